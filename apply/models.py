@@ -30,12 +30,7 @@ from django.conf import settings
 
 GANETI_TAG_PREFIX = settings.GANETI_TAG_PREFIX
 
-try:
-    from ganetimgr.settings import BEANSTALK_TUBE
-except ImportError:
-    BEANSTALK_TUBE = None
-
-import greenstalk
+from ganeti.jobqueue import put_job
 from paramiko import RSAKey, DSSKey
 from binascii import hexlify
 
@@ -249,17 +244,13 @@ class InstanceApplication(models.Model):
         else:
                 disks = [{"size": self.disk_size * 1024}]
         if self.instance_params['node_group'] != 'default':
-            if self.instance_params['disk_template'] == 'drbd':
-                nodes = self.cluster.get_available_nodes(
-                    self.instance_params['node_group'],
-                    2
-                )
-            else:
-                nodes = self.cluster.get_available_nodes(
-                    self.instance_params['node_group'],
-                    1
-                )
-            # We should select the two first non offline nodes
+            # the nodes with the most headroom left for the instance
+            nodes = self.cluster.get_available_nodes(
+                self.instance_params['node_group'],
+                2 if self.instance_params['disk_template'] == 'drbd' else 1,
+                memory=self.memory,
+                disk=self.disk_size * 1024
+            )
         if self.instance_params['disk_template'] in ['drbd', 'plain']:
             if self.instance_params['vgs'] != 'default':
                 disks[0]['vg'] = self.instance_params['vgs']
@@ -281,13 +272,10 @@ class InstanceApplication(models.Model):
         self.save()
         application_submitted.send(sender=self)
 
-        b = greenstalk.Client(host=settings.BEANSTALKD_HOST, port=settings.BEANSTALKD_PORT)
-        if BEANSTALK_TUBE:
-            b.use(BEANSTALK_TUBE)
-        b.put(json.dumps({
+        put_job(self.cluster.slug, {
             "type": "CREATE",
             "application_id": self.id
-        }))
+        })
 
     def get_ssh_keys_url(self, prefix=None):
         if prefix is None:
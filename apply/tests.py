@@ -10,6 +10,8 @@ from apply.models import (
 )
 
 from ganeti.models import Cluster
+from ganeti.snapshots import set_snapshot
+from apply.views import _application_placements
 
 
 class ApplicationTestCase(TestCase):
@@ -426,3 +428,30 @@ class UserTestCase(TestCase):
             reverse('delete-key', args=(key.id, )),
         )
         self.assertEqual(res.status_code, 302)
+
+
+class PlacementTestCase(TestCase):
+    def setUp(self):
+        self.clusters = [
+            Cluster.objects.create(hostname='open.example.com', slug='open'),
+            Cluster.objects.create(
+                hostname='disabled.example.com', slug='disabled',
+                disabled=True
+            ),
+            Cluster.objects.create(
+                hostname='closed.example.com', slug='closed',
+                disable_instance_creation=True
+            ),
+        ]
+        for cluster in self.clusters:
+            set_snapshot(cluster._node_projection_key(), {
+                'nodes': [], 'offline': [],
+                'capacity': [('node1', 'a', 8192, 8192, 10240, 10240, 0)],
+            }, 60)
+
+    def test_only_open_clusters_are_considered(self):
+        application = InstanceApplication(memory=1024, disk_size=1)
+        self.assertEqual(
+            [p['cluster'].slug for p in _application_placements(application)],
+            ['open']
+        )
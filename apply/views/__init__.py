@@ -37,6 +37,7 @@ from django.http import (
     HttpResponse
 )
 
+from ganeti.capacity import find_placements
 from ganeti.models import (
     Network,
     Cluster,
@@ -191,6 +192,24 @@ def application_list(request):
     )
 
 
+def _application_placements(application):
+    '''
+    Returns where the application fits on the clusters open to new
+    instances, using the nodes already cached only.
+    '''
+    capacities = {}
+    clusters = Cluster.objects.exclude(disabled=True).exclude(
+        disable_instance_creation=True
+    )
+    for cluster in clusters:
+        rows = cluster.get_capacity(refresh=False)
+        if rows is not None:
+            capacities[cluster] = rows
+    return find_placements(
+        capacities, application.memory, application.disk_size * 1024
+    )
+
+
 @permission_required("apply.change_instanceapplication")
 def review_application(request, application_id=None):
     applications = InstanceApplication.objects.filter(status__in=PENDING_CODES)
@@ -226,7 +245,8 @@ def review_application(request, application_id=None):
                 'application': app,
                 'applications': applications,
                 'appform': form,
-                'fast_clusters': fast_clusters
+                'fast_clusters': fast_clusters,
+                'placements': _application_placements(app),
             }
         )
     elif request.method == "POST":
@@ -0,0 +1,144 @@
+'''
+Placement of new instances on the nodes of the clusters.
+
+When the nodes of a cluster are refreshed, the free and total memory and
+disk of the nodes which can take new instances are kept with the node
+projection as compact rows (see capacity_rows), so that answering where an
+instance of a given size fits needs neither Ganeti nor the full node list.
+
+A node fits an instance if its free memory and disk cover it. Nodes that
+fit are scored by the headroom they would have left, the smaller of the
+free memory and free disk fractions after the instance is placed, and
+among equal scores the node with fewer primary instances comes first.
+A DRBD instance needs a pair of nodes of the same node group, both of which
+fit it: the secondary holds a copy of the disk and has to be able to run
+the instance on failover.
+'''
+
+# the fields of a capacity row
+NAME, GROUP, MFREE, MTOTAL, DFREE, DTOTAL, PINST_CNT = range(7)
+
+
+def capacity_rows(nodes):
+    '''
+    Returns the capacity rows of the nodes that can take new instances,
+    nodes being the nodes of a cluster as stored by Cluster.refresh_nodes.
+    '''
+    return [
+        (n['name'], n['group'], n['mfree'] or 0, n['mtotal'] or 0,
+         n['dfree'] or 0, n['dtotal'] or 0, n['pinst_cnt'] or 0)
+        for n in nodes
+        if n['role'] not in ('D', 'O') and n['vm_capable'] is not False and
+        not n['offline']
+    ]
+
+
+def headroom(row, memory, disk):
+    '''
+    Returns the fraction of the memory or disk of the node, whichever is
+    smaller, left free after placing an instance with memory and disk MiB on
+    it, None if it does not fit.
+    '''
+    mfree = row[MFREE] - memory
+    dfree = row[DFREE] - disk
+    if mfree < 0 or dfree < 0 or not row[MTOTAL] or not row[DTOTAL]:
+        return None
+    return min(float(mfree) / row[MTOTAL], float(dfree) / row[DTOTAL])
+
+
+def _ranked(rows, memory, disk):
+    # (sort key, headroom, row) of the rows that fit, best first
+    ranked = []
+    for row in rows:
+        score = headroom(row, memory, disk)
+        if score is not None:
+            ranked.append(((-score, row[PINST_CNT], row[NAME]), score, row))
+    ranked.sort(key=lambda entry: entry[0])
+    return ranked
+
+
+def rank_nodes(rows, memory=0, disk=0, node_group=None):
+    '''
+    Returns the names of the nodes of node_group (any group if None), those
+    that fit the instance first, best scored first, followed by those that
+    do not in their original order.
+    '''
+    if node_group is not None:
+        rows = [row for row in rows if row[GROUP] == node_group]
+    fit = [row[NAME] for key, score, row in _ranked(rows, memory, disk)]
+    chosen = set(fit)
+    return fit + [row[NAME] for row in rows if row[NAME] not in chosen]
+
+
+def _best_per_group(rows, memory, disk):
+    # node group -> the (sort key, headroom, row) of the two nodes of the
+    # group that fit best, best first, in a single pass over the rows
+    best = {}
+    for row in rows:
+        mfree = row[MFREE] - memory
+        dfree = row[DFREE] - disk
+        if mfree < 0 or dfree < 0 or not row[MTOTAL] or not row[DTOTAL]:
+            continue
+        score = min(float(mfree) / row[MTOTAL], float(dfree) / row[DTOTAL])
+        top = best.get(row[GROUP])
+        if top is not None and len(top) == 2 and score < top[1][1]:
+            # most nodes do not make it, skip building their sort key
+            continue
+        entry = ((-score, row[PINST_CNT], row[NAME]), score, row)
+        if top is None:
+            best[row[GROUP]] = [entry]
+        elif entry[0] < top[0][0]:
+            top[:] = [entry, top[0]]
+        elif len(top) == 1 or entry[0] < top[1][0]:
+            top[1:] = [entry]
+    return best
+
+
+def _place(best, drbd):
+    placement = None
+    for group, top in best.items():
+        if drbd:
+            if len(top) < 2:
+                continue
+            # the pair is as good as its weaker node
+            score = top[1][1]
+            secondary = top[1][2][NAME]
+        else:
+            score = top[0][1]
+            secondary = None
+        if placement is None or score > placement['headroom']:
+            placement = {
+                'node_group': group,
+                'primary': top[0][2][NAME],
+                'secondary': secondary,
+                'headroom': score,
+            }
+    return placement
+
+
+def place(rows, memory, disk, drbd=False):
+    '''
+    Returns the best placement of an instance on the nodes of rows, a dict
+    with the node group, the primary and secondary (None unless drbd) node
+    names and the headroom left, or None if it does not fit anywhere.
+    '''
+    return _place(_best_per_group(rows, memory, disk), drbd)
+
+
+def find_placements(capacities, memory, disk):
+    '''
+    Returns the best placement of an instance on each cluster where it fits
+    on one node, best first, with the best DRBD pair of the cluster, if any,
+    as 'pair'. capacities maps clusters to their capacity rows, as returned
+    by Cluster.get_capacity.
+    '''
+    placements = []
+    for cluster, rows in capacities.items():
+        best = _best_per_group(rows, memory, disk)
+        placement = _place(best, drbd=False)
+        if placement is not None:
+            placement['cluster'] = cluster
+            placement['pair'] = _place(best, drbd=True)
+            placements.append(placement)
+    placements.sort(key=lambda p: -p['headroom'])
+    return placements
@@ -6,6 +6,7 @@ from django.template.context import RequestContext
 from functools import partial
 
 from ganeti.models import Cluster, Instance
+from ganeti.permissions import get_permissions
 
 
 def check_auth(view_fn, custom_perm, request, *args, **kwargs):
@@ -23,12 +24,12 @@ def check_auth(view_fn, custom_perm, request, *args, **kwargs):
         cluster = get_object_or_404(Cluster, slug=cluster_slug)
         instance = cluster.get_instance_or_404(instance_name)
         user_permitted = False
+        permissions = get_permissions(request)
 
         if (
-            request.user.is_superuser or
-            request.user in instance.users or
-            (custom_perm and request.user.has_perm(custom_perm)) or
-            (set(request.user.groups.all()) & set(instance.groups))
+            permissions.is_superuser or
+            (custom_perm and permissions.has_perm(custom_perm)) or
+            permissions.owns(instance)
         ):
             user_permitted = True
 
@@ -90,15 +91,9 @@ def check_instance_readonly(view_fn):
             cluster = get_object_or_404(Cluster, slug=cluster_slug)
             instance = cluster.get_instance_or_404(instance_name)
             res = False
+            permissions = get_permissions(request)
 
-            if (
-                request.user.is_superuser or
-                request.user in instance.users or
-                request.user.has_perm('ganeti.view_instances') or
-                set.intersection(
-                    set(request.user.groups.all()), set(instance.groups)
-                )
-            ):
+            if permissions.admin or permissions.owns(instance):
                 res = True
 
             cache.set(cache_key, res, 60)
@@ -0,0 +1,208 @@
+'''
+Hands jobs to watcher.py through beanstalkd.
+
+With WATCHER_SHARDS > 1, the jobs of each cluster go to one of several
+tubes, picked by hashing its slug, so that every job of a cluster is handled
+by the same watcher process when running it with --processes.
+
+Jobs are put by a single producer per process, which keeps its connection
+open and sends the jobs from a greenlet, so that callers never wait for
+beanstalkd. While beanstalkd is unreachable, jobs are appended to
+BEANSTALK_SPOOL_FILE and sent once it is back.
+'''
+import fcntl
+import json
+import logging
+import os
+from collections import deque
+from zlib import crc32
+
+import gevent
+import greenstalk
+from gevent.event import Event
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+BEANSTALK_TUBE = getattr(settings, 'BEANSTALK_TUBE', None) or 'default'
+WATCHER_SHARDS = max(getattr(settings, 'WATCHER_SHARDS', 1), 1)
+SPOOL_FILE = getattr(settings, 'BEANSTALK_SPOOL_FILE', None)
+# jobs kept in memory while beanstalkd is unreachable and there is no spool
+BUFFER_SIZE = 1000
+RECONNECT_INTERVAL = 5
+
+
+def shard_tube(shard):
+    if WATCHER_SHARDS == 1:
+        return BEANSTALK_TUBE
+    return '%s-%d' % (BEANSTALK_TUBE, shard)
+
+
+def cluster_shard(cluster_slug):
+    return crc32(cluster_slug.encode('utf-8')) % WATCHER_SHARDS
+
+
+def job_tube(cluster_slug):
+    '''Returns the tube for the jobs of the cluster with cluster_slug'''
+    return shard_tube(cluster_shard(cluster_slug))
+
+
+def watched_tubes(process, processes):
+    '''
+    Returns the tubes watched by watcher process number process (counting
+    from 0) out of processes.
+    '''
+    tubes = [
+        shard_tube(shard) for shard in range(WATCHER_SHARDS)
+        if shard % processes == process
+    ]
+    if WATCHER_SHARDS > 1 and process == 0:
+        # jobs queued before sharding was enabled
+        tubes.append(BEANSTALK_TUBE)
+    return tubes
+
+
+class Producer(object):
+    '''
+    Puts jobs to beanstalkd from a background greenlet, over a connection
+    that is kept open and reopened when it breaks.
+    '''
+    def __init__(self, host=None, port=None, spool_file=SPOOL_FILE):
+        self.host = host or getattr(settings, 'BEANSTALKD_HOST', 'localhost')
+        self.port = port or getattr(settings, 'BEANSTALKD_PORT', 11300)
+        self.spool_file = spool_file
+        self.buffer = deque()
+        self.wakeup = Event()
+        self.client = None
+        self.tube = None
+        self.flusher = None
+        self.pid = os.getpid()
+        # whether jobs may be waiting in the spool file
+        self.spooled = spool_file is not None and os.path.exists(spool_file)
+
+    def put(self, tube, body):
+        '''Queues a job to be put in tube, without blocking'''
+        if self.pid != os.getpid():
+            # forked, the connection and the greenlet belong to the parent
+            self.__init__(self.host, self.port, self.spool_file)
+        self.buffer.append((tube, body))
+        if len(self.buffer) > BUFFER_SIZE and self.spool_file is None:
+            tube, body = self.buffer.popleft()
+            logger.error('Job buffer full, dropping job %s' % body)
+        if self.flusher is None or self.flusher.dead:
+            self.flusher = gevent.spawn(self._run)
+        self.wakeup.set()
+
+    def _close(self):
+        if self.client is not None:
+            try:
+                self.client.close()
+            except Exception:
+                pass
+        self.client = None
+        self.tube = None
+
+    def _put(self, tube, body):
+        if self.client is None:
+            self.client = greenstalk.Client(host=self.host, port=self.port)
+        if tube != self.tube:
+            self.client.use(tube)
+            self.tube = tube
+        try:
+            self.client.put(body)
+        except greenstalk.BuriedError:
+            # beanstalkd ran out of memory, but has the job
+            pass
+        except (greenstalk.DrainingError, greenstalk.OutOfMemoryError):
+            raise
+        except greenstalk.Error as err:
+            # would fail just the same when retried
+            logger.error('Dropping job %s: %r' % (body, err))
+
+    def flush(self):
+        '''
+        Sends the spooled and the buffered jobs. Returns False if
+        beanstalkd could not be reached, after spooling the buffered jobs.
+        '''
+        try:
+            if self.spooled:
+                self._replay_spool()
+            while self.buffer:
+                self._put(*self.buffer[0])
+                self.buffer.popleft()
+            return True
+        except Exception as err:
+            logger.warning('Error putting jobs to beanstalkd: %s' % err)
+            self._close()
+            self._spool()
+            return False
+
+    def _run(self):
+        while True:
+            if self.spooled:
+                # retry the spooled jobs even if no new ones arrive
+                self.wakeup.wait(RECONNECT_INTERVAL)
+            else:
+                self.wakeup.wait()
+            self.wakeup.clear()
+            if not self.flush():
+                gevent.sleep(RECONNECT_INTERVAL)
+
+    def _spool(self):
+        if self.spool_file is None or not self.buffer:
+            return
+        try:
+            with open(self.spool_file, 'a') as spool:
+                fcntl.flock(spool, fcntl.LOCK_EX)
+                while self.buffer:
+                    tube, body = self.buffer[0]
+                    spool.write(json.dumps({'tube': tube, 'body': body}))
+                    spool.write('\n')
+                    self.buffer.popleft()
+        except (IOError, OSError) as err:
+            logger.error('Error spooling jobs to %s: %s' %
+                         (self.spool_file, err))
+            return
+        self.spooled = True
+
+    def _replay_spool(self):
+        try:
+            spool = open(self.spool_file, 'r+')
+        except (IOError, OSError):
+            # already replayed by another process
+            self.spooled = False
+            return
+        with spool:
+            # other processes may be spooling or replaying too
+            fcntl.flock(spool, fcntl.LOCK_EX)
+            jobs = []
+            for line in spool:
+                try:
+                    jobs.append(json.loads(line))
+                except ValueError:
+                    if line.strip():
+                        logger.error('Skipping malformed spooled job %s' %
+                                     line.strip())
+            sent = 0
+            try:
+                for job in jobs:
+                    self._put(job['tube'], job['body'])
+                    sent += 1
+            finally:
+                spool.seek(0)
+                spool.truncate()
+                for job in jobs[sent:]:
+                    spool.write(json.dumps(job))
+                    spool.write('\n')
+        if sent:
+            logger.info('Sent %d spooled job(s) to beanstalkd' % sent)
+        self.spooled = False
+
+
+producer = Producer()
+
+
+def put_job(cluster_slug, job):
+    '''Queues job, a JSON-serializable dict, for the watcher'''
+    producer.put(job_tube(cluster_slug), json.dumps(job))
@@ -0,0 +1,230 @@
+'''
+Server-side processing of the instance listing.
+
+Instead of sending every visible instance to DataTables to be filtered,
+sorted and paged in the browser, the listing is asked for one page at a time
+with the server-side parameters of DataTables 1.9 (iDisplayStart,
+iDisplayLength, sSearch, sSearch_N, iSortCol_0, sSortDir_0, mDataProp_N).
+
+For every sortable column, each cluster keeps the instances of its snapshot
+in order (the sort index), rebuilt once per snapshot version. A page is
+found by merging the indexes of the clusters shown, skipping the instances
+the user cannot see or that do not match the search, so that only the
+instances of the page are serialized. The text searched is indexed the same
+way.
+'''
+import heapq
+from itertools import chain, islice
+
+from ganeti.permissions import for_user
+from ganeti.utils import memsize, disksizes, instance_status
+
+
+SEARCH_FIELD = 'search'
+
+
+def _status_text(i):
+    status = [instance_status(i)[0]]
+    if 'cdrom_image_path' in i.hvparams:
+        if i.hvparams['cdrom_image_path'] and i.hvparams['boot_order'] == 'cdrom':
+            status.append('CDROM')
+    if i.adminlock:
+        status.append('Admin Lock')
+    if i.isolate:
+        status.append('Isolated')
+    if i.needsreboot:
+        status.append('Needs Reboot')
+    return ' '.join(status)
+
+
+def _network(i):
+    return ' '.join(
+        link if ip is None else '%s@%s' % (ip, link)
+        for ip, link in zip(i.nic_ips, i.nic_links)
+    )
+
+
+def _owners(i):
+    return ' '.join(
+        ['%s %s' % (u.username, u.email) for u in i.users] +
+        [g.name for g in i.groups]
+    )
+
+
+# mData of a column -> (sort key, searched text) of an instance
+COLUMNS = {
+    'name': (lambda i: i.name, lambda i: i.name),
+    'pnode': (lambda i: i.pnode or '', lambda i: i.pnode or ''),
+    'memory': (
+        lambda i: i.beparams['maxmem'] or 0,
+        lambda i: memsize(i.beparams['maxmem'])
+    ),
+    'disk': (
+        lambda i: sum(i.disk_sizes),
+        lambda i: ', '.join(disksizes(i.disk_sizes))
+    ),
+    'vcpus': (
+        lambda i: i.beparams['vcpus'] or 0,
+        lambda i: str(i.beparams['vcpus'])
+    ),
+    'status': (_status_text, _status_text),
+    'ipaddress': (
+        lambda i: ' '.join(ip for ip in i.nic_ips if ip),
+        lambda i: ' '.join(ip for ip in i.nic_ips + i.ipv6s if ip)
+    ),
+    'nic_macs': (
+        lambda i: ', '.join(i.nic_macs),
+        lambda i: ', '.join(i.nic_macs)
+    ),
+    'network': (_network, _network),
+    'users': (
+        lambda i: ' '.join(sorted(u.username for u in i.users)),
+        _owners
+    ),
+}
+
+
+def _search_text(i):
+    return ' '.join(
+        [i.cluster.slug, i.cluster.description or ''] +
+        [text(i) for key, text in COLUMNS.values()]
+    ).lower()
+
+
+def _matches(words, text):
+    # the "smart" filtering of DataTables, every word has to be found
+    return all(word in text for word in words)
+
+
+def _int(params, name, default):
+    try:
+        return int(params.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_params(params):
+    '''
+    Returns the paging, sorting and filtering asked for with the DataTables
+    server-side parameters in params.
+    '''
+    columns = []
+    for n in range(_int(params, 'iColumns', 0)):
+        columns.append({
+            'field': params.get('mDataProp_%d' % n),
+            'search': params.get('sSearch_%d' % n, '').lower().split(),
+            'searchable': params.get('bSearchable_%d' % n) != 'false',
+            'sortable': params.get('bSortable_%d' % n) != 'false',
+        })
+    sort_field = 'name'
+    descending = False
+    if _int(params, 'iSortingCols', 0) > 0:
+        # only the first sorting column is used
+        column = _int(params, 'iSortCol_0', 0)
+        if 0 <= column < len(columns) and columns[column]['sortable']:
+            sort_field = columns[column]['field']
+            descending = params.get('sSortDir_0') == 'desc'
+    return {
+        'echo': _int(params, 'sEcho', 0),
+        'start': max(_int(params, 'iDisplayStart', 0), 0),
+        'length': _int(params, 'iDisplayLength', -1),
+        'search': params.get('sSearch', '').lower().split(),
+        'column_search': [
+            (c['field'], c['search']) for c in columns
+            if c['search'] and c['searchable']
+        ],
+        'sort_field': sort_field,
+        'descending': descending,
+    }
+
+
+def _cluster_text(cluster, admin):
+    # what the cluster column shows
+    return cluster.slug if admin else cluster.description or ''
+
+
+def _filter(clusters, query, admin):
+    '''
+    Returns the (cluster slug, name) of the visible instances matching the
+    search of query, or None if there is no search.
+    '''
+    if not query['search'] and not query['column_search']:
+        return None
+    matched = set()
+    for cluster, instances in clusters:
+        visible = dict((i.name, i) for i in instances)
+        if query['search']:
+            names = [
+                name for text, name in
+                cluster.get_instance_order(SEARCH_FIELD, _search_text)
+                if name in visible and _matches(query['search'], text)
+            ]
+        else:
+            names = list(visible)
+        for field, words in query['column_search']:
+            if field == 'cluster':
+                text = _cluster_text(cluster, admin).lower()
+                if not _matches(words, text):
+                    names = []
+            elif field in COLUMNS:
+                text = COLUMNS[field][1]
+                names = [
+                    name for name in names
+                    if _matches(words, text(visible[name]).lower())
+                ]
+        matched.update((cluster.slug, name) for name in names)
+    return matched
+
+
+def get_page(instances, user, params):
+    '''
+    Returns the number of instances, the number of those matching the search
+    and the instances of the page asked for with params, in order.
+    instances are all the instances the user can see.
+    '''
+    query = parse_params(params)
+    admin = for_user(user).admin
+    clusters = {}
+    for instance in instances:
+        clusters.setdefault(
+            instance.cluster.slug, (instance.cluster, [])
+        )[1].append(instance)
+    clusters = list(clusters.values())
+    visible = dict(
+        ((i.cluster.slug, i.name), i) for i in instances
+    )
+    matched = _filter(clusters, query, admin)
+    wanted = visible if matched is None else matched
+
+    field = query['sort_field']
+    if field not in COLUMNS and field != 'cluster':
+        field = 'name'
+    descending = query['descending']
+
+    def ordered(cluster, field):
+        entries = cluster.get_instance_order(field, COLUMNS[field][0])
+        if descending:
+            entries = reversed(entries)
+        return (
+            (key, cluster.slug, name) for key, name in entries
+            if (cluster.slug, name) in wanted
+        )
+
+    if field == 'cluster':
+        clusters.sort(
+            key=lambda c: _cluster_text(c[0], admin), reverse=descending
+        )
+        merged = chain(*[ordered(c, 'name') for c, i in clusters])
+    else:
+        merged = heapq.merge(
+            *[ordered(c, field) for c, i in clusters], reverse=descending
+        )
+
+    stop = None
+    if query['length'] >= 0:
+        stop = query['start'] + query['length']
+    page = [
+        visible[(slug, name)] for key, slug, name in
+        islice(merged, query['start'], stop)
+    ]
+    return len(visible), len(wanted), page
@@ -0,0 +1,152 @@
+'''
+Two-tier cache for the hot keys of the ganeti app.
+
+Values are kept for a few seconds in an in-process cache (L1) of at most
+L1_MAX_ENTRIES entries in front of the shared Django cache, so that views
+reading the same large keys over and over (cluster snapshots, the owner
+index) do not fetch and unpickle them on every call.
+
+Every write or delete through hot_cache is also appended to an invalidation
+log in the shared cache: a sequence counter plus a ring of the last
+INVALIDATION_LOG_SIZE keys. Each process polls the counter at most once per
+INVALIDATION_POLL_INTERVAL seconds and drops the L1 entries of the keys
+logged since its last poll, or all of them if it fell too far behind.
+
+Values returned from L1 are shared between callers and must not be modified
+in place.
+'''
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+L1_TIMEOUT = getattr(settings, 'L1_CACHE_TIMEOUT', 5)
+# bounded by count rather than size, measuring values would mean pickling
+# them once more on every fill
+L1_MAX_ENTRIES = getattr(settings, 'L1_CACHE_MAX_ENTRIES', 256)
+INVALIDATION_LOG_SIZE = 256
+INVALIDATION_POLL_INTERVAL = 1
+# logged instead of a key to drop every entry
+CLEAR_ALL = '*'
+
+SEQUENCE_KEY = 'l1:sequence'
+
+
+def _log_key(sequence):
+    return 'l1:log:%d' % (sequence % INVALIDATION_LOG_SIZE)
+
+
+class TwoTierCache(object):
+    def __init__(self, timeout=L1_TIMEOUT, max_entries=L1_MAX_ENTRIES):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        # key -> (expires, value), least recently used first
+        self.entries = OrderedDict()
+        self.sequence = None
+        self.next_poll = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _drop(self, key):
+        self.entries.pop(key, None)
+
+    def clear_local(self):
+        self.entries.clear()
+
+    def _poll_invalidations(self):
+        now = time.time()
+        if now < self.next_poll:
+            return
+        self.next_poll = now + INVALIDATION_POLL_INTERVAL
+        sequence = cache.get(SEQUENCE_KEY)
+        last = self.sequence
+        self.sequence = sequence
+        if sequence == last:
+            return
+        if (
+            last is None or sequence is None or sequence < last or
+            sequence - last > INVALIDATION_LOG_SIZE
+        ):
+            self.clear_local()
+            return
+        logged = cache.get_many(
+            [_log_key(s) for s in range(last + 1, sequence + 1)]
+        )
+        for s in range(last + 1, sequence + 1):
+            entry = logged.get(_log_key(s))
+            if entry is None or entry[0] != s or entry[1] == CLEAR_ALL:
+                # not logged yet or already overwritten, we cannot tell
+                # what changed
+                self.clear_local()
+                return
+            self._drop(entry[1])
+
+    def _broadcast(self, key):
+        cache.add(SEQUENCE_KEY, 0, None)
+        try:
+            sequence = cache.incr(SEQUENCE_KEY)
+        except ValueError:
+            # evicted in the meantime, every process will clear its L1
+            cache.set(SEQUENCE_KEY, 0, None)
+            return
+        cache.set(_log_key(sequence), (sequence, key),
+                  INVALIDATION_POLL_INTERVAL * 60)
+
+    def _store(self, key, value, timeout):
+        self._drop(key)
+        expires = time.time() + self.timeout
+        if timeout is not None:
+            expires = min(expires, time.time() + timeout)
+        self.entries[key] = (expires, value)
+        while len(self.entries) > self.max_entries:
+            self._drop(next(iter(self.entries)))
+
+    def get(self, key, default=None):
+        self._poll_invalidations()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._drop(key)
+        self.misses += 1
+        value = cache.get(key)
+        if value is None:
+            return default
+        self._store(key, value, self.timeout)
+        return value
+
+    def set(self, key, value, timeout):
+        cache.set(key, value, timeout)
+        self._broadcast(key)
+        self._store(key, value, timeout)
+
+    def delete(self, key):
+        cache.delete(key)
+        self._broadcast(key)
+        self._drop(key)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def clear(self):
+        '''
+        Drops every L1 entry in every process, leaving the shared cache as
+        it is.
+        '''
+        self._broadcast(CLEAR_ALL)
+        self.clear_local()
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+hot_cache = TwoTierCache()
@@ -0,0 +1,89 @@
+'''
+Registry of the instances locked by running jobs, shown as such in the
+instance listings.
+
+With Redis as the cache, every lock is a field of a single hash, holding
+the reason and the expiry time of the lock, so that locking and unlocking
+an instance are single atomic commands and the listing fetches the locks
+of the instances it shows with one HMGET. Expired fields are removed when
+found. With any other cache backend, every lock is a cache key of its own.
+'''
+import json
+import time
+
+from django.core.cache import cache
+
+
+HASH_KEY = 'instance_locks'
+KEY_PREFIX = 'locked_instance:'
+LOCK_TIMEOUT = 90
+
+
+def _redis():
+    '''Returns the Redis client of the cache, None for other backends'''
+    get_client = getattr(cache, 'get_client', None)
+    if get_client is None or not hasattr(cache, 'get_master_client'):
+        return None
+    return get_client(_hash_key(), write=True)
+
+
+def _hash_key():
+    return cache.make_key(HASH_KEY)
+
+
+def lock_instance(name, reason, timeout=LOCK_TIMEOUT):
+    client = _redis()
+    if client is None:
+        cache.set(KEY_PREFIX + name, reason, timeout)
+        return
+    client.hset(_hash_key(), name, json.dumps([reason, time.time() + timeout]))
+    # the hash outlives its entries only if it is abandoned
+    client.expire(_hash_key(), timeout)
+
+
+def unlock_instance(name):
+    '''Unlocks the instance, returns False if it was not locked'''
+    client = _redis()
+    if client is None:
+        locked = cache.get(KEY_PREFIX + name) is not None
+        cache.delete(KEY_PREFIX + name)
+        return locked
+    return bool(client.hdel(_hash_key(), name))
+
+
+def get_locked_instances(names):
+    '''
+    Returns a dict with the lock reason of the instances with the given
+    names which are locked.
+    '''
+    names = list(names)
+    if not names:
+        return {}
+    client = _redis()
+    if client is None:
+        return dict(
+            (key[len(KEY_PREFIX):], reason) for key, reason in
+            cache.get_many([KEY_PREFIX + name for name in names]).items()
+        )
+
+    now = time.time()
+    locked = {}
+    expired = []
+    for name, value in zip(names, client.hmget(_hash_key(), names)):
+        if value is None:
+            continue
+        reason, expires = json.loads(value)
+        if expires > now:
+            locked[name] = reason
+        else:
+            expired.append(name)
+    if expired:
+        client.hdel(_hash_key(), *expired)
+    return locked
+
+
+def clear():
+    '''Forgets every lock, only possible with Redis'''
+    client = _redis()
+    if client is not None:
+        client.delete(_hash_key())
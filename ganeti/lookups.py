@@ -0,0 +1,350 @@
+'''
+Per tag lookups of the users, groups, organizations and applications that
+instance tags refer to.
+
+Instead of loading whole tables, every tag is resolved on demand and stored
+in the shared cache on its own, as a tuple of primitive fields. A small process-local LRU sits in front of the shared cache, so that
+listing thousands of instances owned by the same few users does not hit the
+cache for every one of them. Saving or deleting any of these models drops
+its entries from both.
+'''
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User, Group
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from apply.models import Organization, InstanceApplication
+
+
+# how long entries stay in the shared cache, which also bounds how long a
+# renamed user, group or organization can still be found by its old name
+LOOKUP_CACHE_TIMEOUT = getattr(settings, 'LOOKUP_CACHE_TIMEOUT', 600)
+# entries in the process-local cache are not invalidated by other processes,
+# keep them just long enough to serve a request
+LOOKUP_LOCAL_TIMEOUT = getattr(settings, 'LOOKUP_LOCAL_TIMEOUT', 10)
+LOOKUP_LOCAL_SIZE = getattr(settings, 'LOOKUP_LOCAL_SIZE', 10000)
+
+# stored in the shared cache for names that do not exist
+MISSING = False
+
+
+class UserRef(object):
+    '''
+    Lightweight stand-in for a User, equal to the User with the same pk.
+    '''
+    __slots__ = ('pk', 'username', 'email', 'first_name', 'last_name')
+
+    def __init__(self, pk, username, email, first_name, last_name):
+        self.pk = pk
+        self.username = username
+        self.email = email
+        self.first_name = first_name
+        self.last_name = last_name
+
+    @property
+    def id(self):
+        return self.pk
+
+    def __eq__(self, other):
+        if isinstance(other, (UserRef, User)):
+            return self.pk == other.pk
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __str__(self):
+        return self.username
+
+    def __repr__(self):
+        return '<UserRef: %s>' % self.username
+
+    def get_object(self):
+        return User.objects.get(pk=self.pk)
+
+
+class RefList(list):
+    '''
+    List of refs that can stand in for a related manager in templates.
+    '''
+    def all(self):
+        return self
+
+
+class GroupRef(object):
+    '''
+    Lightweight stand-in for a Group, equal to the Group with the same pk.
+    Its members are resolved through the user lookup when asked for.
+    '''
+    __slots__ = ('pk', 'name', 'usernames')
+
+    def __init__(self, pk, name, usernames):
+        self.pk = pk
+        self.name = name
+        self.usernames = usernames
+
+    @property
+    def id(self):
+        return self.pk
+
+    @property
+    def userset(self):
+        return RefList(
+            user for user in map(users.get, self.usernames)
+            if user is not None
+        )
+
+    @property
+    def user_set(self):
+        return self.userset
+
+    def __eq__(self, other):
+        if isinstance(other, (GroupRef, Group)):
+            return self.pk == other.pk
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return '<GroupRef: %s>' % self.name
+
+    def get_object(self):
+        return Group.objects.get(pk=self.pk)
+
+
+class ModelRef(object):
+    '''
+    Lightweight stand-in for a model instance, equal to the instance of the
+    model with the same pk, which holds its id and name only. Any other
+    field is read from the instance, loaded once when first asked for.
+    '''
+    __slots__ = ('pk', '_object')
+    model = None
+
+    def __init__(self, pk):
+        self.pk = pk
+        self._object = None
+
+    @property
+    def id(self):
+        return self.pk
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get_object(), name)
+
+    def __eq__(self, other):
+        if isinstance(other, (type(self), self.model)):
+            return self.pk == other.pk
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, self)
+
+    def get_object(self):
+        if self._object is None:
+            self._object = self.model.objects.get(pk=self.pk)
+        return self._object
+
+
+class OrganizationRef(ModelRef):
+    __slots__ = ('tag', 'title')
+    model = Organization
+
+    def __init__(self, pk, tag, title):
+        ModelRef.__init__(self, pk)
+        self.tag = tag
+        self.title = title
+
+    def __str__(self):
+        return self.title
+
+
+class ApplicationRef(ModelRef):
+    __slots__ = ('hostname',)
+    model = InstanceApplication
+
+    def __init__(self, pk, hostname):
+        ModelRef.__init__(self, pk)
+        self.hostname = hostname
+
+    def __str__(self):
+        return self.hostname
+
+
+class Lookup(object):
+    '''
+    Read-only mapping of names to objects, loaded one name at a time.
+
+    load(name) returns what is stored in the shared cache for name (None if
+    it does not exist) and build(stored) the object handed to callers.
+    '''
+    def __init__(self, prefix, load, build=None):
+        self.prefix = prefix
+        self.load = load
+        self.build = build
+        self.local = OrderedDict()
+
+    def _key(self, name):
+        return 'lookup:%s:%s' % (self.prefix, name)
+
+    def get(self, name, default=None):
+        now = time.time()
+        try:
+            expires, value = self.local.pop(name)
+        except KeyError:
+            pass
+        else:
+            if expires > now:
+                self.local[name] = (expires, value)
+                return default if value is None else value
+
+        key = self._key(name)
+        stored = cache.get(key)
+        if stored is None:
+            stored = self.load(name)
+            if stored is None:
+                stored = MISSING
+            cache.set(key, stored, LOOKUP_CACHE_TIMEOUT)
+        if stored is MISSING:
+            value = None
+        elif self.build is not None:
+            value = self.build(stored)
+        else:
+            value = stored
+
+        self.local[name] = (now + LOOKUP_LOCAL_TIMEOUT, value)
+        while len(self.local) > LOOKUP_LOCAL_SIZE:
+            self.local.popitem(last=False)
+        return default if value is None else value
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def invalidate(self, name):
+        self.local.pop(name, None)
+        cache.delete(self._key(name))
+
+    def clear_local(self):
+        self.local.clear()
+
+
+def _load_user(username):
+    return User.objects.filter(username=username).values_list(
+        'pk', 'username', 'email', 'first_name', 'last_name'
+    ).first()
+
+
+def _load_group(name):
+    group = Group.objects.filter(name=name).values_list('pk', flat=True).first()
+    if group is None:
+        return None
+    return (group, name, tuple(
+        User.objects.filter(groups=group).values_list('username', flat=True)
+    ))
+
+
+def _load_organization(tag):
+    return Organization.objects.filter(tag=tag).values_list(
+        'pk', 'tag', 'title'
+    ).first()
+
+
+def _load_application(pk):
+    try:
+        pk = int(pk)
+    except ValueError:
+        return None
+    return InstanceApplication.objects.filter(pk=pk).values_list(
+        'pk', 'hostname'
+    ).first()
+
+
+users = Lookup('user', _load_user, lambda stored: UserRef(*stored))
+groups = Lookup('group', _load_group, lambda stored: GroupRef(*stored))
+organizations = Lookup(
+    'org', _load_organization, lambda stored: OrganizationRef(*stored)
+)
+applications = Lookup(
+    'application', _load_application, lambda stored: ApplicationRef(*stored)
+)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(sender, instance, **kwargs):
+    users.invalidate(instance.username)
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def invalidate_group(sender, instance, **kwargs):
+    groups.invalidate(instance.name)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_group_members(sender, instance, action, reverse, pk_set,
+                             **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # the members of a group changed
+        groups.invalidate(instance.name)
+        return
+    if action == 'pre_clear':
+        names = instance.groups.values_list('name', flat=True)
+    else:
+        names = Group.objects.filter(pk__in=pk_set).values_list(
+            'name', flat=True
+        )
+    for name in names:
+        groups.invalidate(name)
+
+
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+def invalidate_organization(sender, instance, **kwargs):
+    if instance.tag:
+        organizations.invalidate(instance.tag)
+
+
+@receiver(post_save, sender=InstanceApplication)
+@receiver(post_delete, sender=InstanceApplication)
+def invalidate_application(sender, instance, **kwargs):
+    applications.invalidate(str(instance.pk))
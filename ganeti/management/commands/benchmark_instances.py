@@ -0,0 +1,135 @@
+import gc
+import time
+import tracemalloc
+
+from gevent.pool import Pool
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from ganeti.lookups import GroupRef, UserRef
+from ganeti.models import Cluster, Instance, GANETI_TAG_PREFIX
+from ganeti.utils import generate_json, generate_json_rows
+
+
+class Command(BaseCommand):
+    help = ("Measures memory per instance and construction time of "
+            "Instance objects built from synthetic RAPI data, and the CPU "
+            "time spent building their listing rows")
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("--count", type=int, default=10000)
+
+    @staticmethod
+    def extra_data(count):
+        users = dict(
+            ("user%d" % i, UserRef(i + 1, "user%d" % i,
+                                   "user%d@example.com" % i, "", ""))
+            for i in range(count // 10 + 1)
+        )
+        groups = dict(
+            ("group%d" % i, GroupRef(i + 1, "group%d" % i, ()))
+            for i in range(count // 100 + 1)
+        )
+        networks = {
+            "br0": "2001:db8:1::/64",
+            "br1": "2001:db8:2::/64",
+        }
+        return {"users": users, "orgs": {}, "groups": groups,
+                "instanceapps": {}, "networks": networks}
+
+    @staticmethod
+    def instance_info(i):
+        return {
+            "name": "instance%d.example.com" % i,
+            "tags": [
+                "%s:user:user%d" % (GANETI_TAG_PREFIX, i // 10),
+                "%s:group:group%d" % (GANETI_TAG_PREFIX, i // 100),
+                "%s:service:web" % GANETI_TAG_PREFIX,
+            ],
+            "pnode": "node%d.example.com" % (i % 40),
+            "snodes": ["node%d.example.com" % ((i + 1) % 40)],
+            "disk.sizes": [20480],
+            "nic.modes": ["bridged", "routed"],
+            "nic.ips": [None, "192.0.2.%d" % (i % 250 + 1)],
+            "nic.links": ["br0", "br1"],
+            "status": "running",
+            "admin_state": "up",
+            "beparams": {"vcpus": 2, "maxmem": 2048, "minmem": 2048},
+            "oper_state": True,
+            "hvparams": {"kernel_path": "", "root_path": "/dev/vda1"},
+            "nic.macs": [
+                "aa:00:00:%02x:%02x:01" % (i // 256 % 256, i % 256),
+                "aa:00:00:%02x:%02x:02" % (i // 256 % 256, i % 256),
+            ],
+            "ctime": 1500000000 + i,
+            "mtime": 1500000000 + i,
+        }
+
+    def handle(self, *args, **options):
+        count = options["count"]
+        cluster = Cluster(hostname="bench.example.com", slug="bench")
+        extra_data = self.extra_data(count)
+        infos = [self.instance_info(i) for i in range(count)]
+
+        start = time.time()
+        instances = [
+            Instance(cluster, info["name"], info, extra_data)
+            for info in infos
+        ]
+        construction = time.time() - start
+
+        # tracing slows allocations down, so measure memory on a second run
+        del instances
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        instances = [
+            Instance(cluster, info["name"], info, extra_data)
+            for info in infos
+        ]
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        start = time.time()
+        listed = [(i.name, i.pnode) for i in instances]
+        name_access = time.time() - start
+
+        start = time.time()
+        for i in instances:
+            (i.users, i.groups, i.services, i.ipv6s, i.ctime,
+             i.admin_state, i.nic_ips)
+        full_access = time.time() - start
+
+        # rows are rendered without the row cache, the instances have no
+        # snapshot version
+        admin = User(username="admin", is_superuser=True)
+        pool_rows = []
+
+        def render(instance):
+            pool_rows.extend(generate_json(instance, admin, []))
+
+        # fresh instances for each run, so that both resolve their fields
+        instances = [
+            Instance(cluster, info["name"], info, extra_data)
+            for info in infos
+        ]
+        start = time.process_time()
+        Pool(80).map(render, instances)
+        pool_rows_cpu = time.process_time() - start
+
+        instances = [
+            Instance(cluster, info["name"], info, extra_data)
+            for info in infos
+        ]
+        start = time.process_time()
+        rows, errors = generate_json_rows(instances, admin, [])
+        batched_rows_cpu = time.process_time() - start
+
+        self.stdout.write("instances:             %d" % len(listed))
+        self.stdout.write("construction:          %.3fs" % construction)
+        self.stdout.write("memory per instance:   %d bytes"
+                          % ((after - before) / count))
+        self.stdout.write("name/pnode access:     %.3fs" % name_access)
+        self.stdout.write("full field access:     %.3fs" % full_access)
+        self.stdout.write("rows, pool of 80:      %.3fs CPU" % pool_rows_cpu)
+        self.stdout.write("rows, batched:         %.3fs CPU" % batched_rows_cpu)
@@ -21,11 +21,10 @@ import base64
 import os
 import ipaddr
 from datetime import datetime, timedelta
-from gevent.pool import Pool
 from socket import gethostbyname
-from time import sleep, time
+from time import time
 from django.db import models
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.http import Http404
 from django.core.cache import cache
@@ -36,8 +35,28 @@ from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
 from django.conf import settings
 from util import vapclient
-from util.client import GanetiRapiClient, GanetiApiError, GenericCurlConfig
-from apply.models import Organization, InstanceApplication
+from util.client import (
+    GanetiRapiClient,
+    GanetiApiError,
+    GenericCurlConfig,
+    CurlPool,
+    CURL_POOL_MAXSIZE,
+    CURL_POOL_MAX_IDLE,
+    ExecuteMany,
+    SetMaxInFlight,
+)
+from ganeti import locks, lookups, rollups
+from ganeti.capacity import capacity_rows, rank_nodes
+from ganeti.jobqueue import put_job
+from ganeti.localcache import hot_cache
+from ganeti.permissions import for_user
+from ganeti.snapshots import (
+    get_snapshot,
+    get_versioned_snapshot,
+    read_snapshot,
+    set_snapshot,
+    update_snapshot,
+)
 from distutils.version import LooseVersion
 from jwcrypto import jwt, jwk
 
@@ -53,38 +72,91 @@ REQUEST_ACTIONS = (
 
 RAPI_CONNECT_TIMEOUT = settings.RAPI_CONNECT_TIMEOUT
 RAPI_RESPONSE_TIMEOUT = settings.RAPI_RESPONSE_TIMEOUT
+RAPI_POOL_SIZE = getattr(settings, 'RAPI_POOL_SIZE', CURL_POOL_MAXSIZE)
+RAPI_POOL_MAX_IDLE = getattr(
+    settings, 'RAPI_POOL_MAX_IDLE', CURL_POOL_MAX_IDLE
+)
+RAPI_MAX_IN_FLIGHT = getattr(settings, 'RAPI_MAX_IN_FLIGHT', None)
+if RAPI_MAX_IN_FLIGHT:
+    SetMaxInFlight(RAPI_MAX_IN_FLIGHT)
+# the node group stack is rebuilt whenever the snapshots it is built from
+# change, this only bounds how long an unused one is kept
+NODE_GROUP_STACK_TIMEOUT = 3600
+# the same for the owner index, the rollup and the sort indexes of the
+# instances of a snapshot
+INDEX_TIMEOUT = 3600
+
+INSTANCE_QUERY_FIELDS = [
+    'name',
+    'tags',
+    'pnode',
+    'snodes',
+    'disk.sizes',
+    'nic.modes',
+    'nic.ips',
+    'nic.links',
+    'status',
+    'admin_state',
+    'beparams',
+    'oper_state',
+    'hvparams',
+    'nic.macs',
+    'ctime',
+    'mtime'
+]
+
+NODE_QUERY_FIELDS = [
+    'name',
+    'role',
+    'mfree',
+    'mtotal',
+    'dtotal',
+    'dfree',
+    'ctotal',
+    'group',
+    'pinst_cnt',
+    'offline',
+    'vm_capable',
+    'pinst_list'
+]
+
+# the fields of the nodes listed by clusternodes_json
+NODE_API_FIELDS = [
+    'name',
+    'mem_used',
+    'mfree',
+    'mtotal',
+    'shared_storage',
+    'disk_used',
+    'dfree',
+    'dtotal',
+    'ctotal',
+    'pinst_cnt',
+    'pinst_list',
+    'role',
+    'cluster',
+]
 
 SHA1_RE = re.compile('^[a-f0-9]{40}$')
 
-if hasattr(settings, 'BEANSTALK_TUBE'):
-    BEANSTALK_TUBE = settings.BEANSTALK_TUBE
-else:
-    BEANSTALK_TUBE = None
-
-import greenstalk
 
 import json
 
-from django.db import close_old_connections
-
 
 class InstanceManager(object):
 
     def all(self):
-        p = Pool(20)
         instances = []
-
-        def _get_instances(cluster):
+        # get only enabled clusters
+        clusters = Cluster.objects.filter(disabled=False)
+        errors = prefetch_cluster_data(clusters)
+        for cluster in clusters:
+            if cluster.pk in errors:
+                continue
             try:
                 instances.extend(cluster.get_instances())
             except (GanetiApiError, Exception):
                 pass
-            finally:
-                close_old_connections()
-
-        # get only enabled clusters
-        clusters = Cluster.objects.filter(disabled=False)
-        p.map(_get_instances, clusters)
         return instances
 
     def filter(self, **kwargs):
@@ -145,6 +217,26 @@ class InstanceManager(object):
 
 
 class Instance(object):
+    # Listings build thousands of instances per request, so instances are
+    # slotted and keep a reference to the RAPI info dict instead of copying
+    # it. Everything derived from it (owners, services, IPv6 addresses,
+    # times) is resolved on first access by the _resolve_* methods and then
+    # stored in its slot. Other RAPI fields are read straight from the info
+    # dict, with dots in field names replaced by underscores (nic.macs is
+    # available as nic_macs).
+    __slots__ = (
+        'cluster', 'name', '_info', '_extra_data',
+        # resolved lazily
+        'networks', 'organization', 'application', 'services', 'users',
+        'groups', 'links', 'ipv6s', 'adminlock', 'isolate', 'needsreboot',
+        'whitelistip', 'ctime', 'mtime', 'admin_state', 'nic_ips',
+        # set by views
+        'admin_view_only', 'joblock', 'cpu_url', 'net_url', 'netw',
+        'osname', 'node_group_locked',
+        # version of the cluster snapshot info was read from, if any
+        'snapshot_version',
+    )
+
     objects = InstanceManager()
 
     def __init__(
@@ -152,94 +244,128 @@ class Instance(object):
         cluster,
         name,
         info=None,
-        cached_data=None
+        cached_data=None,
+        snapshot_version=None
     ):
         self.cluster = cluster
         self.name = name
-        self.networks = []
-        self.organization = None
-        self.application = None
-        self.services = []
-        self.users = []
-        self.groups = []
-        self.links = []
-        self.ipv6s = []
+        self.snapshot_version = snapshot_version
         self.admin_view_only = False
-        self.adminlock = False
-        self.isolate = False
-        self.needsreboot = False
-        self.whitelistip = None
         self.joblock = False
         self._update(info, cached_data)
 
     def _update(self, info=None, cached_data=None):
-        serv_cache = {}
         if not info:
             info = self.cluster.get_instance_info(self.name)
-        for attr in info:
-            self.__dict__[attr.replace(".", "_")] = info[attr]
+        self._info = info
+        self._extra_data = cached_data
+
+    def __getattr__(self, attr):
+        # only called for attributes not found in a slot or the class
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        resolver = _INSTANCE_RESOLVERS.get(attr)
+        if resolver is not None:
+            value = resolver(self)
+            setattr(self, attr, value)
+            return value
+        info = self._info
+        try:
+            return info[_INSTANCE_FIELDS.get(attr, attr)]
+        except KeyError:
+            pass
+        for field in info:
+            if field.replace('.', '_') == attr:
+                _INSTANCE_FIELDS[attr] = field
+                return info[field]
+        raise AttributeError(
+            "'Instance' object has no attribute '%s'" % attr
+        )
 
-        group_pfx = "%s:group:" % GANETI_TAG_PREFIX
-        user_pfx = "%s:user:" % GANETI_TAG_PREFIX
-        org_pfx = "%s:org:" % GANETI_TAG_PREFIX
-        app_pfx = "%s:application:" % GANETI_TAG_PREFIX
+    def _get_extra_data(self):
+        if self._extra_data is None:
+            self._extra_data = preload_instance_data()
+        return self._extra_data
+
+    def _resolve_networks(self):
+        return self._get_extra_data()["networks"]
+
+    def _resolve_users(self):
+        return list(tag_prefix_resolver(
+            self._info, "%s:user:" % GANETI_TAG_PREFIX,
+            self._get_extra_data()["users"]))
+
+    def _resolve_groups(self):
+        return list(tag_prefix_resolver(
+            self._info, "%s:group:" % GANETI_TAG_PREFIX,
+            self._get_extra_data()["groups"]))
+
+    def _resolve_organization(self):
+        return next(iter(tag_prefix_resolver(
+            self._info, "%s:org:" % GANETI_TAG_PREFIX,
+            self._get_extra_data()["orgs"])), None)
+
+    def _resolve_application(self):
+        return next(iter(tag_prefix_resolver(
+            self._info, "%s:application:" % GANETI_TAG_PREFIX,
+            self._get_extra_data()["instanceapps"])), None)
+
+    def _resolve_services(self):
         serv_pfx = "%s:service:" % GANETI_TAG_PREFIX
-        adminlock_tag = "%s:adminlock" % GANETI_TAG_PREFIX
-        isolate_tag = "%s:isolate" % GANETI_TAG_PREFIX
-        needsreboot_tag = "%s:needsreboot" % GANETI_TAG_PREFIX
-        whitelist_pfx = "%s:whitelist_ip:" % GANETI_TAG_PREFIX
+        return [tag.replace(serv_pfx, '') for tag in self.tags
+                if tag.startswith(serv_pfx)]
 
-        extra_data = cached_data or preload_instance_data()
+    def _resolve_adminlock(self):
+        return "%s:adminlock" % GANETI_TAG_PREFIX in self.tags
 
-        self.groups = list(tag_prefix_resolver(info, group_pfx,
-                                               extra_data["groups"]))
-        self.users = list(tag_prefix_resolver(info, user_pfx,
-                                              extra_data["users"]))
-        self.organization = next(iter(tag_prefix_resolver(
-            info, org_pfx, extra_data["orgs"])), None)
-        self.application = next(iter(tag_prefix_resolver(
-            info, app_pfx, extra_data["instanceapps"])), None)
-        self.networks = extra_data["networks"]
+    def _resolve_isolate(self):
+        return "%s:isolate" % GANETI_TAG_PREFIX in self.tags
 
+    def _resolve_needsreboot(self):
+        return "%s:needsreboot" % GANETI_TAG_PREFIX in self.tags
+
+    def _resolve_whitelistip(self):
+        whitelist_pfx = "%s:whitelist_ip:" % GANETI_TAG_PREFIX
+        whitelistip = None
         for tag in self.tags:
-            if tag.startswith(serv_pfx):
-                serv = tag.replace(serv_pfx, '')
-                if serv not in serv_cache:
-                    serv_cache[serv] = serv
-                if serv_cache[serv] is not None:
-                    self.services.append(serv_cache[serv])
-            elif tag == adminlock_tag:
-                self.adminlock = True
-            elif tag == isolate_tag:
-                self.isolate = True
-            elif tag == needsreboot_tag:
-                self.needsreboot = True
-            elif tag.startswith(whitelist_pfx):
-                self.whitelistip = tag.replace(whitelist_pfx, '')
-        if getattr(self, 'ctime', None):
-            self.ctime = datetime.fromtimestamp(self.ctime)
-        if getattr(self, 'mtime', None):
-            self.mtime = datetime.fromtimestamp(self.mtime)
-        for nlink in self.nic_links:
-            try:
-                self.links.append(self.networks[nlink])
-            except Exception:
-                pass
-        for i in range(len(self.nic_modes)):
-            if self.nic_modes[i] == 'bridged':
-                self.nic_ips[i] = None
-        for i in range(len(self.links)):
-            try:
-                ipv6addr = self.generate_ipv6(self.links[i], self.nic_macs[i])
-                if not ipv6addr:
-                    continue
-                self.ipv6s.append("%s" % (ipv6addr))
-            except Exception:
-                pass
-        if self.admin_state == 'up':
-            self.admin_state = True
-        if self.admin_state == 'down':
-            self.admin_state = False
+            if tag.startswith(whitelist_pfx):
+                whitelistip = tag.replace(whitelist_pfx, '')
+        return whitelistip
+
+    def _resolve_ctime(self):
+        ctime = self._info.get('ctime')
+        return datetime.fromtimestamp(ctime) if ctime else ctime
+
+    def _resolve_mtime(self):
+        mtime = self._info.get('mtime')
+        return datetime.fromtimestamp(mtime) if mtime else mtime
+
+    def _resolve_admin_state(self):
+        admin_state = self._info.get('admin_state')
+        if admin_state == 'up':
+            return True
+        if admin_state == 'down':
+            return False
+        return admin_state
+
+    def _resolve_nic_ips(self):
+        nic_ips = list(self._info['nic.ips'])
+        for i, mode in enumerate(self.nic_modes):
+            if mode == 'bridged':
+                nic_ips[i] = None
+        return nic_ips
+
+    def _resolve_links(self):
+        return [self.networks[nlink] for nlink in self.nic_links
+                if nlink in self.networks]
+
+    def _resolve_ipv6s(self):
+        ipv6s = []
+        for link, mac in zip(self.links, self.nic_macs):
+            ipv6addr = self.generate_ipv6(link, mac)
+            if ipv6addr:
+                ipv6s.append("%s" % (ipv6addr))
+        return ipv6s
 
     def generate_ipv6(self, prefix, mac):
         try:
@@ -320,6 +446,16 @@ class Instance(object):
         return self._pending_action_request(3)
 
 
+# attribute name -> method resolving it, see Instance.__getattr__
+_INSTANCE_RESOLVERS = dict(
+    (name[len('_resolve_'):], method)
+    for name, method in vars(Instance).items()
+    if name.startswith('_resolve_')
+)
+# attribute name -> RAPI field name, for fields with dots in their name
+_INSTANCE_FIELDS = {}
+
+
 class Cluster(models.Model):
     hostname = models.CharField(max_length=128)
     slug = models.SlugField(max_length=50)
@@ -360,8 +496,14 @@ class Cluster(models.Model):
             host=self.hostname,
             username=self.username,
             password=self.password,
-            curl_config_fn=curl_conf
+            curl_config_fn=curl_conf,
+            curl_pool=get_rapi_pool(
+                self.hostname, self.username, self.password
+            ),
+            timeout=RAPI_RESPONSE_TIMEOUT
         )
+        # cleared if the cluster's RAPI cannot query jobs
+        self._query_jobs = True
 
     def __str__(self):
         return self.hostname
@@ -369,6 +511,21 @@ class Cluster(models.Model):
     def _cluster_cache_key(self):
         return "cluster:{0}:instances".format(self.hostname)
 
+    def _instance_index_key(self):
+        return "cluster:{0}:instances:index".format(self.hostname)
+
+    def _rollup_key(self):
+        return "cluster:{0}:instances:rollup".format(self.hostname)
+
+    def _node_group_stack_key(self):
+        return "cluster:{0}:nodegroups:stack".format(self.hostname)
+
+    def _node_projection_key(self):
+        return "cluster:{0}:nodes:api".format(self.hostname)
+
+    def _instance_order_key(self, field):
+        return "cluster:{0}:instances:order:{1}".format(self.hostname, field)
+
     def _instance_cache_key(self, instance):
         return "cluster:{0}:instance:{1}".format(self.hostname, instance)
 
@@ -376,36 +533,23 @@ class Cluster(models.Model):
         return "cluster:{0}:instance:{1}:lock".format(self.hostname, instance)
 
     def _lock_instance(self, instance, reason="locked",
-                       timeout=30, job_id=None, flush_keys=[]):
+                       timeout=30, job_id=None, flush_keys=[],
+                       refresh_names=None):
         lock_key = self._instance_lock_key(instance)
         cache.set(lock_key, reason, timeout)
-        locked_instances = cache.get('locked_instances')
-        if locked_instances is not None:
-            locked_instances["%s" % instance] = reason
-            cache.set('locked_instances', locked_instances, 90)
-        else:
-            cache.set('locked_instances', {'%s' % instance: "%s" % reason}, 90)
+        locks.lock_instance("%s" % instance, "%s" % reason)
         if job_id is not None:
-            b = None
-            for i in range(5):
-                try:
-                    b = greenstalk.Client(host=settings.BEANSTALKD_HOST, port=settings.BEANSTALKD_PORT)
-                    break
-                except Exception:
-                    sleep(1)
-            if b is None:
-                return
-
-            if BEANSTALK_TUBE:
-                b.use(BEANSTALK_TUBE)
-            b.put(json.dumps({
+            put_job(self.slug, {
                 "type": "JOB_LOCK",
                 "cluster": self.slug,
                 "instance": instance,
                 "job_id": job_id,
                 "lock_key": lock_key,
-                "flush_keys": flush_keys + [self._instance_cache_key(instance)]
-            }))
+                "flush_keys": flush_keys + [self._instance_cache_key(instance)],
+                # instances to update in the cluster snapshot once the job
+                # is over
+                "refresh_names": refresh_names or [instance],
+            })
 
     @classmethod
     def get_all_instances(cls):
@@ -432,39 +576,188 @@ class Cluster(models.Model):
                 raise
 
     def refresh_instances(self, seconds=180):
-        instances = parseQuery(
-            self._client.Query(
-                'instance',
-                [
-                    'name',
-                    'tags',
-                    'pnode',
-                    'snodes',
-                    'disk.sizes',
-                    'nic.modes',
-                    'nic.ips',
-                    'nic.links',
-                    'status',
-                    'admin_state',
-                    'beparams',
-                    'oper_state',
-                    'hvparams',
-                    'nic.macs',
-                    'ctime',
-                    'mtime'
-                ]))
-        cache.set(self._cluster_cache_key(),
-                  instances, seconds)
+        # rows are decoded while the response is being received, so
+        # that the raw response is never held in memory as a whole
+        instances = list(
+            parseQueryStream(
+                self._client.StreamQuery('instance', INSTANCE_QUERY_FIELDS),
+                INSTANCE_QUERY_FIELDS
+            )
+        )
+        return self._set_instances(instances, seconds)
+
+    def _store_instances(self, response, seconds=180):
+        return self._set_instances(parseQuery(response), seconds)
+
+    def _set_instances(self, instances, seconds):
+        version = set_snapshot(self._cluster_cache_key(), instances, seconds)
+        self._index_instances(instances, version)
+        self._roll_up_instances(instances, version)
+        return instances
+
+    def _index_instances(self, instances, version):
+        '''
+        Builds and stores the owner index of a snapshot, which maps every
+        username and group name found in instance tags to the (position,
+        name) of their instances in the snapshot.
+        '''
+        user_pfx = "%s:user:" % GANETI_TAG_PREFIX
+        group_pfx = "%s:group:" % GANETI_TAG_PREFIX
+        users = {}
+        groups = {}
+        for position, info in enumerate(instances):
+            entry = (position, info['name'])
+            for tag in info.get('tags') or ():
+                if tag.startswith(user_pfx):
+                    users.setdefault(tag[len(user_pfx):], []).append(entry)
+                elif tag.startswith(group_pfx):
+                    groups.setdefault(tag[len(group_pfx):], []).append(entry)
+        index = {'version': version, 'users': users, 'groups': groups}
+        hot_cache.set(self._instance_index_key(), index, INDEX_TIMEOUT)
+        return index
+
+    def _get_instance_index(self, instances, version):
+        index = hot_cache.get(self._instance_index_key())
+        if index is None or index['version'] != version:
+            index = self._index_instances(instances, version)
+        return index
+
+    def drop_instances(self):
+        '''
+        Drops the cached instances of the cluster along with their index
+        and rollup, so that they are fetched again when next needed.
+        '''
+        hot_cache.delete_many([
+            self._cluster_cache_key(),
+            self._instance_index_key(),
+            self._rollup_key(),
+        ])
+
+    def _roll_up_instances(self, instances, version):
+        rollup = rollups.build_rollup(instances, version)
+        hot_cache.set(self._rollup_key(), rollup, INDEX_TIMEOUT)
+        return rollup
+
+    def get_rollup(self):
+        '''
+        Returns the rollup of the instances of the snapshot (see
+        ganeti.rollups), built when the snapshot is stored.
+        '''
+        instances, version = get_versioned_snapshot(
+            self._cluster_cache_key(), self.refresh_instances
+        )
+        rollup = hot_cache.get(self._rollup_key())
+        if rollup is None or rollup['version'] != version:
+            rollup = self._roll_up_instances(instances, version)
+        return rollup
+
+    def get_user_rollup(self, user):
+        '''
+        Returns the totals and the creation counts per bucket (see
+        ganeti.rollups) of the instances the user can see, along with the
+        totals of every user for those who can see every instance (None for
+        the rest).
+        '''
+        permissions = for_user(user)
+        if permissions.admin:
+            rollup = self.get_rollup()
+            return rollup['total'], rollup['created'], rollup['users']
+        owned, version = self._owned_instances(permissions)
+        totals, created = rollups.summarize(owned)
+        return totals, created, None
+
+    def get_instance_order(self, field, sort_key):
+        '''
+        Returns the (sort_key(instance), name) tuples of every instance in
+        the snapshot, sorted. They are computed once per snapshot version
+        and field.
+        '''
+        instances, version = get_versioned_snapshot(
+            self._cluster_cache_key(), self.refresh_instances
+        )
+        order = hot_cache.get(self._instance_order_key(field))
+        if order is None or order['version'] != version:
+            cached_extra_info = preload_instance_data()
+            order = {
+                'version': version,
+                'entries': sorted(
+                    (
+                        sort_key(Instance(
+                            self, info['name'], info, cached_extra_info
+                        )),
+                        info['name']
+                    ) for info in instances
+                ),
+            }
+            hot_cache.set(
+                self._instance_order_key(field), order, INDEX_TIMEOUT
+            )
+        return order['entries']
+
+    def refresh_instance_rows(self, names):
+        '''
+        Re-queries the given instances only and patches them into the cached
+        cluster snapshot, instead of throwing the whole snapshot away.
+        Instances that no longer exist are removed from it.
+        '''
+        qfilter = ['|'] + [['=', 'name', name] for name in names]
+        rows = dict(
+            (row['name'], row) for row in parseQueryStream(
+                self._client.StreamQuery(
+                    'instance', INSTANCE_QUERY_FIELDS, qfilter=qfilter
+                ),
+                INSTANCE_QUERY_FIELDS
+            )
+        )
+
+        # the rows of the snapshot that were replaced or dropped
+        removed = []
+
+        def patch(instances):
+            # may be applied more than once, rows is left as it is
+            added = dict(rows)
+            patched = []
+            del removed[:]
+            for info in instances:
+                if info['name'] in added:
+                    removed.append(info)
+                    patched.append(added.pop(info['name']))
+                elif info['name'] in names:
+                    removed.append(info)
+                else:
+                    patched.append(info)
+            # new instances, e.g. created or renamed ones
+            patched.extend(added.values())
+            return patched
+
+        instances, version, previous = update_snapshot(
+            self._cluster_cache_key(), patch
+        )
+        if instances is not None:
+            self._index_instances(instances, version)
+            rollup = hot_cache.get(self._rollup_key())
+            if rollup is not None and rollup['version'] == previous:
+                hot_cache.set(
+                    self._rollup_key(),
+                    rollups.apply_changes(
+                        rollup, removed, list(rows.values()), version
+                    ),
+                    INDEX_TIMEOUT
+                )
+            else:
+                self._roll_up_instances(instances, version)
         return instances
 
     def get_client_struct_instances(self):
-        return (cache.get(self._cluster_cache_key())
-                or self.refresh_instances())
+        return get_snapshot(self._cluster_cache_key(), self.refresh_instances)
 
     def get_instances(self):
+        instances, version = get_versioned_snapshot(
+            self._cluster_cache_key(), self.refresh_instances
+        )
         cached_extra_info = preload_instance_data()
-        return [Instance(self, info['name'], info, cached_extra_info)
-                for info in self.get_client_struct_instances()]
+        return [Instance(self, info['name'], info, cached_extra_info, version)
+                for info in instances]
 
     def force_cluster_cache_refresh(self, instance):
         '''Used in cases of actions that could potentially lock the cluster
@@ -475,39 +768,62 @@ class Cluster(models.Model):
         for i in instances:
             if i['name'] == instance:
                 i['action_lock'] = True
-        cache.set("cluster:{0}:instances".format(self.hostname), instances, 45)
+        self._set_instances(instances, 45)
 
     def get_user_instances(self, user, admin=True):
-        instances = self.get_instances()
-        if (user.is_superuser or user.has_perm('ganeti.view_instances')) and admin:
-            return instances
-        else:
-            user = User.objects.get(pk=user.pk)
-            ugroups = []
-            for ug in user.groups.all():
-                ugroups.append(ug.pk)
-            return [
-                i for i in instances if (
-                    user in i.users or
-                    len(
-                        list(set(ugroups).intersection(
-                            set([g.id for g in i.groups]))
-                        )
-                    ) > 0
-                )
-            ]
+        # user may also be a PermissionContext
+        permissions = for_user(user)
+        if permissions.admin and admin:
+            return self.get_instances()
+        owned, version = self._owned_instances(permissions)
+        cached_extra_info = preload_instance_data()
+        return [Instance(self, info['name'], info, cached_extra_info, version)
+                for info in owned]
 
-    def get_cluster_info(self):
-        info = cache.get("cluster:{0}:info".format(self.hostname))
+    def _owned_instances(self, permissions):
+        '''
+        Returns the info of the instances of the snapshot owned by the user
+        or the user's groups, along with the version of the snapshot.
+        '''
+        instances, version = get_versioned_snapshot(
+            self._cluster_cache_key(), self.refresh_instances
+        )
+        groups = permissions.group_names
+
+        def owned_instances(index):
+            entries = set(index['users'].get(permissions.username, ()))
+            for group in groups:
+                entries.update(index['groups'].get(group, ()))
+            owned = []
+            for position, name in sorted(entries):
+                if (
+                    position >= len(instances) or
+                    instances[position]['name'] != name
+                ):
+                    return None
+                owned.append(instances[position])
+            return owned
+
+        owned = owned_instances(self._get_instance_index(instances, version))
+        if owned is None:
+            # the index was built for another snapshot, which only happens
+            # if a refresh raced with building it
+            owned = owned_instances(self._index_instances(instances, version))
+        return owned, version
 
-        if info is None:
-            info = self._client.GetInfo()
-            if 'ctime' in info and info['ctime']:
-                info['ctime'] = datetime.fromtimestamp(info['ctime'])
-            if 'mtime' in info and info['mtime']:
-                info['mtime'] = datetime.fromtimestamp(info['mtime'])
-            cache.set("cluster:{0}:info".format(self.hostname), info, 180)
+    def get_cluster_info(self):
+        return get_snapshot(
+            "cluster:{0}:info".format(self.hostname),
+            self.refresh_cluster_info
+        )
 
+    def refresh_cluster_info(self, seconds=180):
+        info = self._client.GetInfo()
+        if 'ctime' in info and info['ctime']:
+            info['ctime'] = datetime.fromtimestamp(info['ctime'])
+        if 'mtime' in info and info['mtime']:
+            info['mtime'] = datetime.fromtimestamp(info['mtime'])
+        set_snapshot("cluster:{0}:info".format(self.hostname), info, seconds)
         return info
 
     def get_extstorage_disk_params(self, provider):
@@ -570,6 +886,16 @@ class Cluster(models.Model):
         return nodes
 
     def refresh_nodes(self, seconds=180):
+        return self._store_nodes(self._query_nodes(), seconds)[0]
+
+    def _query_nodes(self):
+        return self._client.Query('node', NODE_QUERY_FIELDS)
+
+    def _store_nodes(self, response, seconds=180):
+        '''
+        Stores the nodes of a node query response along with their
+        projection, and returns (nodes, projection).
+        '''
         def update_info_used(node_info, iused, itotal, ifree):
             try:
                 node_info[iused] = 100 * (
@@ -594,85 +920,140 @@ class Cluster(models.Model):
             node_info['shared_storage'] = False
 
         cachenodes = []
-        nodes = parseQuery(
-            self._client.Query(
-                'node',
-                [
-                    'name',
-                    'role',
-                    'mfree',
-                    'mtotal',
-                    'dtotal',
-                    'dfree',
-                    'ctotal',
-                    'group',
-                    'pinst_cnt',
-                    'offline',
-                    'vm_capable',
-                    'pinst_list'
-                ]))
+        nodes = parseQuery(response)
 
         for info in nodes:
             update_node_info(info)
             cachenodes.append(info)
         nodes = cachenodes
-        cache.set("cluster:{0}:nodes".format(self.hostname), nodes, seconds)
-        return nodes
+        projection = self._project_nodes(nodes)
+        set_snapshot(self._node_projection_key(), projection, seconds)
+        set_snapshot("cluster:{0}:nodes".format(self.hostname), nodes, seconds)
+        return nodes, projection
+
+    def _project_nodes(self, nodes):
+        '''
+        Returns the nodes as listed by the node API, along with the names of
+        the offline ones.
+        '''
+        return {
+            'nodes': [
+                dict((field, node[field]) for field in NODE_API_FIELDS)
+                for node in nodes
+            ],
+            'offline': [node['name'] for node in nodes if node['offline']],
+            'capacity': capacity_rows(nodes),
+        }
+
+    def get_node_projection(self):
+        '''
+        Returns the projection of the nodes stored along with them, a dict
+        with the nodes as listed by the node API and the offline node names.
+        '''
+        return get_snapshot(
+            self._node_projection_key(), self._refresh_node_projection
+        )
+
+    def _refresh_node_projection(self, seconds=180):
+        return self._store_nodes(self._query_nodes(), seconds)[1]
 
     def get_cluster_nodes(self):
-        nodes = cache.get("cluster:{0}:nodes".format(self.hostname))
-        if nodes is None:
-            nodes = self.refresh_nodes()
-        return nodes
+        return get_snapshot(
+            "cluster:{0}:nodes".format(self.hostname), self.refresh_nodes
+        )
 
-    def get_available_nodes(self, node_group, number_of_nodes):
-        ret_nodes = []
-        nodes = self.get_cluster_nodes()
-        for n in nodes:
-            if n['role'] in ['D', 'O']:
-                continue
-            if n['group'] != node_group:
-                continue
-            if n['vm_capable'] is False:
-                continue
-            ret_nodes.append(n['name'])
-        return ret_nodes[0:number_of_nodes]
+    def get_capacity(self, refresh=True):
+        '''
+        Returns the capacity rows of the nodes which can take new instances
+        (see ganeti.capacity). Without refresh, returns None unless the
+        nodes are already cached.
+        '''
+        if refresh:
+            projection = self.get_node_projection()
+        else:
+            projection = read_snapshot(self._node_projection_key())
+            if projection is None:
+                return None
+        if 'capacity' not in projection:
+            # stored before capacity rows were kept
+            return capacity_rows(self.get_cluster_nodes())
+        return projection['capacity']
+
+    def get_available_nodes(self, node_group, number_of_nodes, memory=0,
+                            disk=0):
+        '''
+        Returns the names of number_of_nodes nodes of node_group to place an
+        instance with memory and disk MiB on, the ones with the most
+        headroom left first.
+        '''
+        return rank_nodes(
+            self.get_capacity(), memory, disk, node_group
+        )[0:number_of_nodes]
 
     def get_node_groups(self):
-        info = cache.get('cluster:{0}:nodegroups'.format(self.hostname))
-        if info is None:
-            #info = parseQuery(self._client.Query('group',['name', 'tags']))
-            info = self._client.GetGroups(bulk=True)
-            cache.set('cluster:{0}:nodegroups'.format(self.hostname),
-                      info, 180)
+        #info = parseQuery(self._client.Query('group',['name', 'tags']))
+        return get_snapshot(
+            'cluster:{0}:nodegroups'.format(self.hostname),
+            self.refresh_node_groups
+        )
+
+    def refresh_node_groups(self, seconds=180):
+        return self._store_node_groups(
+            self._client.GetGroups(bulk=True), seconds
+        )
+
+    def _store_node_groups(self, info, seconds=180):
+        set_snapshot(
+            'cluster:{0}:nodegroups'.format(self.hostname), info, seconds
+        )
         return info
 
     def get_networks(self):
-        info = cache.get('cluster:{0}:networks'.format(self.hostname))
-        if info is None:
-            info = self._client.GetNetworks(bulk=True)
-            cache.set('cluster:{0}:networks'.format(self.hostname), info, 180)
-        return info
+        return get_snapshot(
+            'cluster:{0}:networks'.format(self.hostname),
+            self.refresh_networks
+        )
 
-    def get_node_group_networks(self, nodegroup):
+    def refresh_networks(self, seconds=180):
+        networks = self._client.GetNetworks(bulk=True)
+        set_snapshot(
+            'cluster:{0}:networks'.format(self.hostname), networks, seconds
+        )
+        return networks
+
+    def get_network_link_index(self):
+        '''
+        Returns the Network rows of the cluster, loaded with a single query,
+        as a dict with the links of the default networks ('default_links')
+        and the bridged networks ('bridged').
+        '''
+        index = {'default_links': set(), 'bridged': []}
+        for network in self.network_set.all():
+            if network.cluster_default:
+                index['default_links'].add(network.link)
+            if network.mode == 'bridged':
+                index['bridged'].append(network)
+        return index
+
+    def get_node_group_networks(self, nodegroup, networks=None,
+                                link_index=None):
         # This gets networks per nodegroup as received via a GetNetworks RAPI
         # callWe then perform a check for the existing networks in database
         # and add the bridged networks
         nodegroupsnets = []
-        networks = self.get_networks()
-        brnets = self.network_set.filter(mode="bridged")
+        if networks is None:
+            networks = self.get_networks()
+        if link_index is None:
+            link_index = self.get_network_link_index()
+        default_links = link_index['default_links']
         for net in networks:
             for group in net['group_list']:
                 group_dict = {}
                 if group[0] == nodegroup:
                     nd = net['name']
-                    group_dict['defaultnet'] = False
                     # TODO: For the time get the default network from the
                     # database. Later on we can get it from the cluster.
-                    if self.network_set.filter(
-                        cluster_default=True, link=group[2]
-                    ):
-                        group_dict['defaultnet'] = True
+                    group_dict['defaultnet'] = group[2] in default_links
                     group_dict['network'] = nd
                     group_dict['link'] = group[2]
                     group_dict['type'] = group[1]
@@ -682,31 +1063,60 @@ class Cluster(models.Model):
                         group_dict['free_count'] = net['free_count']
                         group_dict['reserved_count'] = net['reserved_count']
                     nodegroupsnets.append(group_dict)
-        for brnet in brnets:
+        for brnet in link_index['bridged']:
             brnet_dict = {}
             brnet_dict['network'] = brnet.description
             brnet_dict['link'] = brnet.link
             brnet_dict['type'] = brnet.mode
             brnet_dict['free_count'] = None
             brnet_dict['reserved_count'] = None
-            brnet_dict['defaultnet'] = False
             # TODO: For the time get the default network from the database.
             # Later on we can get it from the cluster.
-            if self.network_set.filter(cluster_default=True, link=brnet.link):
-                brnet_dict['defaultnet'] = True
+            brnet_dict['defaultnet'] = brnet.link in default_links
             nodegroupsnets.append(brnet_dict)
         nodegroupsnets = sorted(nodegroupsnets, key=lambda k: k['network'])
         return nodegroupsnets
 
     def get_node_group_stack(self):
-        groups = self.get_node_groups()
+        return self.get_versioned_node_group_stack()[0]
+
+    def get_versioned_node_group_stack(self):
+        '''
+        Returns the node group stack along with the versions of the node
+        group and network snapshots it is built from. It is only built again
+        when either of them changes, or when a Network is saved.
+        '''
+        groups, groups_version = get_versioned_snapshot(
+            'cluster:{0}:nodegroups'.format(self.hostname),
+            self.refresh_node_groups
+        )
+        networks, networks_version = get_versioned_snapshot(
+            'cluster:{0}:networks'.format(self.hostname),
+            self.refresh_networks
+        )
+        version = [groups_version, networks_version]
+        stack = hot_cache.get(self._node_group_stack_key())
+        if stack is None or stack['version'] != version:
+            stack = {
+                'version': version,
+                'value': self._build_node_group_stack(groups, networks),
+            }
+            hot_cache.set(
+                self._node_group_stack_key(), stack, NODE_GROUP_STACK_TIMEOUT
+            )
+        return stack['value'], version
+
+    def _build_node_group_stack(self, groups, networks):
+        # shared by every node group, instead of querying the database for
+        # every network of every group
+        link_index = self.get_network_link_index()
         group_stack = []
         for group in groups:
             group_dict = {}
             group_dict['name'] = group['name']
             group_dict['alloc_policy'] = group['alloc_policy']
             group_dict['networks'] = self.get_node_group_networks(
-                group['name']
+                group['name'], networks, link_index
             )
             group_dict['nodes'] = group['node_list']
             group_dict['vgs'] = []
@@ -721,7 +1131,9 @@ class Cluster(models.Model):
         return self._client.GetInstances()
 
     def get_job_list(self):
-        info = self._client.GetJobs(bulk=True)
+        return self._format_job_list(self._client.GetJobs(bulk=True))
+
+    def _format_job_list(self, info):
         for i in info:
             i['cluster'] = self.slug
             if i.get('start_ts'):
@@ -979,7 +1391,8 @@ class Cluster(models.Model):
             ip_check=False,
             name_check=False
         )
-        self._lock_instance(instance, reason="renaming", job_id=job_id)
+        self._lock_instance(instance, reason="renaming", job_id=job_id,
+                            refresh_names=[instance, newname])
         return job_id
 
     def startup_instance(self, instance):
@@ -1010,14 +1423,14 @@ class Cluster(models.Model):
         except Exception as e:
             return e
         else:
-            self._lock_instance(instance, reason="tagging", job_id=job_id, flush_keys=[self._cluster_cache_key()])
+            self._lock_instance(instance, reason="tagging", job_id=job_id)
             return job_id
 
     def untag_instance(self, instance, tags):
         cache_key = self._instance_cache_key(instance)
         cache.delete(cache_key)
         job_id = self._client.DeleteInstanceTags(instance, tags)
-        self._lock_instance(instance, reason="untagging", job_id=job_id, flush_keys=[self._cluster_cache_key()])
+        self._lock_instance(instance, reason="untagging", job_id=job_id)
         return job_id
 
     def migrate_instance(self, instance):
@@ -1080,6 +1493,50 @@ class Cluster(models.Model):
     def get_job_status(self, job_id):
         return self._client.GetJobStatus(job_id)
 
+    def get_job_statuses(self, job_ids, fields):
+        '''Returns the given fields (which must include 'id') of several
+        jobs with a single RAPI call, as a dict keyed by job id. Clusters
+        that cannot query jobs list all of them instead, and jobs missing
+        from the listing (e.g. archived ones) are fetched one by one.
+        '''
+        wanted = set(job_ids)
+        statuses = {}
+        if self._query_jobs:
+            qfilter = ['|'] + [['=', 'id', job_id] for job_id in job_ids]
+            try:
+                for row in parseQuery(self._client.Query('job', fields,
+                                                         qfilter)):
+                    if row['id'] in wanted:
+                        statuses[row['id']] = row
+                return statuses
+            except GanetiApiError as err:
+                if err.code not in (400, 404, 501):
+                    raise
+                self._query_jobs = False
+        for job in self._client.GetJobs(bulk=True):
+            if job['id'] in wanted:
+                statuses[job['id']] = dict(
+                    (field, job.get(field)) for field in fields
+                )
+        for job_id in wanted.difference(statuses):
+            try:
+                job = self._client.GetJobStatus(job_id)
+            except GanetiApiError:
+                continue
+            statuses[job_id] = dict(
+                (field, job.get(field)) for field in fields
+            )
+        return statuses
+
+    def wait_for_job_change(self, job_id, fields, prev_job_info=None,
+                            prev_log_serial=None):
+        '''Long-polls the job until any of fields or its log changes,
+        returns None if nothing changed before RAPI gave up waiting
+        '''
+        return self._client.WaitForJobChange(
+            job_id, fields, prev_job_info, prev_log_serial
+        )
+
     def get_default_network(self):
         try:
             return self.network_set.get(cluster_default=True)
@@ -1115,6 +1572,121 @@ class Network(models.Model):
         super(Network, self).save()
 
 
+@receiver(post_save, sender=Network)
+@receiver(post_delete, sender=Network)
+def invalidate_node_group_stack(sender, instance, **kwargs):
+    # the default and bridged networks of node groups come from the database
+    hot_cache.delete(instance.cluster._node_group_stack_key())
+
+
+# cURL handle pools shared by every Cluster object of this process (web
+# worker or watcher), keyed by RAPI endpoint and credentials so that a
+# credentials change never reuses a stale handle.
+_rapi_pools = {}
+
+
+def get_rapi_pool(hostname, username=None, password=None):
+    key = (hostname, username, password)
+    pool = _rapi_pools.get(key)
+    if pool is None:
+        pool = _rapi_pools.setdefault(
+            key,
+            CurlPool(maxsize=RAPI_POOL_SIZE, max_idle=RAPI_POOL_MAX_IDLE)
+        )
+    return pool
+
+
+def reset_rapi_pools():
+    '''
+    Forgets the RAPI handle pools, e.g. in a forked process, whose handles
+    and connections belong to its parent.
+    '''
+    _rapi_pools.clear()
+
+
+def rapi_pool_stats():
+    '''Returns the hit/miss counters of the RAPI handle pools per cluster'''
+    stats = {}
+    for (hostname, username, password), pool in list(_rapi_pools.items()):
+        stats[hostname] = pool.Stats()
+    return stats
+
+
+def execute_many(requests, timeout=None):
+    '''
+    Sends RAPI requests to several clusters concurrently, over one
+    multiplexed connection loop instead of a greenlet per cluster.
+
+    requests is a list of (cluster, method, path, query) or
+    (cluster, method, path, query, content) tuples. Returns, in order, the
+    decoded response or the GanetiApiError of each request.
+    '''
+    return ExecuteMany(
+        [(request[0]._client,) + tuple(request[1:]) for request in requests],
+        timeout=timeout
+    )
+
+
+def cluster_query(cluster, what, fields):
+    '''Returns the request of a RAPI query of the cluster for execute_many'''
+    return (cluster,) + cluster._client.PrepareQuery(what, fields)[1:]
+
+
+def prefetch_cluster_data(clusters, node_groups=False, timeout=None,
+                          nodes=False, instances=True):
+    '''
+    Fills the instance (and, if asked, node group and node) caches of the
+    clusters whose cache is cold with a single batch of RAPI requests, so
+    that the per-cluster getters called afterwards are served from the cache.
+    Returns a {cluster pk: GanetiApiError} dict of the clusters that failed.
+    '''
+    requests = []
+    stores = []
+    for cluster in clusters:
+        if instances and read_snapshot(cluster._cluster_cache_key()) is None:
+            requests.append(cluster_query(
+                cluster, 'instance', INSTANCE_QUERY_FIELDS
+            ))
+            stores.append((cluster, cluster._store_instances))
+        if node_groups and read_snapshot(
+            'cluster:{0}:nodegroups'.format(cluster.hostname)
+        ) is None:
+            requests.append(
+                (cluster, 'GET', '/2/groups', [('bulk', 1)])
+            )
+            stores.append((cluster, cluster._store_node_groups))
+        if nodes and read_snapshot(cluster._node_projection_key()) is None:
+            requests.append(cluster_query(cluster, 'node', NODE_QUERY_FIELDS))
+            stores.append((cluster, cluster._store_nodes))
+
+    errors = {}
+    results = execute_many(requests, timeout=timeout)
+    for (cluster, store), result in zip(stores, results):
+        if isinstance(result, GanetiApiError):
+            errors[cluster.pk] = result
+        else:
+            store(result)
+    return errors
+
+
+def get_job_lists(clusters, timeout=None):
+    '''
+    Fetches the job list of several clusters concurrently.
+    Returns a list of (cluster, jobs) tuples, where jobs is the
+    GanetiApiError raised by the cluster if it failed.
+    '''
+    clusters = list(clusters)
+    results = execute_many(
+        [(c, 'GET', '/2/jobs', [('bulk', 1)]) for c in clusters],
+        timeout=timeout
+    )
+    return [
+        (cluster, result if isinstance(result, GanetiApiError)
+         else cluster._format_job_list(result))
+        for cluster, result in zip(clusters, results)
+    ]
+
+
 def preload_instance_data():
     networks = cache.get('networklist')
     if not networks:
@@ -1124,39 +1696,11 @@ def preload_instance_data():
             networkdict[network.link] = network.ipv6_prefix
         networks = networkdict
         cache.set('networklist', networks, 60)
-    users = cache.get('userlist')
-    if not users:
-        users = User.objects.prefetch_related('groups').all()
-        userdict = {}
-        for user in users:
-            userdict[user.username] = user
-        users = userdict
-        cache.set('userlist', users, 60)
-    orgs = cache.get('orgslist')
-    if not orgs:
-        orgs = Organization.objects.all()
-        orgsdict = {}
-        for org in orgs:
-            orgsdict[org.tag] = org
-        orgs = orgsdict
-        cache.set('orgslist', orgs, 60)
-    groups = cache.get('groupslist')
-    if not groups:
-        groups = Group.objects.all()
-        groupsdict = {}
-        for group in groups:
-            group.userset = group.user_set.all()
-            groupsdict[group.name] = group
-        groups = groupsdict
-        cache.set('groupslist', groups, 60)
-    instanceapps = cache.get('instaceapplist')
-    if not instanceapps:
-        instanceapps = InstanceApplication.objects.all()
-        instappdict = {}
-        for instapp in instanceapps:
-            instappdict[str(instapp.pk)] = instapp
-        instanceapps = instappdict
-        cache.set('instaceapplist', instanceapps, 60)
+    # users, groups, organizations and applications are looked up per tag
+    users = lookups.users
+    orgs = lookups.organizations
+    groups = lookups.groups
+    instanceapps = lookups.applications
     return {"users": users, "orgs": orgs, "groups": groups,
             "instanceapps": instanceapps, "networks": networks}
 
@@ -1282,6 +1826,17 @@ def parseQuery(response):
     return reslist
 
 
+def parseQueryStream(rows, fields):
+    '''
+    Generator counterpart of parseQuery for the rows yielded by
+    GanetiRapiClient.StreamQuery, which are in the order of fields.
+    '''
+    for row in rows:
+        yield dict(
+            (field, result[1]) for field, result in zip(fields, row)
+        )
+
+
 def parseQuerysimple(response):
     data = response['data']
     reslist = []
@@ -0,0 +1,91 @@
+'''
+Permissions of the user of a request, worked out once per request.
+
+middleware.Permissions.PermissionContextMiddleware sets request.permissions
+to a PermissionContext of request.user, which listings, decorators and
+views use instead of asking the user model again for every instance. Every
+check is done the first time it is needed and remembered for the rest of
+the request.
+'''
+
+
+class PermissionContext(object):
+    def __init__(self, user):
+        self.user = user
+        self._perms = {}
+        self._groups = None
+
+    @property
+    def username(self):
+        return self.user.username
+
+    @property
+    def pk(self):
+        return self.user.pk
+
+    @property
+    def is_superuser(self):
+        return self.user.is_superuser
+
+    def has_perm(self, perm):
+        if perm not in self._perms:
+            self._perms[perm] = self.user.has_perm(perm)
+        return self._perms[perm]
+
+    @property
+    def view_instances(self):
+        return self.has_perm('ganeti.view_instances')
+
+    @property
+    def admin(self):
+        '''Whether the user sees every instance'''
+        return self.is_superuser or self.view_instances
+
+    def _load_groups(self):
+        if self._groups is None:
+            if self.user.is_anonymous:
+                self._groups = {}
+            else:
+                self._groups = dict(
+                    self.user.groups.values_list('pk', 'name')
+                )
+        return self._groups
+
+    @property
+    def group_ids(self):
+        return frozenset(self._load_groups())
+
+    @property
+    def group_names(self):
+        return list(self._load_groups().values())
+
+    def owns(self, instance):
+        '''
+        Whether the instance belongs to the user or to one of the user's
+        groups.
+        '''
+        if any(user.pk == self.pk for user in instance.users):
+            return True
+        groups = self._load_groups()
+        return any(group.pk in groups for group in instance.groups)
+
+
+def for_user(user):
+    '''
+    Returns user if it already is a PermissionContext, a new one for it
+    otherwise.
+    '''
+    if isinstance(user, PermissionContext):
+        return user
+    return PermissionContext(user)
+
+
+def get_permissions(request):
+    '''
+    Returns the PermissionContext of the request, set by the middleware, or
+    a new one if the middleware is not enabled.
+    '''
+    permissions = getattr(request, 'permissions', None)
+    if permissions is None:
+        permissions = request.permissions = PermissionContext(request.user)
+    return permissions
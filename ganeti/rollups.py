@@ -0,0 +1,164 @@
+'''
+Aggregate statistics of the instances of a cluster snapshot.
+
+Every time the instances of a cluster are stored, they are rolled up into
+the totals the statistics pages show: the number of instances, how many of
+them are up or down and their disk, vcpus and memory, for the whole cluster
+and for every user, group and organization found in instance tags, along
+with the number of instances created in every CREATED_BUCKET. The rollup
+holds these counters only, never the instances themselves, and instances
+patched into the snapshot are applied to it as deltas (see apply_changes).
+The statistics views add up the rollups of the clusters instead of walking
+their instances on every request.
+
+Users that cannot see every instance get the totals of their own instances
+(see summarize).
+'''
+from django.conf import settings
+
+
+GANETI_TAG_PREFIX = settings.GANETI_TAG_PREFIX
+
+# creation times are counted per day, in milliseconds, as charted
+CREATED_BUCKET = 24 * 3600 * 1000
+
+# the fields of the resources of an instance
+UP, DISK, VCPUS, MEMORY, CREATED = range(5)
+
+_OWNER_PREFIXES = (
+    ('users', '%s:user:' % GANETI_TAG_PREFIX),
+    ('groups', '%s:group:' % GANETI_TAG_PREFIX),
+    ('organizations', '%s:org:' % GANETI_TAG_PREFIX),
+)
+
+
+def new_totals():
+    return {
+        'instances': 0, 'up': 0, 'down': 0, 'disk': 0, 'vcpus': 0,
+        'memory': 0
+    }
+
+
+def add_totals(totals, other):
+    '''Adds the totals of other to totals'''
+    for key, value in other.items():
+        totals[key] += value
+    return totals
+
+
+def _add(totals, resources, sign=1):
+    totals['instances'] += sign
+    if resources[UP]:
+        totals['up'] += sign
+    else:
+        totals['down'] += sign
+    totals['disk'] += sign * resources[DISK]
+    totals['vcpus'] += sign * resources[VCPUS]
+    totals['memory'] += sign * resources[MEMORY]
+
+
+def _resources(info):
+    beparams = info.get('beparams') or {}
+    ctime = info.get('ctime')
+    return (
+        info.get('admin_state') == 'up',
+        sum(info.get('disk.sizes') or ()),
+        beparams.get('vcpus') or 0,
+        beparams.get('maxmem') or 0,
+        # the start of the bucket of the creation time
+        CREATED_BUCKET * (1000 * int(ctime) // CREATED_BUCKET)
+        if ctime else None,
+    )
+
+
+def _count(counters, key, sign):
+    counters[key] = counters.get(key, 0) + sign
+    if not counters[key]:
+        del counters[key]
+
+
+def _apply(rollup, info, sign):
+    # adds (sign 1) or removes (sign -1) an instance to or from the rollup
+    resources = _resources(info)
+    _add(rollup['total'], resources, sign)
+    for tag in info.get('tags') or ():
+        for owners, prefix in _OWNER_PREFIXES:
+            if tag.startswith(prefix):
+                totals = rollup[owners].setdefault(
+                    tag[len(prefix):], new_totals()
+                )
+                _add(totals, resources, sign)
+                if not totals['instances']:
+                    del rollup[owners][tag[len(prefix):]]
+                break
+    if resources[CREATED] is not None:
+        _count(rollup['created'], resources[CREATED], sign)
+
+
+def build_rollup(instances, version):
+    '''
+    Returns the rollup of instances, the instances of the snapshot with the
+    given version.
+    '''
+    rollup = {
+        'version': version,
+        'total': new_totals(),
+        'users': {},
+        'groups': {},
+        'organizations': {},
+        # bucket -> number of instances created in it
+        'created': {},
+    }
+    for info in instances:
+        _apply(rollup, info, 1)
+    return rollup
+
+
+def apply_changes(rollup, removed, added, version):
+    '''
+    Returns a copy of rollup with the removed instances taken out and the
+    added ones put in, as the rollup of the snapshot with the given version.
+    An instance that changed is both removed (as it was) and added.
+    '''
+    rollup = {
+        'version': version,
+        'total': dict(rollup['total']),
+        'users': dict(
+            (name, dict(totals)) for name, totals in rollup['users'].items()
+        ),
+        'groups': dict(
+            (name, dict(totals)) for name, totals in rollup['groups'].items()
+        ),
+        'organizations': dict(
+            (name, dict(totals))
+            for name, totals in rollup['organizations'].items()
+        ),
+        'created': dict(rollup['created']),
+    }
+    for info in removed:
+        _apply(rollup, info, -1)
+    for info in added:
+        _apply(rollup, info, 1)
+    return rollup
+
+
+def summarize(instances):
+    '''
+    Returns the totals and the creation counts per bucket of instances, for
+    users that can only see some of the instances of the rollup.
+    '''
+    rollup = build_rollup(instances, None)
+    return rollup['total'], rollup['created']
+
+
+def creation_series(created):
+    '''
+    Returns the (bucket, instances created in it, instances created so far)
+    of the creation counts per bucket, oldest first.
+    '''
+    series = []
+    so_far = 0
+    for bucket, count in sorted(created.items()):
+        so_far += count
+        series.append((bucket, count, so_far))
+    return series
@@ -0,0 +1,227 @@
+'''
+Stale-while-revalidate storage for the cluster data cached from RAPI.
+
+Every value is stored in an envelope with a soft expiry time and a version
+number. The cache timeout of the envelope (the hard expiry) is set
+CLUSTER_CACHE_STALE_TIMEOUT seconds after the soft expiry. Between the two,
+readers get the stale value while exactly one greenlet, across all processes
+sharing the cache, refreshes it in the background. When there is no value at all,
+one caller refreshes it and the others wait for its result, instead of every
+request hitting RAPI at once.
+'''
+import logging
+import time
+
+import gevent
+from django.conf import settings
+from django.core.cache import cache
+
+from ganeti.localcache import hot_cache
+from util.client import GanetiApiError
+
+
+logger = logging.getLogger(__name__)
+
+STALE_TIMEOUT = getattr(settings, 'CLUSTER_CACHE_STALE_TIMEOUT', 600)
+# how long a refresh may take before another caller is allowed to start one
+REFRESH_LOCK_TIMEOUT = 60
+# how long callers are answered with the error of a failed refresh, instead
+# of retrying it themselves
+REFRESH_ERROR_TIMEOUT = 5
+REFRESH_POLL_INTERVAL = 0.1
+# how many times an update is applied to values replaced while updating
+UPDATE_RETRIES = 3
+
+
+def _lock_key(key):
+    return '%s:refreshing' % key
+
+
+def _error_key(key):
+    return '%s:error' % key
+
+
+def _version_key(key):
+    return '%s:version' % key
+
+
+def _get_envelope(key, shared=False):
+    # read-modify-write cycles must start from the shared copy
+    envelope = (cache if shared else hot_cache).get(key)
+    if isinstance(envelope, dict) and 'expires' in envelope:
+        return envelope
+    # either missing or written in another format, treat it as missing
+    return None
+
+
+def next_version(key):
+    '''
+    Returns a new version number for the value stored under key.
+    Versions only ever grow, even when the value itself expires.
+    '''
+    version_key = _version_key(key)
+    # start from the current time, so that versions keep growing even if the
+    # counter is flushed from the cache
+    cache.add(version_key, int(time.time() * 1000), None)
+    try:
+        return cache.incr(version_key)
+    except ValueError:
+        # evicted in the meantime
+        version = int(time.time() * 1000)
+        cache.set(version_key, version, None)
+        return version
+
+
+def set_snapshot(key, value, seconds, stale_seconds=None):
+    '''
+    Stores value under key, to be refreshed after seconds and served
+    while being refreshed for at most stale_seconds more. Returns the
+    version value was stored with.
+    '''
+    if stale_seconds is None:
+        stale_seconds = STALE_TIMEOUT
+    version = next_version(key)
+    hot_cache.set(
+        key,
+        {
+            'value': value,
+            'expires': time.time() + seconds,
+            'version': version,
+        },
+        seconds + stale_seconds
+    )
+    cache.delete(_error_key(key))
+    return version
+
+
+def update_snapshot(key, update):
+    '''
+    Replaces the value stored under key with update(value), keeping its
+    expiry time. Returns the new value, its version and the version of the
+    value it replaced, (None, None, None) if there is no value.
+
+    Updates hold the refresh lock of key, so that two of them, or an update
+    and a refresh, do not overwrite each other. Should the value still be
+    replaced meanwhile, by a write which does not take the lock, update is
+    applied again to the new value.
+    '''
+    deadline = time.time() + REFRESH_LOCK_TIMEOUT
+    locked = cache.add(_lock_key(key), 1, REFRESH_LOCK_TIMEOUT)
+    while not locked and time.time() < deadline:
+        gevent.sleep(REFRESH_POLL_INTERVAL)
+        locked = cache.add(_lock_key(key), 1, REFRESH_LOCK_TIMEOUT)
+    try:
+        for attempt in range(UPDATE_RETRIES):
+            envelope = _get_envelope(key, shared=True)
+            if envelope is None:
+                return None, None, None
+            value = update(envelope['value'])
+            current = _get_envelope(key, shared=True)
+            if (
+                current is not None and
+                current['version'] != envelope['version']
+            ):
+                continue
+            version = next_version(key)
+            hot_cache.set(
+                key,
+                {
+                    'value': value,
+                    'expires': envelope['expires'],
+                    'version': version,
+                },
+                max(envelope['expires'] - time.time(), 0) + STALE_TIMEOUT
+            )
+            return value, version, envelope['version']
+        logger.warning('Giving up updating %s, it keeps changing' % key)
+        return None, None, None
+    finally:
+        if locked:
+            cache.delete(_lock_key(key))
+
+
+def read_snapshot(key):
+    '''
+    Returns the value stored under key, stale or not, without refreshing it.
+    Returns None if there is no value.
+    '''
+    envelope = _get_envelope(key)
+    if envelope is None:
+        return None
+    return envelope['value']
+
+
+def get_snapshot_version(key):
+    '''
+    Returns the version of the value stored under key, None if there is none.
+    '''
+    envelope = _get_envelope(key)
+    if envelope is None:
+        return None
+    return envelope['version']
+
+
+def _refresh(key, refresh):
+    try:
+        return refresh()
+    except Exception as err:
+        code = getattr(err, 'code', None)
+        cache.set(_error_key(key), (str(err), code), REFRESH_ERROR_TIMEOUT)
+        raise
+    finally:
+        cache.delete(_lock_key(key))
+
+
+def _refresh_in_background(key, refresh):
+    try:
+        _refresh(key, refresh)
+    except Exception as err:
+        logger.warning('Refreshing %s failed: %s' % (key, err))
+
+
+def _raise_refresh_error(key):
+    error = cache.get(_error_key(key))
+    if error is not None:
+        raise GanetiApiError(error[0], code=error[1])
+
+
+def get_snapshot(key, refresh):
+    '''
+    Returns the value stored under key. refresh() is called to store a new
+    value with set_snapshot: in the background if the value has expired
+    softly, or right away if there is no value at all.
+    '''
+    return get_versioned_snapshot(key, refresh)[0]
+
+
+def get_versioned_snapshot(key, refresh):
+    '''
+    Same as get_snapshot, returning a (value, version) tuple.
+    '''
+    envelope = _get_envelope(key)
+    if envelope is not None:
+        if (
+            envelope['expires'] <= time.time() and
+            cache.add(_lock_key(key), 1, REFRESH_LOCK_TIMEOUT)
+        ):
+            gevent.spawn(_refresh_in_background, key, refresh)
+        return envelope['value'], envelope['version']
+
+    _raise_refresh_error(key)
+    deadline = time.time() + REFRESH_LOCK_TIMEOUT
+    while not cache.add(_lock_key(key), 1, REFRESH_LOCK_TIMEOUT):
+        # someone else is refreshing it, wait for the result
+        gevent.sleep(REFRESH_POLL_INTERVAL)
+        envelope = _get_envelope(key)
+        if envelope is not None:
+            return envelope['value'], envelope['version']
+        _raise_refresh_error(key)
+        if time.time() >= deadline:
+            break
+    value = _refresh(key, refresh)
+    # read back what was stored, so that the version is the one of value
+    # even if another write came in meanwhile
+    envelope = _get_envelope(key)
+    if envelope is None:
+        return value, None
+    return envelope['value'], envelope['version']
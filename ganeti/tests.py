@@ -1,7 +1,57 @@
+import json
+import logging
+import os
+import tempfile
+
+import gevent
+import greenstalk
+from gevent.lock import BoundedSemaphore
+
 from django.test import TestCase, Client
 from django.urls import reverse
-from django.contrib.auth.models import User
-from ganeti.models import Cluster
+from django.contrib.auth.models import User, Group
+from django.core.cache import cache
+from apply.models import Organization
+from ganeti.models import (
+    Cluster,
+    Instance,
+    Network,
+    GANETI_TAG_PREFIX,
+    parseQuery,
+    parseQueryStream,
+    preload_instance_data,
+)
+from ganeti import capacity, jobqueue, listing, locks, lookups, rollups
+from ganeti.permissions import PermissionContext
+from ganeti.localcache import TwoTierCache, hot_cache
+from ganeti.utils import (
+    assemble_cluster_details,
+    clear_cluster_user_cache,
+    generate_json,
+    generate_json_rows,
+    instance_row_key,
+    prepare_clusternodes,
+)
+from ganeti.snapshots import (
+    get_snapshot,
+    get_snapshot_version,
+    get_versioned_snapshot,
+    read_snapshot,
+    set_snapshot,
+    update_snapshot,
+)
+from util import client as rapi
+from util.client import (
+    CurlPool,
+    ExecuteMany,
+    GanetiApiError,
+    GanetiRapiClient,
+    SetMaxInFlight,
+    _QueryRowDecoder,
+    _RapiTransfer,
+)
+import refresher
+import watcher
 
 
 class LoginTestCase(TestCase):
@@ -239,6 +289,17 @@ class InstancesTestCase(LoginTestCase):
         res = self.client.get(reverse('user-instances-json'))
         self.assertEqual(res.status_code, 200)
 
+        # server-side processing
+        res = self.client.get(
+            reverse('user-instances-json'),
+            {'sEcho': '3', 'iDisplayStart': '0', 'iDisplayLength': '20'}
+        )
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.content)
+        self.assertEqual(data['sEcho'], 3)
+        self.assertIn('iTotalRecords', data)
+        self.assertIn('iTotalDisplayRecords', data)
+
     def test_stats_json(self):
         # should get a redirect to the login page
         res = self.client.get(reverse('user-stats-json'))
@@ -399,3 +460,1486 @@ class NodegroupsTestCase(LoginTestCase):
         # should return 200 (with error message)
         res = self.client.get(reverse('cluster_ng_stack'), {'cluster_id': self.cluster.pk})
         self.assertEqual(res.status_code, 200)
+
+
+class FakeCurl(object):
+    def __init__(self):
+        self.closed = False
+        self.options = {}
+
+    def setopt(self, option, value):
+        self.options[option] = value
+
+    def getinfo(self, option):
+        return 200
+
+    def close(self):
+        self.closed = True
+
+
+class CurlPoolTestCase(TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.pool = CurlPool(maxsize=2, max_idle=60,
+                             _time_fn=lambda: self.now)
+
+    def test_reuse(self):
+        curl = self.pool.Checkout(FakeCurl)
+        self.pool.Checkin(curl)
+        self.assertIs(self.pool.Checkout(FakeCurl), curl)
+        stats = self.pool.Stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_maxsize(self):
+        handles = [self.pool.Checkout(FakeCurl) for i in range(3)]
+        for curl in handles:
+            self.pool.Checkin(curl)
+        self.assertEqual(self.pool.Stats()['idle'], 2)
+        self.assertTrue(handles[2].closed)
+
+    def test_idle_eviction(self):
+        curl = self.pool.Checkout(FakeCurl)
+        self.pool.Checkin(curl)
+        self.now += 61
+        self.assertIsNot(self.pool.Checkout(FakeCurl), curl)
+        self.assertTrue(curl.closed)
+        self.assertEqual(self.pool.Stats()['evictions'], 1)
+
+    def test_unhealthy_handle(self):
+        curl = self.pool.Checkout(FakeCurl)
+        self.pool.Checkin(curl, healthy=False)
+        self.assertTrue(curl.closed)
+        self.assertEqual(self.pool.Stats()['idle'], 0)
+        self.assertEqual(self.pool.Stats()['discards'], 1)
+
+
+class ExecuteManyTestCase(TestCase):
+    def test_failures_are_returned_per_request(self):
+        pool = CurlPool()
+        # nothing listens on the discard port, so connections are refused
+        client = GanetiRapiClient('127.0.0.1', port=9, curl_pool=pool)
+        results = ExecuteMany([
+            (client, 'GET', '/version', None),
+            (client, 'GET', '/2/info', None),
+        ], timeout=5)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertIsInstance(result, GanetiApiError)
+        self.assertEqual(pool.Stats()['discards'], 2)
+
+    def test_empty(self):
+        self.assertEqual(ExecuteMany([]), [])
+
+    def test_invalid_json_is_an_api_error(self):
+        client = GanetiRapiClient('127.0.0.1', curl_pool=CurlPool())
+        transfer = _RapiTransfer(client, 'GET', '/version', None, None)
+        transfer.curl = FakeCurl()
+        transfer.encoded_resp_body.write(b'<html>Bad Gateway</html>')
+        transfer.Finish()
+        self.assertIsInstance(transfer.error, GanetiApiError)
+
+    def test_prepare_query(self):
+        client = GanetiRapiClient('127.0.0.1')
+        self.assertEqual(
+            client.PrepareQuery('node', ['name']),
+            (client, 'PUT', '/2/query/node', [], {'fields': ['name']})
+        )
+
+
+class QueryStreamTestCase(TestCase):
+    response = {
+        'data': [
+            [[0, 'inst1'], [0, ['tag "a" ]', '[{\\']]],
+            [[0, 'inst\u00e92'], [0, []]],
+        ],
+        'fields': [{'name': 'name'}, {'name': 'tags'}],
+    }
+
+    def test_rows_split_across_chunks(self):
+        raw = json.dumps(self.response, ensure_ascii=False).encode('utf-8')
+        for size in (1, 3, len(raw)):
+            decoder = _QueryRowDecoder()
+            rows = []
+            for i in range(0, len(raw), size):
+                decoder.Feed(raw[i:i + size])
+                rows.extend(decoder.rows)
+                decoder.rows.clear()
+            self.assertEqual(rows, self.response['data'])
+            remainder = json.loads(decoder.GetRemainder())
+            self.assertEqual(remainder['data'], [])
+            self.assertEqual(remainder['fields'], self.response['fields'])
+
+    def test_parse_query_stream(self):
+        self.assertEqual(
+            list(parseQueryStream(self.response['data'], ['name', 'tags'])),
+            parseQuery(self.response)
+        )
+
+
+class StalledRapiServer(object):
+    '''
+    Answers every request with the first row of a query and then stalls,
+    until stopped.
+    '''
+    def __init__(self):
+        from gevent.event import Event
+        from gevent.server import StreamServer
+        self.stop = Event()
+        self.server = StreamServer(('127.0.0.1', 0), self.handle)
+        self.server.start()
+        self.port = self.server.server_port
+
+    def handle(self, sock, address):
+        sock.recv(65536)
+        body = b'{"fields": [{"name": "name"}], "data": [[[0, "vm1"]], '
+        sock.sendall(
+            b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+            b'Content-Length: 1000\r\n\r\n' + body
+        )
+        self.stop.wait(10)
+        sock.close()
+
+    def close(self):
+        self.stop.set()
+        self.server.stop()
+
+
+class StreamQuerySlotTestCase(TestCase):
+    def setUp(self):
+        SetMaxInFlight(1)
+        self.server = StalledRapiServer()
+        self.client = GanetiRapiClient('127.0.0.1', port=self.server.port,
+                                       timeout=1)
+        self.client._base_url = 'http://127.0.0.1:%d' % self.server.port
+
+    def tearDown(self):
+        self.server.close()
+        SetMaxInFlight(rapi.MAX_IN_FLIGHT)
+
+    def test_dropped_stream_releases_its_slot(self):
+        rows = self.client.StreamQuery('instance', ['name'])
+        self.assertEqual(next(rows), [[0, 'vm1']])
+        # the only slot is held until the stream is dropped
+        self.assertFalse(rapi._in_flight.acquire(False))
+        del rows
+        self.assertTrue(rapi._in_flight.acquire(False))
+        rapi._in_flight.release()
+
+    def test_waiting_for_a_slot_times_out(self):
+        rows = self.client.StreamQuery('instance', ['name'])
+        next(rows)
+        # waits for the held slot for the client timeout only
+        results = ExecuteMany([(self.client, 'GET', '/version', None)])
+        self.assertIsInstance(results[0], GanetiApiError)
+        rows.close()
+
+
+class InstanceTestCase(TestCase):
+    def setUp(self):
+        self.user = User(pk=1, username='owner')
+        self.extra_data = {
+            'users': {'owner': self.user}, 'groups': {}, 'orgs': {},
+            'instanceapps': {}, 'networks': {'br0': '2001:db8::/64'},
+        }
+        self.info = {
+            'name': 'vm.example.com',
+            'tags': ['%s:user:owner' % GANETI_TAG_PREFIX,
+                     '%s:isolate' % GANETI_TAG_PREFIX],
+            'pnode': 'node1.example.com',
+            'nic.modes': ['bridged'],
+            'nic.ips': ['192.0.2.1'],
+            'nic.links': ['br0'],
+            'nic.macs': ['aa:00:00:00:00:01'],
+            'admin_state': 'up',
+            'ctime': 1500000000,
+        }
+        self.instance = Instance(
+            Cluster(hostname='cluster.example.com'), self.info['name'],
+            self.info, self.extra_data
+        )
+
+    def test_fields(self):
+        self.assertEqual(self.instance.pnode, 'node1.example.com')
+        self.assertEqual(self.instance.nic_macs, ['aa:00:00:00:00:01'])
+        self.assertRaises(AttributeError, getattr, self.instance, 'nonexistent')
+
+    def test_resolved_fields(self):
+        self.assertEqual(self.instance.users, [self.user])
+        self.assertEqual(self.instance.groups, [])
+        self.assertTrue(self.instance.isolate)
+        self.assertFalse(self.instance.adminlock)
+        self.assertIs(self.instance.admin_state, True)
+        self.assertEqual(self.instance.nic_ips, [None])
+        self.assertEqual(self.instance.ipv6s, ['2001:db8::a800:ff:fe00:1'])
+        # the cached RAPI data is left untouched
+        self.assertEqual(self.info['nic.ips'], ['192.0.2.1'])
+
+
+class SnapshotTestCase(TestCase):
+    key = 'snapshot:test'
+
+    def setUp(self):
+        self.refreshes = 0
+
+    def tearDown(self):
+        hot_cache.delete_many([self.key, self.key + ':error'])
+
+    def refresh(self):
+        self.refreshes += 1
+        set_snapshot(self.key, ['fresh'], 60)
+        return ['fresh']
+
+    def test_cold(self):
+        self.assertEqual(get_snapshot(self.key, self.refresh), ['fresh'])
+        self.assertEqual(get_snapshot(self.key, self.refresh), ['fresh'])
+        self.assertEqual(self.refreshes, 1)
+
+    def test_versions(self):
+        version = set_snapshot(self.key, ['first'], 60)
+        self.assertEqual(get_snapshot_version(self.key), version)
+        self.assertGreater(set_snapshot(self.key, ['second'], 60), version)
+
+    def test_cold_refresh_returns_the_stored_version(self):
+        hot_cache.delete(self.key)
+        value, version = get_versioned_snapshot(self.key, self.refresh)
+        self.assertEqual(value, ['fresh'])
+        self.assertEqual(version, get_snapshot_version(self.key))
+
+    def test_update_waits_for_refresh(self):
+        set_snapshot(self.key, ['a'], 60)
+        # a refresh is running
+        cache.add(self.key + ':refreshing', 1, 60)
+        update = gevent.spawn(
+            update_snapshot, self.key, lambda value: value + ['b']
+        )
+        gevent.sleep(0.2)
+        self.assertFalse(update.ready())
+        set_snapshot(self.key, ['refreshed'], 60)
+        refreshed = get_snapshot_version(self.key)
+        cache.delete(self.key + ':refreshing')
+        value, version, previous = update.get(timeout=5)
+        self.assertEqual(value, ['refreshed', 'b'])
+        self.assertEqual(version, get_snapshot_version(self.key))
+        self.assertEqual(previous, refreshed)
+
+    def test_update_is_reapplied_to_replaced_value(self):
+        set_snapshot(self.key, ['a'], 60)
+
+        def update(value):
+            if value == ['a']:
+                # written meanwhile without the lock
+                set_snapshot(self.key, ['refreshed'], 60)
+            return value + ['b']
+        self.assertEqual(
+            update_snapshot(self.key, update)[0], ['refreshed', 'b']
+        )
+        self.assertEqual(read_snapshot(self.key), ['refreshed', 'b'])
+        self.assertIsNone(cache.get(self.key + ':refreshing'))
+
+    def test_stale_value_is_served_while_refreshing(self):
+        set_snapshot(self.key, ['stale'], 0)
+        version = get_snapshot_version(self.key)
+        self.assertEqual(get_snapshot(self.key, self.refresh), ['stale'])
+        self.assertEqual(get_snapshot(self.key, self.refresh), ['stale'])
+        gevent.sleep(0)
+        self.assertEqual(self.refreshes, 1)
+        self.assertEqual(read_snapshot(self.key), ['fresh'])
+        self.assertGreater(get_snapshot_version(self.key), version)
+
+    def test_failed_refresh_is_not_retried_at_once(self):
+        def fail():
+            self.refreshes += 1
+            raise GanetiApiError('unreachable', code=500)
+
+        self.assertRaises(GanetiApiError, get_snapshot, self.key, fail)
+        self.assertRaises(GanetiApiError, get_snapshot, self.key, fail)
+        self.assertEqual(self.refreshes, 1)
+
+
+class RefreshInstanceRowsTestCase(TestCase):
+    def setUp(self):
+        self.cluster = Cluster(hostname='rows.example.com', slug='rows')
+        self.key = self.cluster._cluster_cache_key()
+        set_snapshot(self.key, [
+            {'name': 'kept', 'status': 'running'},
+            {'name': 'rebooted', 'status': 'ADMIN_down'},
+            {'name': 'renamed', 'status': 'running'},
+        ], 60)
+
+        def stream_query(what, fields, qfilter=None):
+            self.qfilter = qfilter
+            for name in ('rebooted', 'new-name'):
+                row = {'name': name, 'status': 'running'}
+                yield [[0, row.get(field)] for field in fields]
+        self.cluster._client.StreamQuery = stream_query
+
+    def tearDown(self):
+        hot_cache.delete(self.key)
+
+    def test_rows_are_patched(self):
+        self.cluster.refresh_instance_rows(['rebooted', 'renamed', 'new-name'])
+        self.assertEqual(
+            self.qfilter,
+            ['|', ['=', 'name', 'rebooted'], ['=', 'name', 'renamed'],
+             ['=', 'name', 'new-name']]
+        )
+        self.assertEqual(
+            [(i['name'], i['status']) for i in read_snapshot(self.key)],
+            [('kept', 'running'), ('rebooted', 'running'),
+             ('new-name', 'running')]
+        )
+
+
+class UserInstanceIndexTestCase(TestCase):
+    def setUp(self):
+        self.cluster = Cluster.objects.create(
+            hostname='index.example.com', slug='index'
+        )
+        self.user = User.objects.create_user('owner', 'owner@example.com')
+        group = Group.objects.create(name='team')
+        self.user.groups.add(group)
+        User.objects.create_user('other', 'other@example.com')
+        self.cluster._set_instances([
+            {'name': 'mine', 'tags': ['%s:user:owner' % GANETI_TAG_PREFIX]},
+            {'name': 'theirs', 'tags': ['%s:user:other' % GANETI_TAG_PREFIX]},
+            {'name': 'shared', 'tags': ['%s:group:team' % GANETI_TAG_PREFIX]},
+        ], 60)
+
+    def tearDown(self):
+        hot_cache.delete_many([self.cluster._cluster_cache_key(),
+                           self.cluster._instance_index_key()])
+
+    def test_user_instances(self):
+        self.assertEqual(
+            [i.name for i in self.cluster.get_user_instances(self.user)],
+            ['mine', 'shared']
+        )
+
+    def test_stale_index_is_rebuilt(self):
+        set_snapshot(self.cluster._cluster_cache_key(), [
+            {'name': 'theirs', 'tags': ['%s:user:other' % GANETI_TAG_PREFIX]},
+            {'name': 'mine', 'tags': ['%s:user:owner' % GANETI_TAG_PREFIX]},
+        ], 60)
+        self.assertEqual(
+            [i.name for i in self.cluster.get_user_instances(self.user)],
+            ['mine']
+        )
+
+
+class RollupTestCase(TestCase):
+    def setUp(self):
+        self.cluster = Cluster.objects.create(
+            hostname='rollup.example.com', slug='rollup'
+        )
+        self.user = User.objects.create_user('owner', 'owner@example.com')
+        group = Group.objects.create(name='team')
+        self.user.groups.add(group)
+        User.objects.create_user('other', 'other@example.com')
+
+        def info(name, state, disk, vcpus, memory, ctime, *tags):
+            return {
+                'name': name, 'admin_state': state, 'disk.sizes': disk,
+                'beparams': {'vcpus': vcpus, 'maxmem': memory},
+                'ctime': ctime,
+                'tags': ['%s:%s' % (GANETI_TAG_PREFIX, t) for t in tags],
+            }
+        day = 24 * 3600
+        self.instances = [
+            info('mine', 'up', [1024, 2048], 2, 1024, 3 * day, 'user:owner',
+                 'org:grnet'),
+            info('theirs', 'down', [4096], 1, 512, day, 'user:other',
+                 'user:owner'),
+            info('shared', 'up', [1024], 4, 2048, day + 60, 'group:team'),
+            info('nobody', 'down', [1024], 1, 512, None, 'user:missing'),
+        ]
+        self.cluster._set_instances(self.instances, 60)
+
+    def tearDown(self):
+        hot_cache.delete_many([self.cluster._cluster_cache_key(),
+                               self.cluster._instance_index_key(),
+                               self.cluster._rollup_key()])
+
+    def test_rollup(self):
+        rollup = self.cluster.get_rollup()
+        self.assertEqual(rollup['total'], {
+            'instances': 4, 'up': 2, 'down': 2, 'disk': 9216, 'vcpus': 8,
+            'memory': 4096,
+        })
+        self.assertEqual(rollup['users']['owner']['instances'], 2)
+        self.assertEqual(rollup['users']['owner']['disk'], 7168)
+        self.assertEqual(rollup['groups']['team']['vcpus'], 4)
+        self.assertEqual(rollup['organizations']['grnet']['memory'], 1024)
+        day = rollups.CREATED_BUCKET
+        self.assertEqual(rollup['created'], {day: 2, 3 * day: 1})
+        self.assertNotIn('instances', rollup)
+
+    def test_rollup_follows_refreshed_rows(self):
+        rows = [
+            dict(self.instances[2], admin_state='down'),
+            dict(self.instances[0], name='new'),
+        ]
+
+        def stream_query(what, fields, qfilter=None):
+            for row in rows:
+                yield [[0, row.get(field)] for field in fields]
+        self.cluster._client.StreamQuery = stream_query
+        self.cluster.refresh_instance_rows(['theirs', 'shared', 'new'])
+        rollup = self.cluster.get_rollup()
+        self.assertEqual(rollup['total']['instances'], 4)
+        self.assertEqual(rollup['total']['down'], 2)
+        # the removed instance was the only one of other
+        self.assertNotIn('other', rollup['users'])
+        self.assertEqual(rollup['organizations']['grnet']['instances'], 2)
+        # the same as rolling up the whole snapshot
+        instances = read_snapshot(self.cluster._cluster_cache_key())
+        self.assertEqual(
+            rollup, rollups.build_rollup(instances, rollup['version'])
+        )
+
+    def test_user_rollup(self):
+        # the permissions and the groups of the user
+        with self.assertNumQueries(3):
+            totals, created, users = self.cluster.get_user_rollup(
+                PermissionContext(self.user)
+            )
+        self.assertEqual(totals['instances'], 3)
+        self.assertEqual(totals['up'], 2)
+        day = rollups.CREATED_BUCKET
+        self.assertEqual(
+            rollups.creation_series(created), [(day, 2, 2), (3 * day, 1, 3)]
+        )
+        self.assertIsNone(users)
+
+    def test_clear_cluster_user_cache(self):
+        clear_cluster_user_cache('owner', 'rollup')
+        self.assertIsNone(read_snapshot(self.cluster._cluster_cache_key()))
+        self.assertIsNone(hot_cache.get(self.cluster._instance_index_key()))
+        self.assertIsNone(hot_cache.get(self.cluster._rollup_key()))
+
+    def test_user_sum_stats(self):
+        self.client.force_login(self.user)
+        res = self.client.get(reverse('user-stats-json'))
+        self.assertEqual(
+            [(u['user'], u['instances'], u['cpu'])
+             for u in json.loads(res.content)['aaData']],
+            [('owner', 3, 7)]
+        )
+        admin = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'secret'
+        )
+        self.client.force_login(admin)
+        res = self.client.get(reverse('user-stats-json'))
+        # missing does not exist
+        self.assertEqual(
+            sorted((u['user'], u['instances'])
+                   for u in json.loads(res.content)['aaData']),
+            [('other', 1), ('owner', 2)]
+        )
+        res = self.client.get(
+            reverse('stats_ajax_vms_pc', kwargs={'cluster_slug': 'rollup'})
+        )
+        self.assertEqual(
+            json.loads(res.content)['instances'], {'up': 2, 'down': 2}
+        )
+        res = self.client.get(reverse('stats_ajax_instances'))
+        day = rollups.CREATED_BUCKET
+        self.assertEqual(json.loads(res.content)[0]['instances'], [
+            {'time': day, 'created': 2, 'count': 2},
+            {'time': 3 * day, 'created': 1, 'count': 3},
+        ])
+
+
+class LookupTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            'looked', 'looked@example.com', first_name='Looked'
+        )
+        self.group = Group.objects.create(name='lookers')
+        self.user.groups.add(self.group)
+
+    def tearDown(self):
+        for lookup in (lookups.users, lookups.groups, lookups.organizations):
+            lookup.clear_local()
+        cache.delete_many(['lookup:user:looked', 'lookup:user:missing',
+                           'lookup:group:lookers', 'lookup:org:grnet'])
+
+    def test_refs_equal_models(self):
+        user = lookups.users['looked']
+        group = lookups.groups['lookers']
+        self.assertEqual(user.first_name, 'Looked')
+        self.assertIn(self.user, [user])
+        self.assertIn(user, [self.user])
+        self.assertEqual(set([self.group]) & set([group]), set([group]))
+        self.assertEqual(
+            [u.email for u in group.user_set.all()], ['looked@example.com']
+        )
+
+    def test_missing(self):
+        self.assertIsNone(lookups.users.get('missing'))
+        self.assertRaises(KeyError, lambda: lookups.users['missing'])
+        with self.assertNumQueries(0):
+            self.assertIsNone(lookups.users.get('missing'))
+
+    def test_local_cache(self):
+        lookups.users.get('looked')
+        cache.delete('lookup:user:looked')
+        with self.assertNumQueries(0):
+            self.assertEqual(lookups.users['looked'].pk, self.user.pk)
+
+    def test_invalidation(self):
+        self.assertEqual(lookups.users['looked'].email, 'looked@example.com')
+        self.assertEqual(len(lookups.groups['lookers'].usernames), 1)
+        self.user.email = 'changed@example.com'
+        self.user.save()
+        self.assertEqual(lookups.users['looked'].email, 'changed@example.com')
+        self.user.groups.remove(self.group)
+        self.assertEqual(lookups.groups['lookers'].usernames, ())
+        self.group.delete()
+        self.assertIsNone(lookups.groups.get('lookers'))
+
+    def test_organization_refs(self):
+        org = Organization.objects.create(
+            title='GRNET', tag='grnet', phone='210'
+        )
+        ref = lookups.organizations['grnet']
+        # only the id and the name are stored
+        self.assertEqual(
+            cache.get('lookup:org:grnet'), (org.pk, 'grnet', 'GRNET')
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(ref, org)
+            self.assertEqual(str(ref), 'GRNET')
+        # other fields are loaded once, when asked for
+        with self.assertNumQueries(1):
+            self.assertEqual(ref.phone, '210')
+            self.assertIsNone(ref.email)
+
+    def test_instance_owners(self):
+        instance = Instance(
+            Cluster(hostname='lookup.example.com', slug='lookup'),
+            'owned', {'name': 'owned', 'tags': [
+                '%s:user:looked' % GANETI_TAG_PREFIX,
+                '%s:user:missing' % GANETI_TAG_PREFIX,
+                '%s:group:lookers' % GANETI_TAG_PREFIX,
+            ]}
+        )
+        self.assertEqual(instance.users, [self.user])
+        self.assertEqual(instance.groups, [self.group])
+
+
+class TwoTierCacheTestCase(TestCase):
+    def setUp(self):
+        self.reader = TwoTierCache()
+        self.writer = TwoTierCache()
+
+    def tearDown(self):
+        cache.delete('l1:test')
+
+    def test_hits_stay_local(self):
+        self.writer.set('l1:test', [1, 2, 3], 60)
+        self.assertEqual(self.reader.get('l1:test'), [1, 2, 3])
+        # changed behind the back of the two-tier cache
+        cache.set('l1:test', [4], 60)
+        self.assertEqual(self.reader.get('l1:test'), [1, 2, 3])
+        self.assertEqual(self.reader.stats()['hits'], 1)
+
+    def test_invalidation_is_broadcast(self):
+        self.writer.set('l1:test', 'old', 60)
+        self.assertEqual(self.reader.get('l1:test'), 'old')
+        self.writer.set('l1:test', 'new', 60)
+        self.reader.next_poll = 0
+        self.assertEqual(self.reader.get('l1:test'), 'new')
+        self.writer.delete('l1:test')
+        self.reader.next_poll = 0
+        self.assertIsNone(self.reader.get('l1:test'))
+
+    def test_clear(self):
+        self.writer.set('l1:test', 'value', 60)
+        self.reader.get('l1:test')
+        self.writer.clear()
+        self.reader.next_poll = 0
+        cache.set('l1:test', 'changed', 60)
+        self.assertEqual(self.reader.get('l1:test'), 'changed')
+
+    def test_entry_bound(self):
+        small = TwoTierCache(max_entries=4)
+        for i in range(10):
+            small._store('l1:test:%d' % i, 'x' * 512, 60)
+        self.assertEqual(len(small.entries), 4)
+        self.assertNotIn('l1:test:0', small.entries)
+        self.assertIn('l1:test:9', small.entries)
+        # reading an entry keeps it
+        small.next_poll = float('inf')
+        small.get('l1:test:6')
+        small._store('l1:test:new', 'x', 60)
+        self.assertIn('l1:test:6', small.entries)
+        self.assertNotIn('l1:test:7', small.entries)
+
+
+class FakeJobsClient(object):
+    def __init__(self, query_supported=True):
+        self.query_supported = query_supported
+        self.calls = []
+
+    def Query(self, what, fields, qfilter=None):
+        self.calls.append(('Query', what, qfilter))
+        if not self.query_supported:
+            raise GanetiApiError('Not found', code=404)
+        return {
+            'fields': [{'name': field} for field in fields],
+            'data': [[[0, 1], [0, 'success'], [0, [1, 0]]],
+                     [[0, 2], [0, 'running'], [0, None]]],
+        }
+
+    def GetJobs(self, bulk=False):
+        self.calls.append(('GetJobs', bulk))
+        return [{'id': 1, 'status': 'success', 'end_ts': [1, 0]},
+                {'id': 3, 'status': 'running', 'end_ts': None}]
+
+    def GetJobStatus(self, job_id):
+        self.calls.append(('GetJobStatus', job_id))
+        return {'id': job_id, 'status': 'error', 'end_ts': [2, 0]}
+
+
+class JobStatusesTestCase(TestCase):
+    fields = ['id', 'status', 'end_ts']
+
+    def test_query(self):
+        cluster = Cluster(hostname='jobs.example.com', slug='jobs')
+        cluster._client = FakeJobsClient()
+        statuses = cluster.get_job_statuses([1, 2], self.fields)
+        self.assertEqual(statuses[1]['end_ts'], [1, 0])
+        self.assertEqual(statuses[2]['status'], 'running')
+        self.assertEqual(cluster._client.calls, [
+            ('Query', 'job', ['|', ['=', 'id', 1], ['=', 'id', 2]])
+        ])
+
+    def test_listing_fallback(self):
+        cluster = Cluster(hostname='jobs.example.com', slug='jobs')
+        cluster._client = FakeJobsClient(query_supported=False)
+        statuses = cluster.get_job_statuses([1, 2], self.fields)
+        self.assertEqual(statuses[1]['status'], 'success')
+        # not in the listing, fetched on its own
+        self.assertEqual(statuses[2]['status'], 'error')
+        cluster.get_job_statuses([1], self.fields)
+        self.assertEqual(
+            [call[0] for call in cluster._client.calls],
+            ['Query', 'GetJobs', 'GetJobStatus', 'GetJobs']
+        )
+
+
+class JobQueueTestCase(TestCase):
+    def setUp(self):
+        self.shards = jobqueue.WATCHER_SHARDS
+        jobqueue.WATCHER_SHARDS = 4
+
+    def tearDown(self):
+        jobqueue.WATCHER_SHARDS = self.shards
+
+    def test_every_tube_is_watched_once(self):
+        watched = [
+            tube for process in range(3)
+            for tube in jobqueue.watched_tubes(process, 3)
+        ]
+        self.assertEqual(len(watched), len(set(watched)))
+        self.assertIn(jobqueue.BEANSTALK_TUBE, watched)
+        for slug in ('a', 'b', 'cluster1', 'cluster2'):
+            self.assertIn(jobqueue.job_tube(slug), watched)
+        self.assertEqual(jobqueue.job_tube('a'), jobqueue.job_tube('a'))
+
+
+class RecordingProducer(jobqueue.Producer):
+    def __init__(self, *args, **kwargs):
+        jobqueue.Producer.__init__(self, *args, **kwargs)
+        self.sent = []
+
+    def _put(self, tube, body):
+        self.sent.append((tube, body))
+
+
+class ProducerTestCase(TestCase):
+    def setUp(self):
+        fd, self.spool_file = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.spool_file)
+
+    def tearDown(self):
+        if os.path.exists(self.spool_file):
+            os.unlink(self.spool_file)
+
+    def test_put_does_not_block(self):
+        producer = RecordingProducer(spool_file=self.spool_file)
+        producer.put('tube', 'job1')
+        producer.put('tube', 'job2')
+        self.assertEqual(producer.sent, [])
+        gevent.sleep(0)
+        self.assertEqual(producer.sent, [('tube', 'job1'), ('tube', 'job2')])
+
+    def test_spool_while_unreachable(self):
+        # nothing listens on the discard port
+        producer = jobqueue.Producer('127.0.0.1', 9, self.spool_file)
+        producer.buffer.extend([('tube', 'job1'), ('tube', 'job2')])
+        self.assertFalse(producer.flush())
+        self.assertEqual(len(producer.buffer), 0)
+        with open(self.spool_file) as spool:
+            self.assertEqual(len(spool.readlines()), 2)
+
+        recovered = RecordingProducer(spool_file=self.spool_file)
+        self.assertTrue(recovered.spooled)
+        recovered.buffer.append(('tube', 'job3'))
+        self.assertTrue(recovered.flush())
+        self.assertEqual([body for tube, body in recovered.sent],
+                         ['job1', 'job2', 'job3'])
+        self.assertEqual(os.path.getsize(self.spool_file), 0)
+
+
+class FakeBeanstalk(object):
+    def __init__(self):
+        self.reserves = 0
+        self.commands = []
+
+    def reserve(self, timeout):
+        # an empty tube
+        self.reserves += 1
+        gevent.sleep(0.05)
+        raise greenstalk.TimedOutError()
+
+    def touch(self, job):
+        self.commands.append(('touch', job))
+
+    def delete(self, job):
+        self.commands.append(('delete', job))
+
+
+class WatcherConnectionTestCase(TestCase):
+    def setUp(self):
+        watcher.logger = logging.getLogger('watcher')
+
+    def test_jobs_are_acked_while_reserving(self):
+        scheduler = watcher.Scheduler(1, ['tube'])
+        client = scheduler.connection.client = FakeBeanstalk()
+        reserver = gevent.spawn(scheduler.reserve)
+        try:
+            gevent.sleep(0.01)
+            handlers = [
+                gevent.spawn(scheduler.connection.touch, 1),
+                gevent.spawn(scheduler.connection.delete, 1),
+                gevent.spawn(scheduler.connection.delete, 2),
+            ]
+            gevent.joinall(handlers, timeout=1)
+            self.assertEqual(client.commands, [
+                ('touch', 1), ('delete', 1), ('delete', 2)
+            ])
+            self.assertGreater(client.reserves, 1)
+        finally:
+            reserver.kill()
+
+
+class FakeWaitCluster(object):
+    hostname = 'wait.example.com'
+
+    def __init__(self, wait_error=None, wait_time=0.01):
+        self.wait_error = wait_error
+        self.wait_time = wait_time
+        # job id -> status, of the jobs the cluster knows
+        self.jobs = {}
+        self.calls = []
+
+    def finish(self, job_id):
+        self.jobs[job_id] = dict(
+            dict.fromkeys(watcher.JOB_FIELDS), id=job_id, status='success',
+            end_ts=[1, 0]
+        )
+
+    def wait_for_job_change(self, job_id, fields, job_info, log_serial):
+        self.calls.append(('wait', job_id))
+        if self.wait_error is not None:
+            raise GanetiApiError('Error', code=self.wait_error)
+        gevent.sleep(self.wait_time)
+        status = self.jobs.get(job_id)
+        if status is None:
+            raise GanetiApiError('Not found', code=404)
+        if not status['end_ts']:
+            return None
+        return {
+            'job_info': [status[field] for field in fields],
+            'log_entries': [],
+        }
+
+    def get_job_statuses(self, job_ids, fields):
+        self.calls.append(('poll', sorted(job_ids)))
+        return dict(
+            (job_id, self.jobs[job_id]) for job_id in job_ids
+            if job_id in self.jobs
+        )
+
+
+class JobTrackerTestCase(TestCase):
+    def setUp(self):
+        watcher.logger = logging.getLogger('watcher')
+        self.intervals = watcher.POLL_INTERVALS
+        watcher.POLL_INTERVALS = [0.01]
+        watcher.trackers.clear()
+        watcher.wait_unsupported.clear()
+
+    def tearDown(self):
+        watcher.POLL_INTERVALS = self.intervals
+        watcher.trackers.clear()
+        watcher.wait_unsupported.clear()
+
+    def wait(self, cluster, job_id):
+        return watcher.wait_for_job(cluster, job_id, lambda: True)
+
+    def test_long_poll(self):
+        cluster = FakeWaitCluster()
+        cluster.finish(1)
+        self.assertEqual(self.wait(cluster, 1)['status'], 'success')
+        self.assertEqual(cluster.calls, [('wait', 1)])
+
+    def test_unsupported_wait_falls_back_to_polling(self):
+        cluster = FakeWaitCluster(wait_error=501)
+        cluster.finish(1)
+        self.assertEqual(self.wait(cluster, 1)['status'], 'success')
+        self.assertEqual(cluster.calls, [('wait', 1), ('poll', [1])])
+        self.assertGreater(
+            watcher.wait_unsupported[cluster.hostname], watcher.time()
+        )
+        # remembered for the cluster, its next jobs are polled right away
+        cluster.calls = []
+        cluster.finish(2)
+        self.assertEqual(self.wait(cluster, 2)['status'], 'success')
+        self.assertEqual(cluster.calls, [('poll', [2])])
+
+    def test_unknown_job_is_gone(self):
+        cluster = FakeWaitCluster()
+        cluster.finish(1)
+        status = self.wait(cluster, 2)
+        self.assertEqual(status['status'], watcher.JOB_GONE)
+        self.assertEqual(status['id'], 2)
+        # the cluster itself still long-polls
+        self.assertNotIn(cluster.hostname, watcher.wait_unsupported)
+        self.assertEqual(
+            cluster.calls.count(('poll', [2])), watcher.MISSING_JOB_TICKS
+        )
+        self.assertEqual(self.wait(cluster, 1)['status'], 'success')
+
+    def test_added_job_interrupts_long_poll(self):
+        cluster = FakeWaitCluster(wait_time=5)
+        waiter = gevent.spawn(self.wait, cluster, 1)
+        gevent.sleep(0.01)
+        cluster.finish(2)
+        with gevent.Timeout(1):
+            self.assertEqual(self.wait(cluster, 2)['status'], 'success')
+        self.assertIn(('poll', [1, 2]), cluster.calls)
+        waiter.kill()
+
+
+class StubRefreshCluster(object):
+    hostname = 'stub.example.com'
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.refreshed = []
+
+    def __getattr__(self, step):
+        if not step.startswith('refresh_'):
+            raise AttributeError(step)
+
+        def refresh(seconds):
+            self.refreshed.append((step, seconds))
+            if step in self.failing:
+                raise GanetiApiError('Error', code=500)
+        return refresh
+
+
+class StopRefreshing(Exception):
+    pass
+
+
+class RefresherTestCase(TestCase):
+    def setUp(self):
+        refresher.logger = logging.getLogger('refresher')
+        self.patched = dict(
+            (name, getattr(refresher, name))
+            for name in ('sleep', 'jitter', 'refresh_cluster')
+        )
+        self.delays = []
+        refresher.sleep = self.sleep
+        refresher.jitter = lambda interval: 0
+
+    def tearDown(self):
+        for name, value in self.patched.items():
+            setattr(refresher, name, value)
+
+    def sleep(self, delay):
+        if delay:
+            self.delays.append(delay)
+        if len(self.delays) == 3:
+            raise StopRefreshing()
+
+    def test_refresh_cluster(self):
+        cluster = StubRefreshCluster()
+        self.assertTrue(refresher.refresh_cluster(cluster))
+        self.assertEqual(cluster.refreshed, [
+            (step, refresher.REFRESH_CACHE_TIMEOUT)
+            for step in refresher.REFRESH_STEPS
+        ])
+        # a failed step does not keep the rest from being refreshed
+        cluster = StubRefreshCluster(failing=('refresh_instances',))
+        self.assertFalse(refresher.refresh_cluster(cluster))
+        self.assertEqual(
+            [step for step, seconds in cluster.refreshed],
+            list(refresher.REFRESH_STEPS)
+        )
+
+    def test_refresh_cycle(self):
+        cluster = Cluster.objects.create(
+            hostname='refresh.example.com', slug='refresh'
+        )
+        stub = StubRefreshCluster(failing=('refresh_nodes',))
+        refreshed = []
+
+        def refresh_cluster(c):
+            # fails twice, then refreshes fine
+            refreshed.append(c.hostname)
+            if len(refreshed) == 3:
+                stub.failing = ()
+            return self.patched['refresh_cluster'](stub)
+        refresher.refresh_cluster = refresh_cluster
+        clusters = {cluster.pk: None}
+        with self.assertRaises(StopRefreshing):
+            refresher.cluster_refresher(
+                cluster.pk, BoundedSemaphore(1), clusters
+            )
+        self.assertEqual(refreshed, ['refresh.example.com'] * 3)
+        interval = refresher.REFRESH_INTERVAL
+        # backs off from the failing cluster
+        self.assertEqual(self.delays, [
+            min(interval * 2, refresher.MAX_BACKOFF),
+            min(interval * 4, refresher.MAX_BACKOFF),
+            interval,
+        ])
+        self.assertNotIn(cluster.pk, clusters)
+        self.assertEqual(len(stub.refreshed), 3 * len(refresher.REFRESH_STEPS))
+
+    def test_disabled_cluster_is_dropped(self):
+        cluster = Cluster.objects.create(
+            hostname='refresh.example.com', slug='refresh', disabled=True
+        )
+        clusters = {cluster.pk: None}
+        refresher.cluster_refresher(cluster.pk, BoundedSemaphore(1), clusters)
+        self.assertEqual(clusters, {})
+
+
+class InstanceLocksTestCase(TestCase):
+    def tearDown(self):
+        for name in ('locked1', 'locked2', 'unlocked'):
+            locks.unlock_instance(name)
+
+    def test_lock_registry(self):
+        locks.lock_instance('locked1', 'reboot')
+        locks.lock_instance('locked2', 'shutdown')
+        self.assertEqual(
+            locks.get_locked_instances(['locked1', 'locked2', 'unlocked']),
+            {'locked1': 'reboot', 'locked2': 'shutdown'}
+        )
+        self.assertTrue(locks.unlock_instance('locked1'))
+        self.assertFalse(locks.unlock_instance('unlocked'))
+        self.assertEqual(
+            locks.get_locked_instances(['locked1', 'locked2']),
+            {'locked2': 'shutdown'}
+        )
+        self.assertEqual(locks.get_locked_instances([]), {})
+
+
+def _listing_row(name, memory, status='running'):
+    return {
+        'name': name, 'tags': [], 'pnode': 'node1', 'snodes': [],
+        'disk.sizes': [1024], 'nic.modes': ['routed'],
+        'nic.ips': ['192.0.2.1'], 'nic.links': ['br0'],
+        'nic.macs': ['aa:00:00:00:00:01'], 'status': status,
+        'admin_state': 'up', 'oper_state': status == 'running',
+        'beparams': {'maxmem': memory, 'vcpus': 1},
+        'hvparams': {}, 'ctime': 0, 'mtime': 0,
+    }
+
+
+class ListingTestCase(TestCase):
+    def setUp(self):
+        self.user = User(username='admin', is_superuser=True)
+        self.clusters = [
+            Cluster.objects.create(hostname='a.example.com', slug='a'),
+            Cluster.objects.create(hostname='b.example.com', slug='b'),
+        ]
+        self.clusters[0]._set_instances([
+            _listing_row('web1', 2048),
+            _listing_row('db1', 8192, status='ADMIN_down'),
+        ], 60)
+        self.clusters[1]._set_instances([
+            _listing_row('web2', 4096),
+            _listing_row('mail', 1024),
+        ], 60)
+
+    def tearDown(self):
+        for cluster in self.clusters:
+            hot_cache.delete_many(
+                [cluster._cluster_cache_key(), cluster._instance_index_key()] +
+                [cluster._instance_order_key(field) for field in
+                 list(listing.COLUMNS) + [listing.SEARCH_FIELD]]
+            )
+
+    def get_page(self, **params):
+        params.setdefault('iColumns', '3')
+        params.update({
+            'mDataProp_0': 'name', 'mDataProp_1': 'cluster',
+            'mDataProp_2': 'memory',
+        })
+        instances = []
+        for cluster in self.clusters:
+            instances.extend(cluster.get_instances())
+        total, filtered, page = listing.get_page(instances, self.user, params)
+        return total, filtered, [i.name for i in page]
+
+    def test_sorted_pages(self):
+        self.assertEqual(
+            self.get_page(iDisplayStart='1', iDisplayLength='2'),
+            (4, 4, ['mail', 'web1'])
+        )
+        self.assertEqual(
+            self.get_page(iSortingCols='1', iSortCol_0='2', sSortDir_0='desc'),
+            (4, 4, ['db1', 'web2', 'web1', 'mail'])
+        )
+        self.assertEqual(
+            self.get_page(iSortingCols='1', iSortCol_0='1', sSortDir_0='desc'),
+            (4, 4, ['web2', 'mail', 'web1', 'db1'])
+        )
+
+    def test_search(self):
+        self.assertEqual(
+            self.get_page(sSearch='WEB'), (4, 2, ['web1', 'web2'])
+        )
+        self.assertEqual(
+            self.get_page(sSearch='stopped'), (4, 1, ['db1'])
+        )
+        self.assertEqual(
+            self.get_page(sSearch_1='b', sSearch_2='4.0 gb'),
+            (4, 1, ['web2'])
+        )
+
+
+class InstanceRowTestCase(TestCase):
+    def setUp(self):
+        self.admin = User(username='admin', is_superuser=True)
+        self.info = _listing_row('vm', 2048)
+        self.cluster = Cluster(hostname='rows.example.com', slug='rows')
+
+    def tearDown(self):
+        cache.delete(instance_row_key(self.instance(), True))
+        cache.delete(instance_row_key(self.instance(), False))
+
+    def instance(self, joblock=False, networks=None):
+        extra_data = preload_instance_data()
+        if networks is not None:
+            extra_data = dict(extra_data, networks=networks)
+        instance = Instance(self.cluster, 'vm', self.info, extra_data, 1)
+        instance.joblock = joblock
+        return instance
+
+    def test_rows_are_cached_per_snapshot(self):
+        row = generate_json(self.instance(), self.admin, [])[0]
+        self.assertEqual(row['memory'], '2.0\xa0GB')
+        self.info['beparams'] = {'maxmem': 4096, 'vcpus': 1}
+        self.assertEqual(
+            generate_json(self.instance(), self.admin, [])[0], row
+        )
+        instance = self.instance()
+        instance.snapshot_version = None
+        self.assertEqual(
+            generate_json(instance, self.admin, [])[0]['memory'],
+            '4.0\xa0GB'
+        )
+
+    def test_lock_state_is_overlaid(self):
+        generate_json(self.instance(), self.admin, [])
+        row = generate_json(self.instance('deleting'), self.admin, ['node1'])[0]
+        self.assertTrue(row['node_group_locked'])
+        self.assertEqual(row['locked_reason'], 'Deleting')
+        self.assertNotIn('name_href', row)
+        row = generate_json(self.instance(), self.admin, [])[0]
+        self.assertFalse(row['node_group_locked'])
+        self.assertNotIn('locked', row)
+        self.assertIn('name_href', row)
+
+    def test_database_fields_are_not_cached(self):
+        owner = User.objects.create_user('owner', 'owner@example.com')
+        self.info['tags'] = ['%s:user:owner' % GANETI_TAG_PREFIX]
+        row = generate_json(self.instance(), self.admin, [])[0]
+        self.assertEqual(row['users'][0]['email'], 'owner@example.com')
+        owner.email = 'new@example.com'
+        owner.save()
+        row = generate_json(self.instance(), self.admin, [])[0]
+        self.assertEqual(row['users'][0]['email'], 'new@example.com')
+        self.assertNotIn(
+            'users', cache.get(instance_row_key(self.instance(), True))
+        )
+
+    def test_owner_ipv6_addresses_are_not_cached(self):
+        owner = User.objects.create_user('owner', 'owner@example.com')
+        self.info['tags'] = ['%s:user:owner' % GANETI_TAG_PREFIX]
+        instance = self.instance(networks={'br0': '2001:db8:1::/64'})
+        row = generate_json(instance, owner, [])[0]
+        self.assertEqual(row['ipv6address'], ['2001:db8:1:0:a800:ff:fe00:1'])
+        instance = self.instance(networks={'br0': '2001:db8:2::/64'})
+        row = generate_json(instance, owner, [])[0]
+        self.assertEqual(row['ipv6address'], ['2001:db8:2:0:a800:ff:fe00:1'])
+        self.assertNotIn(
+            'ipv6address', cache.get(instance_row_key(instance, False))
+        )
+
+    def test_batched_rows(self):
+        instances = []
+        for name in ('vm3', 'vm1', 'vm2'):
+            info = dict(self.info, name=name)
+            instances.append(
+                Instance(self.cluster, name, info, preload_instance_data())
+            )
+        rows, errors = generate_json_rows(instances, self.admin, [])
+        self.assertEqual(errors, [])
+        self.assertEqual([row['name'] for row in rows], ['vm3', 'vm1', 'vm2'])
+        self.assertEqual(
+            rows[0], generate_json(instances[0], self.admin, [])[0]
+        )
+        self.assertEqual(
+            rows[0]['name_href'],
+            reverse('instance-detail', kwargs={
+                'cluster_slug': 'rows', 'instance': 'vm3'
+            })
+        )
+
+
+class PermissionContextTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com')
+        self.group = Group.objects.create(name='team')
+        self.user.groups.add(self.group)
+        self.info = _listing_row('vm', 1024)
+
+    def instance(self, tag):
+        info = dict(self.info, tags=['%s:%s' % (GANETI_TAG_PREFIX, tag)])
+        return Instance(
+            Cluster(hostname='perms.example.com'), 'vm', info,
+            preload_instance_data()
+        )
+
+    def test_checks_are_done_once(self):
+        mine = self.instance('user:owner')
+        shared = self.instance('group:team')
+        theirs = self.instance('user:other')
+        for instance in (mine, shared, theirs):
+            instance.users, instance.groups
+        permissions = PermissionContext(self.user)
+        with self.assertNumQueries(3):
+            # the permissions of the user, their groups, and the groups of
+            # their permissions
+            self.assertFalse(permissions.admin)
+            self.assertTrue(permissions.owns(mine))
+            self.assertTrue(permissions.owns(shared))
+            self.assertFalse(permissions.owns(theirs))
+            self.assertFalse(permissions.admin)
+            self.assertEqual(permissions.group_names, ['team'])
+
+
+class NodeProjectionTestCase(TestCase):
+    def setUp(self):
+        self.cluster = Cluster(hostname='nodes.example.com', slug='nodes')
+        self.queries = 0
+
+        def query(what, fields):
+            self.queries += 1
+            values = {
+                'name': 'node1', 'role': 'M', 'mfree': 1024, 'mtotal': 4096,
+                'dtotal': 100, 'dfree': None, 'ctotal': 8, 'group': 'default',
+                'pinst_cnt': 1, 'offline': True, 'vm_capable': True,
+                'pinst_list': ['vm1'],
+            }
+            return {
+                'fields': [{'name': field} for field in fields],
+                'data': [[[0, values[field]] for field in fields]],
+            }
+        self.cluster._client.Query = query
+
+    def tearDown(self):
+        hot_cache.delete_many([
+            self.cluster._node_projection_key(),
+            'cluster:nodes.example.com:nodes',
+        ])
+
+    def test_projection_is_stored_with_the_nodes(self):
+        self.assertEqual(self.cluster.get_node_projection(), {
+            'nodes': [{
+                'name': 'node1', 'mem_used': 75.0, 'mfree': 1024,
+                'mtotal': 4096, 'shared_storage': False, 'disk_used': 100.0,
+                'dfree': 0, 'dtotal': 100, 'ctotal': 8, 'pinst_cnt': 1,
+                'pinst_list': ['vm1'], 'role': 'M',
+                'cluster': 'nodes.example.com',
+            }],
+            'offline': ['node1'],
+            'capacity': [],
+        })
+        self.assertEqual(
+            self.cluster.get_cluster_nodes()[0]['group'], 'default'
+        )
+        self.assertEqual(self.queries, 1)
+
+    def test_cluster_nodes_are_read_from_the_cache(self):
+        self.cluster.save()
+        self.cluster.get_node_projection()
+        nodes, bad_clusters, bad_nodes = prepare_clusternodes()
+        self.assertEqual([node['name'] for node in nodes], ['node1'])
+        self.assertEqual((bad_clusters, bad_nodes), ([], ['node1']))
+        self.assertEqual(self.queries, 1)
+
+
+class CapacityTestCase(TestCase):
+    def setUp(self):
+        self.cluster = Cluster(hostname='capacity.example.com', slug='capacity')
+        nodes = [
+            # name, group, mfree, dfree, pinst_cnt, role, offline
+            ('node1', 'a', 2048, 100 * 1024, 4, 'R', False),
+            ('node2', 'a', 16384, 500 * 1024, 6, 'R', False),
+            ('node3', 'a', 16384, 500 * 1024, 2, 'R', False),
+            ('node4', 'b', 30000, 900 * 1024, 0, 'D', False),
+            ('node5', 'b', 30000, 900 * 1024, 0, 'R', True),
+            ('node6', 'b', 8192, 800 * 1024, 1, 'M', False),
+        ]
+        fields = [
+            'name', 'group', 'mfree', 'dfree', 'pinst_cnt', 'role', 'offline'
+        ]
+
+        def query(what, query_fields):
+            data = []
+            for node in nodes:
+                values = dict(zip(fields, node))
+                values.update({
+                    'mtotal': 32768, 'dtotal': 1000 * 1024, 'ctotal': 8,
+                    'vm_capable': True, 'pinst_list': [],
+                })
+                data.append([[0, values[f]] for f in query_fields])
+            return {
+                'fields': [{'name': f} for f in query_fields], 'data': data
+            }
+        self.cluster._client.Query = query
+
+    def tearDown(self):
+        hot_cache.delete_many([
+            self.cluster._node_projection_key(),
+            'cluster:capacity.example.com:nodes',
+        ])
+
+    def test_capacity_rows(self):
+        self.assertEqual(self.cluster.get_capacity(refresh=False), None)
+        self.assertEqual(
+            [row[0] for row in self.cluster.get_capacity()],
+            ['node1', 'node2', 'node3', 'node6']
+        )
+        self.assertEqual(len(self.cluster.get_capacity(refresh=False)), 4)
+
+    def test_available_nodes_by_headroom(self):
+        # equal headroom, fewer primary instances first
+        self.assertEqual(
+            self.cluster.get_available_nodes('a', 2, 1024, 10 * 1024),
+            ['node3', 'node2']
+        )
+        # node1 does not fit and comes last
+        self.assertEqual(
+            self.cluster.get_available_nodes('a', 3, 4096, 10 * 1024),
+            ['node3', 'node2', 'node1']
+        )
+        self.assertEqual(
+            self.cluster.get_available_nodes('b', 2), ['node6']
+        )
+
+    def test_placements(self):
+        rows = self.cluster.get_capacity()
+        placement = capacity.place(rows, 4096, 10 * 1024)
+        self.assertEqual(
+            (placement['node_group'], placement['primary']), ('a', 'node3')
+        )
+        self.assertEqual(placement['secondary'], None)
+        pair = capacity.place(rows, 4096, 10 * 1024, drbd=True)
+        self.assertEqual(
+            (pair['node_group'], pair['primary'], pair['secondary']),
+            ('a', 'node3', 'node2')
+        )
+        # only node6 has the disk, too few nodes for a pair
+        placement = capacity.place(rows, 4096, 600 * 1024)
+        self.assertEqual(
+            (placement['node_group'], placement['primary']), ('b', 'node6')
+        )
+        self.assertEqual(
+            capacity.place(rows, 4096, 600 * 1024, drbd=True), None
+        )
+        self.assertEqual(capacity.place(rows, 20000, 0), None)
+
+        placements = capacity.find_placements(
+            {'capacity': rows, 'empty': []}, 4096, 10 * 1024
+        )
+        self.assertEqual(len(placements), 1)
+        self.assertEqual(placements[0]['cluster'], 'capacity')
+        self.assertEqual(placements[0]['pair']['secondary'], 'node2')
+
+    def test_placement_is_the_best_ranked(self):
+        rows = [
+            ('node%d' % i, 'g%d' % (i % 3), (i * 7919) % 32768, 32768,
+             (i * 104729) % (1000 * 1024), 1000 * 1024, i % 5)
+            for i in range(200)
+        ]
+        by_name = dict((row[0], row) for row in rows)
+        for drbd in (False, True):
+            placement = capacity.place(rows, 4096, 100 * 1024, drbd)
+            best = {}
+            for group in ('g0', 'g1', 'g2'):
+                ranked = capacity.rank_nodes(rows, 4096, 100 * 1024, group)
+                chosen = ranked[:2] if drbd else [ranked[0], None]
+                # the pair is as good as its weaker node
+                best[group] = (capacity.headroom(
+                    by_name[chosen[-1] or chosen[0]], 4096, 100 * 1024
+                ), chosen)
+            group = max(best, key=lambda g: best[g][0])
+            self.assertEqual(placement['node_group'], group)
+            self.assertEqual(
+                [placement['primary'], placement['secondary']],
+                best[group][1]
+            )
+            self.assertEqual(placement['headroom'], best[group][0])
+
+
+class FakeDetailsClient(object):
+    def __init__(self):
+        self.calls = []
+
+    def GetInfo(self):
+        self.calls.append('info')
+        return {'name': 'details', 'ctime': None, 'mtime': None}
+
+    def GetGroups(self, bulk=False):
+        self.calls.append('groups')
+        return [{'name': 'default', 'alloc_policy': 'preferred',
+                 'node_list': ['node1'], 'tags': ['vg:xenvg']}]
+
+    def GetNetworks(self, bulk=False):
+        self.calls.append('networks')
+        return [{'name': 'public', 'free_count': 10, 'reserved_count': 2,
+                 'group_list': [['default', 'routed', 'br1']]}]
+
+    def Query(self, what, fields):
+        self.calls.append('nodes')
+        return {'fields': [{'name': field} for field in fields], 'data': []}
+
+
+class ClusterDetailsTestCase(TestCase):
+    def setUp(self):
+        self.cluster = Cluster.objects.create(
+            hostname='details.example.com', slug='details'
+        )
+        self.client_calls = self.cluster._client = FakeDetailsClient()
+
+    def tearDown(self):
+        hot_cache.delete_many(
+            ['cluster:details.example.com:%s' % section for section in
+             ('info', 'nodes', 'nodes:api', 'networks', 'nodegroups',
+              'nodegroups:stack')]
+        )
+
+    def test_sections_are_refreshed_independently(self):
+        details = assemble_cluster_details(self.cluster)
+        self.assertEqual(details['nodegroups'][0]['vgs'], ['xenvg'])
+        self.assertEqual(
+            details['nodegroups'][0]['networks'][0]['network'], 'public'
+        )
+        self.assertEqual(
+            set(details['versions']),
+            set(['clusterinfo', 'nodegroups', 'nodes', 'networks'])
+        )
+        self.assertEqual(
+            sorted(self.client_calls.calls),
+            ['groups', 'info', 'networks', 'nodes']
+        )
+
+        self.cluster.refresh_cluster_info()
+        updated = assemble_cluster_details(self.cluster)
+        self.assertGreater(
+            updated['versions']['clusterinfo'],
+            details['versions']['clusterinfo']
+        )
+        self.assertEqual(
+            updated['versions']['nodegroups'],
+            details['versions']['nodegroups']
+        )
+        self.assertIs(updated['nodegroups'], details['nodegroups'])
+
+    def test_network_changes_rebuild_the_node_group_stack(self):
+        self.cluster.get_node_group_stack()
+        Network.objects.create(
+            description='bridged', cluster=self.cluster, link='br0',
+            mode='bridged'
+        )
+        networks = self.cluster.get_node_group_stack()[0]['networks']
+        self.assertEqual(
+            [network['link'] for network in networks], ['br0', 'br1']
+        )
+
+
+class NodeGroupNetworksTestCase(TestCase):
+    def setUp(self):
+        self.cluster = Cluster.objects.create(
+            hostname='networks.example.com', slug='networks'
+        )
+        client = self.cluster._client = FakeDetailsClient()
+        groups = ['group%d' % n for n in range(5)]
+        client.GetGroups = lambda bulk=False: [
+            {'name': name, 'alloc_policy': 'preferred', 'node_list': [],
+             'tags': []} for name in groups
+        ]
+        client.GetNetworks = lambda bulk=False: [
+            {'name': 'net%d' % n, 'free_count': 1, 'reserved_count': 0,
+             'group_list': [[name, 'routed', 'rt%d' % n] for name in groups]}
+            for n in range(10)
+        ]
+        Network.objects.create(
+            description='default', cluster=self.cluster, link='rt3',
+            mode='routed', cluster_default=True
+        )
+        for n in range(3):
+            Network.objects.create(
+                description='bridged%d' % n, cluster=self.cluster,
+                link='br%d' % n, mode='bridged'
+            )
+
+    def tearDown(self):
+        hot_cache.delete_many(
+            ['cluster:networks.example.com:%s' % section for section in
+             ('networks', 'nodegroups', 'nodegroups:stack')]
+        )
+
+    def test_networks_are_loaded_once(self):
+        with self.assertNumQueries(1):
+            stack = self.cluster.get_node_group_stack()
+        self.assertEqual(len(stack), 5)
+        networks = stack[0]['networks']
+        self.assertEqual(len(networks), 13)
+        self.assertEqual(
+            [n['link'] for n in networks if n['defaultnet']], ['rt3']
+        )
+        with self.assertNumQueries(0):
+            self.cluster.get_node_group_stack()
+
+    def test_single_group(self):
+        self.cluster.get_networks()
+        with self.assertNumQueries(1):
+            networks = self.cluster.get_node_group_networks('group1')
+        self.assertEqual(
+            [n['network'] for n in networks if n['type'] == 'bridged'],
+            ['bridged0', 'bridged1', 'bridged2']
+        )
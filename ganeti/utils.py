@@ -3,25 +3,35 @@ import requests
 from requests.exceptions import RequestException
 from bs4 import BeautifulSoup
 import json
-from gevent.pool import Pool
+from urllib.parse import quote
 
 from django.conf import settings
 from django.urls import reverse
 from django.core.cache import cache
+from ganeti.permissions import for_user
+from ganeti.snapshots import get_versioned_snapshot
 from django.core.mail import send_mail
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User, Group
-from django.db import close_old_connections
 from django.shortcuts import get_object_or_404
 from django.template.defaultfilters import filesizeformat
 from django.template.loader import render_to_string
+from django.utils.http import RFC3986_SUBDELIMS
 from django.utils.translation import gettext as _
-from ganeti.models import Cluster, Instance, InstanceAction
+from ganeti.models import (
+    Cluster,
+    Instance,
+    InstanceAction,
+    prefetch_cluster_data,
+)
 
 from util.client import GanetiApiError
 
 IMAGES_URL = getattr(settings, "IMAGES_URL", tuple())
 IMG_META_SFX = getattr(settings, "IMG_META_SFX", ".meta")
+INSTANCE_ROW_CACHE_TIMEOUT = getattr(
+    settings, "INSTANCE_ROW_CACHE_TIMEOUT", 600
+)
 
 
 def memsize(value):
@@ -54,18 +64,18 @@ def get_user_instances(user, admin=True, tag=None):
     instances = []
     error = False
 
-    def _get_instances(cluster):
+    clusters = Cluster.objects.filter(disabled=False)
+    errors = prefetch_cluster_data(clusters)
+    for cluster in clusters:
+        if cluster.pk in errors:
+            error = True
+            continue
         try:
             instances.extend(
                 build_instance_list(cluster.get_user_instances(user, admin), tag)
             )
         except (GanetiApiError, Exception):
             error = True
-        finally:
-            close_old_connections()
-    p = Pool(20)
-    clusters = Cluster.objects.filter(disabled=False)
-    p.map(_get_instances, clusters)
     return {'instances': instances, 'errors': error}
 
 
@@ -118,13 +128,16 @@ def prepare_clusternodes(cluster=None):
         clusters = Cluster.objects.filter(disabled=False)
     else:
         clusters = Cluster.objects.filter(slug=cluster.slug)
-    p = Pool(15)
+    clusters = list(clusters)
     nodes = []
     bad_clusters = []
     bad_nodes = []
-
-    def _get_nodes(cluster):
+    # fetch the nodes of the clusters whose cache is cold in one batch
+    errors = prefetch_cluster_data(clusters, nodes=True, instances=False)
+    for cluster in clusters:
         try:
+            if cluster.pk in errors:
+                raise errors[cluster.pk]
             for node in cluster.get_cluster_nodes():
                 nodes.append(node)
                 if node['offline'] is True:
@@ -132,62 +145,82 @@ def prepare_clusternodes(cluster=None):
         except (GanetiApiError, Exception):
             cluster._client = None
             bad_clusters.append(cluster)
-        finally:
-            close_old_connections()
-    p.map(_get_nodes, clusters)
     return nodes, bad_clusters, bad_nodes
 
 
-def generate_json(instance, user, locked_nodes):
-    jresp_list = []
-    i = instance
+def instance_status(i):
+    '''Returns the status text of an instance and its label style'''
+    if i.status == 'ERROR_nodedown':
+        return "Generic cluster error", "important"
+    if i.admin_state == i.oper_state:
+        if i.admin_state:
+            return "Running", "success"
+        return "Stopped", "important"
+    status = "Running" if i.oper_state else "Stopped"
+    if i.admin_state:
+        return "%s, should be running" % status, "warning"
+    return "%s, should be stopped" % status, "warning"
+
+
+class ListingUrls(object):
+    '''
+    Builds the hrefs of the listing rows from URLs reversed once, quoting
+    the arguments the way reverse() does, instead of resolving the URL
+    patterns again for every row.
+    '''
+    def __init__(self):
+        self.instance = reverse(
+            'instance-detail',
+            kwargs={'cluster_slug': '__cluster__', 'instance': '__instance__'}
+        )
+        self.user = reverse(
+            'user-info', kwargs={'type': 'user', 'usergroup': '__name__'}
+        )
+        self.group = reverse(
+            'user-info', kwargs={'type': 'group', 'usergroup': '__name__'}
+        )
+
+    @staticmethod
+    def _quote(value):
+        return quote(value, safe=RFC3986_SUBDELIMS + "/~:@")
+
+    def instance_detail(self, i):
+        return self.instance.replace(
+            '__cluster__', self._quote(i.cluster.slug)
+        ).replace('__instance__', self._quote(i.name))
+
+    def user_info(self, username):
+        return self.user.replace('__name__', self._quote(username))
+
+    def group_info(self, name):
+        return self.group.replace('__name__', self._quote(name))
+
+
+def render_instance_row(i, admin, urls=None):
+    '''
+    Returns the listing row of an instance for admins (admin is True) or
+    owners, without its lock state and the fields that come from the
+    database (see overlay_instance_row).
+    '''
+    if urls is None:
+        urls = ListingUrls()
     inst_dict = {}
     if not i.admin_view_only:
-        inst_dict['name_href'] = "%s" % (
-            reverse(
-                'instance-detail',
-                kwargs={
-                    'cluster_slug': i.cluster.slug, 'instance': i.name
-                }
-            )
-        )
+        inst_dict['name_href'] = urls.instance_detail(i)
     inst_dict['name'] = i.name
-    if user.is_superuser or user.has_perm('ganeti.view_instances'):
+    if admin:
         inst_dict['cluster'] = i.cluster.slug
         inst_dict['pnode'] = i.pnode
         if i.snodes:
             inst_dict['snodes'] = i.snodes
     else:
-        inst_dict['cluster'] = i.cluster.description
         inst_dict['clusterslug'] = i.cluster.slug
-    inst_dict['node_group_locked'] = i.pnode in locked_nodes
     inst_dict['memory'] = memsize(i.beparams['maxmem'])
     inst_dict['disk'] = ", ".join(disksizes(i.disk_sizes))
     inst_dict['vcpus'] = i.beparams['vcpus']
     inst_dict['ipaddress'] = [ip for ip in i.nic_ips if ip]
-    if not user.is_superuser and not user.has_perm('ganeti.view_instances'):
-        inst_dict['ipv6address'] = [ip for ip in i.ipv6s if ip]
     # inst_dict['status'] = i.nic_ips[0] if i.nic_ips[0] else "-"
-    if i.admin_state == i.oper_state:
-        if i.admin_state:
-            inst_dict['status'] = "Running"
-            inst_dict['status_style'] = "success"
-        else:
-            inst_dict['status'] = "Stopped"
-            inst_dict['status_style'] = "important"
-    else:
-        if i.oper_state:
-            inst_dict['status'] = "Running"
-        else:
-            inst_dict['status'] = "Stopped"
-        if i.admin_state:
-            inst_dict['status'] = "%s, should be running" % inst_dict['status']
-        else:
-            inst_dict['status'] = "%s, should be stopped" % inst_dict['status']
-        inst_dict['status_style'] = "warning"
-    if i.status == 'ERROR_nodedown':
-        inst_dict['status'] = "Generic cluster error"
-        inst_dict['status_style'] = "important"
+    inst_dict['status'], inst_dict['status_style'] = instance_status(i)
 
     if i.adminlock:
         inst_dict['adminlock'] = True
@@ -206,19 +239,11 @@ def generate_json(instance, user, locked_nodes):
             except KeyError:
                 pass
 
-    if i.joblock:
-        inst_dict['locked'] = True
-        inst_dict['locked_reason'] = "%s" % ((i.joblock).capitalize())
-        if inst_dict['locked_reason'] in ['Deleting', 'Renaming']:
-            try:
-                del inst_dict['name_href']
-            except KeyError:
-                pass
     if 'cdrom_image_path' in i.hvparams:
         if i.hvparams['cdrom_image_path'] and i.hvparams['boot_order'] == 'cdrom':
             inst_dict['cdrom'] = True
     inst_dict['nic_macs'] = ', '.join(i.nic_macs)
-    if user.is_superuser or user.has_perm('ganeti.view_instances'):
+    if admin:
         inst_dict['nic_links'] = ', '.join(i.nic_links)
         inst_dict['network'] = []
         for (nic_i, link) in enumerate(i.nic_links):
@@ -228,19 +253,27 @@ def generate_json(instance, user, locked_nodes):
                 inst_dict['network'].append(
                     "%s@%s" % (i.nic_ips[nic_i], i.nic_links[nic_i])
                 )
+    return inst_dict
+
+
+def overlay_instance_row(row, i, locked_nodes, admin, urls=None):
+    '''
+    Returns a copy of row with the lock state of the instance and the fields
+    that come from the database: the cluster description and the IPv6
+    addresses, derived from the IPv6 prefixes of the networks, for owners,
+    the users and groups of the instance for admins. These change without
+    the snapshot of the cluster changing, so they are never cached with the
+    row.
+    '''
+    if urls is None:
+        urls = ListingUrls()
+    inst_dict = dict(row)
+    if admin:
         inst_dict['users'] = [
             {
                 'user': user_item.username,
                 'email': user_item.email,
-                'user_href': "%s" % (
-                    reverse(
-                        "user-info",
-                        kwargs={
-                            'type': 'user',
-                            'usergroup': user_item.username
-                        }
-                    )
-                )
+                'user_href': urls.user_info(user_item.username),
             } for user_item in i.users]
         inst_dict['groups'] = [
             {
@@ -248,52 +281,128 @@ def generate_json(instance, user, locked_nodes):
                 'groupusers': [
                     "%s,%s" % (u.username, u.email) for u in group.userset
                 ],
-                'group_href':"%s" % (
-                    reverse(
-                        "user-info",
-                        kwargs={
-                            'type': 'group',
-                            'usergroup': group.name
-                        }
-                    )
-                )
+                'group_href': urls.group_info(group.name),
             } for group in i.groups
         ]
-    jresp_list.append(inst_dict)
-    return jresp_list
+    else:
+        inst_dict['cluster'] = i.cluster.description
+        inst_dict['ipv6address'] = [ip for ip in i.ipv6s if ip]
+    inst_dict['node_group_locked'] = i.pnode in locked_nodes
+    if i.joblock:
+        inst_dict['locked'] = True
+        inst_dict['locked_reason'] = "%s" % ((i.joblock).capitalize())
+        if inst_dict['locked_reason'] in ['Deleting', 'Renaming']:
+            try:
+                del inst_dict['name_href']
+            except KeyError:
+                pass
+    return inst_dict
 
 
-def generate_json_light(instance, user):
-    jresp_list = []
-    i = instance
-    inst_dict = {}
-    if not i.admin_view_only:
-        inst_dict['name_href'] = "%s" % (
-            reverse(
-                "instance-detail",
-                kwargs={
-                    'cluster_slug': i.cluster.slug,
-                    'instance': i.name
-                }
+def instance_row_key(i, admin):
+    '''
+    Returns the cache key of the listing row of an instance, None if the row
+    cannot be cached.
+    '''
+    if i.snapshot_version is None or i.admin_view_only:
+        return None
+    return "cluster:%s:instance:%s:row:%s:%s" % (
+        i.cluster.hostname, i.name, 'admin' if admin else 'owner',
+        i.snapshot_version
+    )
+
+
+def generate_json(instance, user, locked_nodes):
+    admin = for_user(user).admin
+    urls = ListingUrls()
+    # rows only change with the snapshot they are rendered from, and are the
+    # same for every user with the same role
+    key = instance_row_key(instance, admin)
+    row = cache.get(key) if key is not None else None
+    if row is None:
+        row = render_instance_row(instance, admin, urls)
+        if key is not None:
+            cache.set(key, row, INSTANCE_ROW_CACHE_TIMEOUT)
+    return [overlay_instance_row(row, instance, locked_nodes, admin, urls)]
+
+
+def generate_json_rows(instances, user, locked_nodes):
+    '''
+    Returns the listing rows of instances, in the same order, along with
+    the (instance, error) of those that could not be rendered. Same as
+    calling generate_json for each of them, with the permission checks and
+    the cache round trips done once for all of them.
+    '''
+    admin = for_user(user).admin
+    urls = ListingUrls()
+    locked_nodes = set(locked_nodes)
+    keys = [instance_row_key(i, admin) for i in instances]
+    cached = cache.get_many([key for key in keys if key is not None])
+    rendered = {}
+    rows = []
+    errors = []
+    for i, key in zip(instances, keys):
+        row = cached.get(key) if key is not None else None
+        try:
+            if row is None:
+                row = render_instance_row(i, admin, urls)
+                if key is not None:
+                    rendered[key] = row
+            rows.append(
+                overlay_instance_row(row, i, locked_nodes, admin, urls)
             )
-        )
-    inst_dict['name'] = i.name
-    inst_dict['clusterslug'] = i.cluster.slug
-    inst_dict['memory'] = i.beparams['maxmem']
-    inst_dict['vcpus'] = i.beparams['vcpus']
-    inst_dict['disk'] = sum(i.disk_sizes)
-    if user.is_superuser or user.has_perm('ganeti.view_instances'):
-        inst_dict['users'] = [
-            {
-                'user': user_item.username
-            } for user_item in i.users
-        ]
-    jresp_list.append(inst_dict)
-    return jresp_list
+        except Exception as err:
+            errors.append((i, err))
+    if rendered:
+        cache.set_many(rendered, INSTANCE_ROW_CACHE_TIMEOUT)
+    return rows, errors
+
+
+def generate_json_light(instance, user):
+    rows, errors = generate_json_light_rows([instance], user)
+    if errors:
+        raise errors[0][1]
+    return rows
+
+
+def generate_json_light_rows(instances, user, urls=None):
+    '''
+    Returns the rows with the resources of instances, in the same order,
+    along with the (instance, error) of those that could not be rendered.
+    '''
+    admin = for_user(user).admin
+    if urls is None:
+        urls = ListingUrls()
+    rows = []
+    errors = []
+    for i in instances:
+        try:
+            inst_dict = {}
+            if not i.admin_view_only:
+                inst_dict['name_href'] = urls.instance_detail(i)
+            inst_dict['name'] = i.name
+            inst_dict['clusterslug'] = i.cluster.slug
+            inst_dict['memory'] = i.beparams['maxmem']
+            inst_dict['vcpus'] = i.beparams['vcpus']
+            inst_dict['disk'] = sum(i.disk_sizes)
+            if admin:
+                inst_dict['users'] = [
+                    {
+                        'user': user_item.username
+                    } for user_item in i.users
+                ]
+        except Exception as err:
+            errors.append((i, err))
+            continue
+        rows.append(inst_dict)
+    return rows, errors
 
 
 def clear_cluster_user_cache(username, cluster_slug):
-    cache.delete("cluster:%s:instances" % cluster_slug)
+    # the cached instances are keyed by hostname, not slug
+    cluster = Cluster.objects.filter(slug=cluster_slug).first()
+    if cluster is not None:
+        cluster.drop_instances()
 
 
 def notifyuseradvancedactions(
@@ -437,25 +546,49 @@ def refresh_cluster_cache(cluster, instance):
 
 
 def clusterdetails_generator(slug):
+    return assemble_cluster_details(Cluster.objects.get(slug=slug))
+
+
+def assemble_cluster_details(cluster):
+    '''
+    Assembles the details of a cluster from the snapshots of its info,
+    nodes, networks and node groups, which are refreshed independently of
+    each other. The version of every section is returned under 'versions'.
+    '''
     cluster_profile = {}
-    cluster_profile['slug'] = slug
-    cluster = Cluster.objects.get(slug=slug)
+    cluster_profile['slug'] = cluster.slug
     cluster_profile['description'] = cluster.description
     cluster_profile['hostname'] = cluster.hostname
     # We want to fetch info about the cluster per se, networks,
     # nodes and nodegroups plus a really brief instances outline.
     # Nodegroups
-    nodegroups = cluster.get_node_group_stack()
-    nodes = cluster.get_cluster_nodes()
+    nodegroups, nodegroups_version = cluster.get_versioned_node_group_stack()
+    nodes, nodes_version = get_versioned_snapshot(
+        "cluster:{0}:nodes".format(cluster.hostname), cluster.refresh_nodes
+    )
     # Networks
-    networks = cluster.get_networks()
+    networks, networks_version = get_versioned_snapshot(
+        "cluster:{0}:networks".format(cluster.hostname),
+        cluster.refresh_networks
+    )
     # Instances later on...
-    cluster_profile['clusterinfo'] = cluster.get_cluster_info()
-    cluster_profile['clusterinfo']['mtime'] = str(cluster_profile['clusterinfo']['mtime'])
-    cluster_profile['clusterinfo']['ctime'] = str(cluster_profile['clusterinfo']['ctime'])
+    info, info_version = get_versioned_snapshot(
+        "cluster:{0}:info".format(cluster.hostname),
+        cluster.refresh_cluster_info
+    )
+    # the snapshot is shared, change a copy
+    cluster_profile['clusterinfo'] = dict(info)
+    cluster_profile['clusterinfo']['mtime'] = str(info['mtime'])
+    cluster_profile['clusterinfo']['ctime'] = str(info['ctime'])
     cluster_profile['nodegroups'] = nodegroups
     cluster_profile['nodes'] = nodes
     cluster_profile['networks'] = networks
+    cluster_profile['versions'] = {
+        'clusterinfo': info_version,
+        'nodegroups': nodegroups_version,
+        'nodes': nodes_version,
+        'networks': networks_version,
+    }
     return cluster_profile
 
 
@@ -25,6 +25,9 @@ from .discovery import *
 from .nodegroup import *
 
 from ganeti.utils import prepare_tags
+from ganeti import locks
+from ganeti.localcache import hot_cache
+from ganeti.permissions import get_permissions
 from django.core.cache import cache
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User, Group
@@ -95,20 +98,20 @@ def clear_cache(request):
             "cluster:*",
             "pendingapplications",
             "%s:ajax*" % username,
-            "user:%s:index:instance:light" % username,
-            "user:%s:index:users:instance:stats" % username,
             '%s:ajaxapplist' % username,
-            '%s:ajaxinstances' % username,
             "allclusternodes",
             "bad*",
             "len*",
-            "locked_instances",
             "*list",
             "operating_systems",
         ]
         for key in keys_pattern:
             if key in cache:
-                cache.delete(key)
+                hot_cache.delete(key)
+        # the shared keys may have been replaced by other means, drop
+        # whatever every process still holds
+        hot_cache.clear()
+        locks.clear()
         result = {'result': "Success"}
     else:
         result = {'error': "Violation"}
@@ -140,14 +143,8 @@ def tagInstance(request, instance):
         # if not, we must see if the user requested
         # the change, has permissions to do so.
         res = False
-        if (
-            request.user.is_superuser or
-            request.user in instance.users or
-            set.intersection(
-                set(request.user.groups.all()),
-                set(instance.groups)
-            )
-        ):
+        permissions = get_permissions(request)
+        if permissions.is_superuser or permissions.owns(instance):
             res = True
         cache.set(cache_key, res, 90)
         if not res:
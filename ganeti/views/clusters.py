@@ -51,7 +51,12 @@ from ganeti.utils import (
     prepare_clusternodes,
     clusterdetails_generator,
 )
-from ganeti.models import Cluster, InstanceAction, Instance
+from ganeti.models import (
+    Cluster,
+    InstanceAction,
+    Instance,
+    prefetch_cluster_data,
+)
 
 
 def mail_unauthorized_action(action, instance, user):
@@ -69,16 +74,27 @@ def clusternodes_json(request, cluster=None):
         request.user.has_perm('ganeti.view_instances')
     ):
         nodedetails = []
-        jresp = {}
-        nodes = []
         bad_clusters = []
         bad_nodes = []
         if cluster:
-            cluster = get_object_or_404(Cluster, pk=cluster)
-        cache.get('allclusternodes')
-        if not nodes:
-            nodes, bad_clusters, bad_nodes = prepare_clusternodes(cluster)
-            cache.set('allclusternodes', nodes, 90)
+            clusters = [get_object_or_404(Cluster, pk=cluster)]
+        else:
+            # get only enabled clusters
+            clusters = list(Cluster.objects.filter(disabled=False))
+        # the nodes of every cluster are stored already shaped for this
+        # view whenever they are refreshed
+        errors = prefetch_cluster_data(clusters, nodes=True, instances=False)
+        for c in clusters:
+            if c.pk in errors:
+                bad_clusters.append(c)
+                continue
+            try:
+                projection = c.get_node_projection()
+            except Exception:
+                bad_clusters.append(c)
+                continue
+            nodedetails.extend(projection['nodes'])
+            bad_nodes.extend(projection['offline'])
         if bad_clusters:
             messages.add_message(
                 request,
@@ -94,31 +110,10 @@ def clusternodes_json(request, cluster=None):
                 "Some nodes appear to be offline: " +
                 ", ".join(bad_nodes)
             )
-        for node in nodes:
-            if (not cluster or
-                    (cluster and node['cluster'] == cluster.hostname)):
-                node_dict = {}
-                node_dict['name'] = node['name']
-                # node_dict['node_group'] = node['node_group']
-                node_dict['mem_used'] = node['mem_used']
-                node_dict['mfree'] = node['mfree']
-                node_dict['mtotal'] = node['mtotal']
-                node_dict['shared_storage'] = node['shared_storage']
-                node_dict['disk_used'] = node['disk_used']
-                node_dict['dfree'] = node['dfree']
-                node_dict['dtotal'] = node['dtotal']
-                node_dict['ctotal'] = node['ctotal']
-                node_dict['pinst_cnt'] = node['pinst_cnt']
-                node_dict['pinst_list'] = node['pinst_list']
-                node_dict['role'] = node['role']
-                if cluster:
-                    node_dict['cluster'] = cluster.hostname
-                else:
-                    node_dict['cluster'] = node['cluster']
-                nodedetails.append(node_dict)
-        jresp['aaData'] = nodedetails
-        res = jresp
-        return HttpResponse(json.dumps(res), content_type='application/json')
+        return HttpResponse(
+            json.dumps({'aaData': nodedetails}),
+            content_type='application/json'
+        )
     else:
         raise PermissionDenied
 
@@ -379,30 +374,30 @@ def clusterdetails_json(request):
     if request.user.is_superuser or request.user.has_perm('ganeti.view_instances'):
         if request.GET.get('cluster'):
             cluster_slug = request.GET.get('cluster')
-            cluster_details = cache.get("cluster:%s:clusterdetails" % (cluster_slug))
-            if not cluster_details:
-                try:
-                    cluster_details = clusterdetails_generator(cluster_slug)
-                except GanetiApiError as e:
-                    messages.add_message(
-                        request,
-                        messages.ERROR,
-                        '%s: %s' %
-                        (
-                            cluster_slug,
-                            format_ganeti_api_error(e)
-                        )
+            # every section is cached on its own and refreshed in the
+            # background once stale, so assembling them is cheap
+            cluster_details = None
+            try:
+                cluster_details = clusterdetails_generator(cluster_slug)
+            except GanetiApiError as e:
+                messages.add_message(
+                    request,
+                    messages.ERROR,
+                    '%s: %s' %
+                    (
+                        cluster_slug,
+                        format_ganeti_api_error(e)
                     )
-                except Exception as e:
-                    messages.add_message(
-                        request,
-                        messages.ERROR,
-                        '%s' %
-                        (
-                            e
-                        )
+                )
+            except Exception as e:
+                messages.add_message(
+                    request,
+                    messages.ERROR,
+                    '%s' %
+                    (
+                        e
                     )
-                cache.set("cluster:%s:clusterdetails" % (cluster_slug), cluster_details, 3600 * 24)
+                )
             return HttpResponse(
                 json.dumps(cluster_details),
                 content_type='application/json'
@@ -17,7 +17,6 @@
 
 import json
 
-from gevent.pool import Pool
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.messages import constants as msgs
 from django.contrib import messages as djmessages
@@ -41,9 +40,11 @@ from auditlog.utils import auditlog_entry
 
 from util.client import GanetiApiError
 
+from ganeti import listing, locks
+from ganeti.permissions import get_permissions
+from ganeti.rollups import add_totals, new_totals
 from ganeti.utils import (
-    generate_json,
-    generate_json_light,
+    generate_json_rows,
     clear_cluster_user_cache,
     notifyuseradvancedactions,
     get_os_details,
@@ -128,7 +129,7 @@ def user_index_json(request):
             )
         }
         return HttpResponse(json.dumps(action), content_type='application/json')
-    p = Pool(20)
+    permissions = get_permissions(request)
     instances = []
     bad_clusters = []
     bad_instances = []
@@ -141,7 +142,7 @@ def user_index_json(request):
                 if cluster_locked_nodes:
                     locked_clusters.append(str(cluster.description))
                     locked_nodes.extend(cluster_locked_nodes)
-                instances.extend(cluster.get_user_instances(request.user))
+                instances.extend(cluster.get_user_instances(permissions))
             except GanetiApiError as e:
                 bad_clusters.append((cluster, format_ganeti_api_error(e)))
             except Exception as e:
@@ -149,34 +150,20 @@ def user_index_json(request):
             finally:
                 close_old_connections()
     jresp = {}
-    instancedetails = []
-    j = Pool(80)
-    locked_instances = cache.get('locked_instances')
-
-    def _get_instance_details(instance):
-        try:
-            if (
-                locked_instances is not None and
-                instance.name in locked_instances
-            ):
-                instance.joblock = locked_instances['%s' % instance.name]
-            else:
-                instance.joblock = False
-            instancedetails.extend(generate_json(instance, request.user, locked_nodes))
-        except GanetiApiError as e:
-            bad_clusters.append((instance.cluster, format_ganeti_api_error(e)))
-        except Exception as e:
-                bad_clusters.append((instance.cluster, e))
-        finally:
-            close_old_connections()
-
     if not request.user.is_anonymous:
         if cluster_slug:
             clusters = Cluster.objects.filter(slug=cluster_slug)
         else:
             # get only enabled clusters
             clusters = Cluster.objects.filter(disabled=False)
-        p.map(_get_instances, clusters)
+        errors = prefetch_cluster_data(clusters, node_groups=True)
+        for cluster in clusters:
+            if cluster.pk in errors:
+                bad_clusters.append(
+                    (cluster, format_ganeti_api_error(errors[cluster.pk]))
+                )
+            else:
+                _get_instances(cluster)
     cache_timeout = 900
     if bad_clusters:
         if request.user.is_superuser:
@@ -211,7 +198,26 @@ def user_index_json(request):
             pass
 
         cache_timeout = 30
-    j.map(_get_instance_details, instances)
+    if 'sEcho' in request.GET:
+        # server-side processing, only the page shown is serialized
+        total, filtered, instances = listing.get_page(
+            instances, permissions, request.GET
+        )
+        jresp['sEcho'] = listing.parse_params(request.GET)['echo']
+        jresp['iTotalRecords'] = total
+        jresp['iTotalDisplayRecords'] = filtered
+    locked_instances = locks.get_locked_instances(
+        instance.name for instance in instances
+    )
+    for instance in instances:
+        instance.joblock = locked_instances.get(instance.name, False)
+    instancedetails, row_errors = generate_json_rows(
+        instances, permissions, locked_nodes
+    )
+    for instance, e in row_errors:
+        if isinstance(e, GanetiApiError):
+            e = format_ganeti_api_error(e)
+        bad_clusters.append((instance.cluster, e))
     if locked_clusters:
         djmessages.add_message(
             request,
@@ -244,23 +250,35 @@ def user_sum_stats(request):
             )
         }
         return HttpResponse(json.dumps(action), content_type='application/json')
-    p = Pool(20)
-    instances = []
+    permissions = get_permissions(request)
+    # username -> totals of the instances the user can see
+    user_totals = {}
     bad_clusters = []
 
-    def _get_instances(cluster):
+    def _add_rollup(cluster):
         try:
-            instances.extend(cluster.get_user_instances(request.user))
+            totals, created, users = cluster.get_user_rollup(permissions)
         except GanetiApiError as e:
             bad_clusters.append((cluster, format_ganeti_api_error(e)))
+            return
         except Exception as e:
             bad_clusters.append((cluster, e))
-
-        finally:
-            close_old_connections()
+            return
+        if users is None:
+            users = {request.user.username: totals}
+        for username, owned in users.items():
+            add_totals(user_totals.setdefault(username, new_totals()), owned)
     if not request.user.is_anonymous:
         # get only enabled clusters
-        p.map(_get_instances, Cluster.objects.filter(disabled=False))
+        clusters = Cluster.objects.filter(disabled=False)
+        errors = prefetch_cluster_data(clusters)
+        for cluster in clusters:
+            if cluster.pk in errors:
+                bad_clusters.append(
+                    (cluster, format_ganeti_api_error(errors[cluster.pk]))
+                )
+            else:
+                _add_rollup(cluster)
 
     if bad_clusters:
         for c in bad_clusters:
@@ -294,77 +312,27 @@ def user_sum_stats(request):
                     )
                 )
 
-    jresp = {}
-    cache_key = "user:%s:index:instance:light" % request.user.username
-    res = cache.get(cache_key)
-    instancedetails = []
-    j = Pool(80)
-    user = request.user
-
-    def _get_instance_details(instance):
-        try:
-            instancedetails.extend(generate_json_light(instance, user))
-        except (GanetiApiError, Exception):
-            pass
-        finally:
-            close_old_connections()
-    if res is None:
-        j.map(_get_instance_details, instances)
-        jresp['aaData'] = instancedetails
-        cache.set(cache_key, jresp, 125)
-        res = jresp
-
-    instances_stats = []
-    user_dict = {}
-    cache_key_stats = "user:%s:index:users:instance:stats" % \
-        request.user.username
-    instances_stats = cache.get(cache_key_stats)
-    if instances_stats is None:
-        for i in res['aaData']:
-            if not 'users' in i:
-                i['users'] = [{'user': request.user.username}]
-            for useritem in i['users']:
-                if not useritem['user'] in user_dict:
-                    user_dict[useritem['user']] = {
-                        'instances': 0,
-                        'disk': 0,
-                        'cpu': 0,
-                        'memory': 0
-                    }
-                user_dict[useritem['user']]['instances'] = user_dict[
-                    useritem['user']
-                ]['instances'] + 1
-                user_dict[useritem['user']]['disk'] = user_dict[
-                    useritem['user']
-                ]['disk'] + int(i['disk'])
-                user_dict[useritem['user']]['cpu'] = user_dict[
-                    useritem['user']
-                ]['cpu'] + int(i['vcpus'])
-                user_dict[useritem['user']]['memory'] = user_dict[
-                    useritem['user']
-                ]['memory'] + int(i['memory'])
-        #TODO: Must implement that in a more efficient way
-        instances_stats_list = []
-        for u in user_dict.keys():
-            user_stats_dict = {}
-            user_stats_dict['user_href'] = '%s' % (
-                reverse(
-                    'user-info',
-                    kwargs={
-                        'type': 'user',
-                        'usergroup': u
-                    }
-                )
-            )
-            user_stats_dict['user'] = u
-            user_stats_dict['instances'] = user_dict[u]['instances']
-            user_stats_dict['disk'] = user_dict[u]['disk']
-            user_stats_dict['cpu'] = user_dict[u]['cpu']
-            user_stats_dict['memory'] = user_dict[u]['memory']
-            instances_stats_list.append(user_stats_dict)
-        return_dict = {'aaData': instances_stats_list}
-        cache.set(cache_key_stats, return_dict, 300)
-        instances_stats = return_dict
+    # tags may name users that do not exist
+    known_users = preload_instance_data()['users']
+    instances_stats_list = []
+    for u, totals in user_totals.items():
+        if not totals['instances'] or known_users.get(u) is None:
+            continue
+        instances_stats_list.append({
+            'user_href': reverse(
+                'user-info',
+                kwargs={
+                    'type': 'user',
+                    'usergroup': u
+                }
+            ),
+            'user': u,
+            'instances': totals['instances'],
+            'disk': totals['disk'],
+            'cpu': totals['vcpus'],
+            'memory': totals['memory'],
+        })
+    instances_stats = {'aaData': instances_stats_list}
     return HttpResponse(
         json.dumps(instances_stats),
         content_type='application/json'
@@ -375,13 +343,8 @@ def user_sum_stats(request):
 def poll(request, cluster_slug, instance):
         cluster = get_object_or_404(Cluster, slug=cluster_slug)
         instance = cluster.get_instance_or_404(instance)
-        if (
-            request.user.is_superuser or
-            request.user in instance.users or
-            set.intersection(
-                set(request.user.groups.all()), set(instance.groups)
-            )
-        ):
+        permissions = get_permissions(request)
+        if permissions.is_superuser or permissions.owns(instance):
             try:
                 instance.osname = instance.osparams['img_id']
             except Exception:
@@ -395,7 +358,7 @@ def poll(request, cluster_slug, instance):
                     'instance': instance,
                 },
             )
-        elif request.user.has_perm('ganeti.view_instances'):
+        elif permissions.view_instances:
             return render(
                 request,
                 'instances/includes/instance_status.html',
@@ -735,10 +698,9 @@ def instance(request, cluster_slug, instance):
     ret_dict = {'cluster': cluster,
                 'instance': instance
                 }
-    if not request.user.has_perm('ganeti.view_instances') or (
-        request.user.is_superuser or
-        request.user in instance.users or
-        set.intersection(set(request.user.groups.all()), set(instance.groups))
+    permissions = get_permissions(request)
+    if not permissions.view_instances or (
+        permissions.is_superuser or permissions.owns(instance)
     ):
             ret_dict['configform'] = configform
     return render(
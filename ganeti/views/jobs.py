@@ -18,12 +18,10 @@
 import json
 import pprint
 
-from gevent.pool import Pool
 
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse
 from django.contrib import messages as djmessages
-from django.db import close_old_connections
 from django.http import HttpResponseRedirect, HttpResponse, Http404
 from django.shortcuts import render, get_object_or_404
 from django.template.context import RequestContext
@@ -31,7 +29,7 @@ from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import PermissionDenied
 
 from util.client import GanetiApiError
-from ganeti.models import Cluster
+from ganeti.models import Cluster, get_job_lists
 from ganeti.utils import format_ganeti_api_error
 
 
@@ -68,25 +66,21 @@ def jobs_index_json(request):
     ):
         cluster_slug = request.GET.get('cluster', None)
         messages = ""
-        p = Pool(20)
         jobs = []
         bad_clusters = []
 
-        def _get_jobs(cluster):
-            try:
-                jobs.extend(cluster.get_job_list())
-            except GanetiApiError as e:
-                bad_clusters.append((cluster, format_ganeti_api_error(e)))
-            except Exception as e:
-                bad_clusters.append((cluster, e))
-            finally:
-                close_old_connections()
         if not request.user.is_anonymous:
             # get only enabled clusters
             clusters = Cluster.objects.filter(disabled=False)
             if cluster_slug:
                 clusters = clusters.filter(slug=cluster_slug)
-            p.map(_get_jobs, clusters)
+            for cluster, result in get_job_lists(clusters):
+                if isinstance(result, GanetiApiError):
+                    bad_clusters.append(
+                        (cluster, format_ganeti_api_error(result))
+                    )
+                else:
+                    jobs.extend(result)
         if bad_clusters:
             messages = "Some instances may be missing because the" \
                 " following clusters are unreachable: %s" \
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*- vim:fileencoding=utf-8:
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from ganeti.permissions import PermissionContext
+
+
+class PermissionContextMiddleware(object):
+    """
+    Sets request.permissions, the permissions of request.user checked at
+    most once per request. Must come after AuthenticationMiddleware.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # nothing is checked until it is needed, so that requests which
+        # never look at permissions do not pay for them
+        request.permissions = PermissionContext(request.user)
+        return self.get_response(request)
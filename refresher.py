@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*- vim:fileencoding=utf-8:
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Keeps the cached snapshot of every enabled cluster (instances, nodes, node
+# groups, networks and cluster info) warm, so that web requests read listings
+# from the cache instead of calling RAPI themselves.
+
+import sys
+import random
+
+from gevent import monkey
+monkey.patch_all()
+
+from gevent import sleep, spawn
+from gevent.lock import BoundedSemaphore
+
+import os
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ganetimgr.settings")
+from django.conf import settings
+import django
+django.setup()
+
+from ganeti.models import Cluster
+from util import daemons
+from django.db import close_old_connections
+
+logger = None
+
+DEFAULT_WORKERS = 10
+DEFAULT_PID_FILE = "/var/run/ganetimgr-refresher.pid"
+DEFAULT_LOG_FILE = "/var/log/ganetimgr/refresher.log"
+REFRESH_INTERVAL = getattr(settings, "REFRESHER_INTERVAL", 60)
+# Cached data must outlive a refresh interval (and a failed refresh or two),
+# otherwise web requests would hit RAPI on a cache miss between refreshes
+REFRESH_CACHE_TIMEOUT = getattr(settings, "REFRESHER_CACHE_TIMEOUT",
+                                5 * REFRESH_INTERVAL)
+MAX_BACKOFF = 600
+CLUSTER_SCAN_INTERVAL = 60
+
+# What to refresh for every cluster, in order
+REFRESH_STEPS = (
+    "refresh_cluster_info",
+    "refresh_instances",
+    "refresh_nodes",
+    "refresh_node_groups",
+    "refresh_networks",
+)
+
+
+def jitter(interval):
+    # Spread the refreshes of the clusters over the interval, instead of
+    # hitting every master at the same time
+    return random.uniform(0, interval / 4.0)
+
+
+def refresh_cluster(cluster):
+    failed = False
+    for step in REFRESH_STEPS:
+        try:
+            getattr(cluster, step)(seconds=REFRESH_CACHE_TIMEOUT)
+        except Exception as err:
+            logger.warn("%s failed for cluster %s: %s" %
+                        (step, cluster.hostname, str(err)))
+            failed = True
+    return not failed
+
+
+def cluster_refresher(cluster_id, slots, clusters):
+    failures = 0
+    sleep(jitter(REFRESH_INTERVAL))
+    try:
+        while True:
+            try:
+                cluster = Cluster.objects.get(pk=cluster_id, disabled=False)
+            except Cluster.DoesNotExist:
+                logger.info("Cluster %d removed or disabled, no longer"
+                            " refreshing it" % cluster_id)
+                return
+            finally:
+                close_old_connections()
+
+            with slots:
+                logger.debug("Refreshing cluster %s" % cluster.hostname)
+                ok = refresh_cluster(cluster)
+                close_old_connections()
+
+            if ok:
+                failures = 0
+                delay = REFRESH_INTERVAL
+            else:
+                # Back off from clusters that keep failing
+                failures += 1
+                delay = min(REFRESH_INTERVAL * 2 ** failures, MAX_BACKOFF)
+                logger.info("Refreshing cluster %s failed %d time(s),"
+                            " retrying in %d seconds" %
+                            (cluster.hostname, failures, delay))
+            sleep(delay + jitter(REFRESH_INTERVAL))
+    finally:
+        clusters.pop(cluster_id, None)
+
+
+def refresh_clusters(workers):
+    slots = BoundedSemaphore(workers)
+    clusters = {}
+    while True:
+        try:
+            cluster_ids = list(
+                Cluster.objects.filter(disabled=False)
+                .values_list("pk", flat=True)
+            )
+        except Exception as err:
+            logger.error("Error listing clusters: %s" % str(err))
+            cluster_ids = []
+        finally:
+            close_old_connections()
+
+        for cluster_id in cluster_ids:
+            if cluster_id not in clusters:
+                logger.info("Refreshing cluster %d every %d seconds" %
+                            (cluster_id, REFRESH_INTERVAL))
+                clusters[cluster_id] = spawn(cluster_refresher, cluster_id,
+                                             slots, clusters)
+        sleep(CLUSTER_SCAN_INTERVAL)
+
+
+def parse_arguments(args):
+    parser = daemons.option_parser(DEFAULT_PID_FILE, DEFAULT_LOG_FILE)
+    parser.add_option("-w", "--workers", dest="workers", type="int",
+                      default=DEFAULT_WORKERS, metavar="NUM",
+                      help="The number of clusters refreshed"
+                           " simultaneously (default: %d)" % DEFAULT_WORKERS)
+    return parser.parse_args(args)
+
+
+def main():
+    opts, args = parse_arguments(sys.argv[1:])
+
+    global logger
+    logger, context = daemons.start("refresher", opts)
+    refresh_clusters(opts.workers)
+
+
+if __name__ == "__main__":
+    main()
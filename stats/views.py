@@ -17,18 +17,17 @@
 from time import mktime
 import json
 from gevent.timeout import Timeout
-from gevent.pool import Pool
-from operator import itemgetter
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User, Group
 from django.core.cache import cache
-from django.db import close_old_connections
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render, get_object_or_404
 from django.urls import reverse
 
-from ganeti.models import Cluster
+from ganeti.models import Cluster, prefetch_cluster_data
+from ganeti.permissions import get_permissions
+from ganeti.rollups import creation_series
 from apply.models import InstanceApplication, Organization
 
 from util.client import GanetiApiError
@@ -36,23 +35,28 @@ from util.client import GanetiApiError
 
 def instance_owners(request):
     if request.user.is_superuser or request.user.has_perm('ganeti.view_instances'):
-        p = Pool(20)
         instancesall = []
         bad_clusters = []
 
-        def _get_instances(cluster):
-            try:
-                instancesall.extend(cluster.get_user_instances(request.user))
-            except (GanetiApiError, Exception):
-                bad_clusters.append(cluster)
         if not request.user.is_anonymous:
-            p.map(_get_instances, Cluster.objects.all())
+            clusters = list(Cluster.objects.all())
+            # fetch the instances of the clusters whose cache is cold in one
+            # batch
+            errors = prefetch_cluster_data(clusters)
+            for cluster in clusters:
+                if cluster.pk in errors:
+                    bad_clusters.append(cluster)
+                    continue
+                try:
+                    instancesall.extend(
+                        cluster.get_user_instances(request.user)
+                    )
+                except (GanetiApiError, Exception):
+                    bad_clusters.append(cluster)
         instances = [i for i in instancesall if i.users]
-
-        def cmp_users(x, y):
-            return cmp(",".join([u.username for u in x.users]),
-                       ",".join([u.username for u in y.users]))
-        instances.sort(cmp=cmp_users)
+        instances.sort(
+            key=lambda i: ",".join([u.username for u in i.users])
+        )
 
         return render(
             request,
@@ -90,76 +94,40 @@ def stats_ajax_applications(request):
 
 @login_required
 def stats_ajax_instances(request):
-    username = request.user.username
-    cluster_list = cache.get('%s:ajaxinstances' % username)
-    if cluster_list is None:
-        # get only enabled clusters
-        clusters = Cluster.objects.filter(disabled=False)
-        i = 0
-        cluster_list = []
-        for cluster in clusters:
-            cinstances = []
-            i = 0
-            cluster_dict = {}
-            if (
-                request.user.is_superuser or
-                request.user.has_perm('ganeti.view_instances')
-            ):
-                cluster_dict['name'] = cluster.slug
-            else:
-                cluster_dict['name'] = cluster.description
-            cluster_dict['instances'] = []
-            try:
-                cinstances.extend(cluster.get_user_instances(request.user))
-            except (GanetiApiError, Timeout):
-                cinstances = []
-            for instance in cinstances:
-                inst_dict = {}
-                inst_dict['time'] = (1000 * mktime(instance.ctime.timetuple()))
-                inst_dict['name'] = instance.name
-                cluster_dict['instances'].append(inst_dict)
-            cluster_dict['instances'] = sorted(
-                cluster_dict['instances'],
-                key=itemgetter('time')
-            )
-            for item in cluster_dict['instances']:
-                i = i + 1
-                item['count'] = i
-            if len(cinstances) > 0:
-                cluster_list.append(cluster_dict)
-        cache.set('%s:ajaxinstances' % username, cluster_list, 90)
+    permissions = get_permissions(request)
+    # get only enabled clusters
+    clusters = Cluster.objects.filter(disabled=False)
+    cluster_list = []
+    for cluster in clusters:
+        cluster_dict = {}
+        if permissions.admin:
+            cluster_dict['name'] = cluster.slug
+        else:
+            cluster_dict['name'] = cluster.description
+        try:
+            created = cluster.get_user_rollup(permissions)[1]
+        except (GanetiApiError, Timeout):
+            created = {}
+        cluster_dict['instances'] = [
+            {'time': time, 'created': count, 'count': so_far}
+            for time, count, so_far in creation_series(created)
+        ]
+        if created:
+            cluster_list.append(cluster_dict)
     return HttpResponse(json.dumps(cluster_list), content_type='application/json')
 
 
 @login_required
 def stats_ajax_vms_per_cluster(request, cluster_slug):
-    cluster_dict = cache.get('%s:ajaxvmscluster:%s' % (
-        request.user.username,
-        cluster_slug)
-    )
-    if cluster_dict is None:
-        cluster = get_object_or_404(Cluster, slug=cluster_slug)
-        cluster_dict = {}
-        cluster_dict['name'] = cluster.slug
-        cluster_dict['instances'] = {'up': 0, 'down': 0}
-        cinstances = []
-        try:
-            cinstances.extend(cluster.get_user_instances(request.user))
-        except (GanetiApiError, Timeout):
-            return HttpResponse(json.dumps([]), content_type='application/json')
-        for instance in cinstances:
-            if instance.admin_state:
-                cluster_dict['instances']['up'] = cluster_dict['instances']['up'] + 1
-            else:
-                cluster_dict['instances']['down'] = cluster_dict['instances']['down'] + 1
-        cache.set(
-            '%s:ajaxvmscluster:%s' % (
-                request.user.username,
-                cluster_slug
-            ),
-            cluster_dict,
-            90
-        )
+    cluster = get_object_or_404(Cluster, slug=cluster_slug)
+    try:
+        totals = cluster.get_user_rollup(get_permissions(request))[0]
+    except (GanetiApiError, Timeout):
+        return HttpResponse(json.dumps([]), content_type='application/json')
+    cluster_dict = {
+        'name': cluster.slug,
+        'instances': {'up': totals['up'], 'down': totals['down']},
+    }
     return HttpResponse(json.dumps(cluster_dict), content_type='application/json')
 
 
@@ -169,22 +137,17 @@ def stats(request):
     clusters = Cluster.objects.filter(disabled=False)
     exclude_pks = []
     if (request.user.is_superuser or request.user.has_perm('ganeti.view_instances')):
-        instances = cache.get('leninstances')
-        if instances is None:
-            p = Pool(20)
-            instances = []
-
-            def _get_instances(cluster):
+        instances = 0
+        if not request.user.is_anonymous:
+            errors = prefetch_cluster_data(clusters)
+            exclude_pks.extend(errors.keys())
+            for cluster in clusters:
+                if cluster.pk in errors:
+                    continue
                 try:
-                    instances.extend(cluster.get_user_instances(request.user))
+                    instances += cluster.get_rollup()['total']['instances']
                 except (GanetiApiError, Exception):
                     exclude_pks.append(cluster.pk)
-                finally:
-                    close_old_connections()
-            if not request.user.is_anonymous:
-                p.map(_get_instances, clusters)
-            instances = len(instances)
-            cache.set('leninstances', instances, 90)
         users = cache.get('lenusers')
         if users is None:
             users = len(User.objects.all())
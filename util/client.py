@@ -42,7 +42,11 @@
 # No Ganeti-specific modules should be imported. The RAPI client is supposed to
 # be standalone.
 
+import codecs
+import collections
 import logging
+import re
+import select
 import socket
 import threading
 import time
@@ -181,6 +185,26 @@ _CURL_SSL_CERT_ERRORS = frozenset([
   _CURLE_SSL_CACERT_BADFILE,
   ])
 
+#: Default number of idle cURL handles kept per pool
+CURL_POOL_MAXSIZE = 8
+
+#: Default number of seconds an idle cURL handle is kept around
+CURL_POOL_MAX_IDLE = 60
+
+#: Default maximum number of concurrent RAPI transfers per process
+MAX_IN_FLIGHT = 32
+
+#: Default number of seconds a request without a deadline waits for one of
+#: the L{MAX_IN_FLIGHT} transfer slots
+SLOT_TIMEOUT = 60
+
+# Older libcurl versions can't share their connection cache between handles
+try:
+  _CURL_SHARED_DATA = (pycurl.LOCK_DATA_DNS, pycurl.LOCK_DATA_SSL_SESSION,
+                       pycurl.LOCK_DATA_CONNECT)
+except AttributeError:
+  _CURL_SHARED_DATA = (pycurl.LOCK_DATA_DNS, pycurl.LOCK_DATA_SSL_SESSION)
+
 
 class Error(Exception):
   """Base error class for this module.
@@ -412,6 +436,605 @@ class _CompatIO(object):
     return self.buffer.seek(*args, **kwargs)
 
 
+class CurlPool(object):
+  """Pool of reusable cURL handles.
+
+  libcurl keeps the connection (and TLS session) of an easy handle alive after
+  a transfer, so handing the same handle to subsequent requests against the
+  same cluster master skips the TCP and TLS setup. Handles are checked out for
+  exclusive use by a single request and checked back in afterwards, which makes
+  the pool safe to share between threads and greenlets.
+
+  """
+  def __init__(self, maxsize=CURL_POOL_MAXSIZE, max_idle=CURL_POOL_MAX_IDLE,
+               _time_fn=time.time):
+    """Initializes this class.
+
+    @type maxsize: int
+    @param maxsize: maximum number of idle handles kept in the pool
+    @type max_idle: number
+    @param max_idle: seconds after which an idle handle is closed
+
+    """
+    self._maxsize = maxsize
+    self._max_idle = max_idle
+    self._time_fn = _time_fn
+    self._lock = threading.Lock()
+    self._idle = collections.deque()
+    # Transfers are driven through short-lived multi handles, which would
+    # otherwise each keep their own connection cache
+    self._share = pycurl.CurlShare()
+    for data in _CURL_SHARED_DATA:
+      self._share.setopt(pycurl.SH_SHARE, data)
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.discards = 0
+
+  def _EvictIdle(self, now):
+    """Closes handles which have been idle for too long.
+
+    Must be called with the pool lock held. The oldest handles are at the left
+    end of the queue.
+
+    """
+    while self._idle and now - self._idle[0][1] > self._max_idle:
+      curl, _ = self._idle.popleft()
+      curl.close()
+      self.evictions += 1
+
+  def Checkout(self, factory):
+    """Returns a handle for exclusive use.
+
+    @type factory: callable
+    @param factory: function creating a new, configured handle on pool misses
+    @rtype: pycurl.Curl
+
+    """
+    with self._lock:
+      self._EvictIdle(self._time_fn())
+      if self._idle:
+        # Most recently used handles are the most likely to still have a live
+        # connection
+        curl, _ = self._idle.pop()
+        self.hits += 1
+        return curl
+      self.misses += 1
+
+    curl = factory()
+    curl.setopt(pycurl.SHARE, self._share)
+    return curl
+
+  def Checkin(self, curl, healthy=True):
+    """Returns a handle to the pool.
+
+    @type curl: pycurl.Curl
+    @param curl: handle previously returned by L{Checkout}
+    @type healthy: bool
+    @param healthy: whether the last transfer on this handle succeeded at the
+                    transport level; unhealthy handles are closed
+
+    """
+    if not healthy:
+      curl.close()
+      with self._lock:
+        self.discards += 1
+      return
+
+    with self._lock:
+      now = self._time_fn()
+      self._EvictIdle(now)
+      if len(self._idle) < self._maxsize:
+        self._idle.append((curl, now))
+        return
+      self.evictions += 1
+
+    curl.close()
+
+  def Clear(self):
+    """Closes all idle handles.
+
+    """
+    with self._lock:
+      while self._idle:
+        curl, _ = self._idle.pop()
+        curl.close()
+
+  def Stats(self):
+    """Returns the pool counters.
+
+    @rtype: dict
+
+    """
+    with self._lock:
+      return {
+        "idle": len(self._idle),
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "discards": self.discards,
+        }
+
+
+_in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+
+def SetMaxInFlight(limit):
+  """Sets the maximum number of concurrent RAPI transfers of this process.
+
+  Must be called during initialization, before any request is sent.
+
+  @type limit: int
+  @param limit: maximum number of transfers in flight
+
+  """
+  global _in_flight # pylint: disable=W0603
+  _in_flight = threading.BoundedSemaphore(limit)
+
+
+def _Remaining(deadline):
+  """Returns the seconds left until a deadline, None if there is none.
+
+  """
+  if deadline is None:
+    return None
+  return max(0, deadline - time.time())
+
+
+class _QueryRowDecoder(object):
+  """Incremental decoder for the rows of a query response.
+
+  Query responses are JSON objects with a "data" member listing one row per
+  resource. The raw response is fed to the decoder in chunks, as received,
+  and every row is decoded and appended to L{rows} as soon as it is complete.
+  Neither the whole response nor its decoded form is ever held in memory. The
+  rest of the response is kept as text, with an empty "data" list, and is
+  returned by L{GetRemainder}.
+
+  """
+  _SPECIAL_RE = re.compile(r'["\\\[\]{}]')
+  _STRING_RE = re.compile(r'["\\]')
+
+  def __init__(self):
+    self.rows = collections.deque()
+    self._utf8 = codecs.getincrementaldecoder("utf-8")()
+    self._depth = 0
+    self._in_string = False
+    self._escape = False
+    # Inside the top-level "data" list
+    self._in_data = False
+    # Pieces of the top-level string (key) being read
+    self._key = None
+    self._last_key = None
+    # Pieces of the row being read
+    self._row = None
+    self._rest = []
+
+  def _Append(self, text):
+    if self._row is not None:
+      self._row.append(text)
+    elif not (self._in_data and self._depth == 2):
+      # Separators between rows are dropped
+      self._rest.append(text)
+
+  def Feed(self, data):
+    """Decodes a chunk of the response.
+
+    @type data: bytes or str
+    @param data: next chunk of the response
+
+    """
+    if isinstance(data, bytes):
+      data = self._utf8.decode(data)
+
+    start = 0
+    key_start = 0
+    pos = 0
+    end = len(data)
+
+    while pos < end:
+      if self._in_string:
+        if self._escape:
+          self._escape = False
+          pos += 1
+          continue
+        match = self._STRING_RE.search(data, pos)
+        if not match:
+          break
+        pos = match.end()
+        if match.group() == "\\":
+          self._escape = True
+        else:
+          self._in_string = False
+          if self._key is not None:
+            self._key.append(data[key_start:pos - 1])
+            self._last_key = "".join(self._key)
+            self._key = None
+        continue
+
+      match = self._SPECIAL_RE.search(data, pos)
+      if not match:
+        break
+      char = match.group()
+      pos = match.end()
+
+      if char == '"':
+        self._in_string = True
+        if self._depth == 1:
+          self._key = []
+          key_start = pos
+      elif char in "[{":
+        if self._in_data and self._depth == 2:
+          # Start of a row
+          self._Append(data[start:match.start()])
+          start = match.start()
+          self._row = []
+        elif self._depth == 1 and char == "[" and self._last_key == "data":
+          self._Append(data[start:pos])
+          start = pos
+          self._in_data = True
+        self._depth += 1
+      else:
+        self._depth -= 1
+        if self._row is not None and self._depth == 2:
+          # End of a row
+          self._row.append(data[start:pos])
+          self.rows.append(simplejson.loads("".join(self._row)))
+          self._row = None
+          start = pos
+        elif self._in_data and self._depth == 1:
+          # End of the "data" list
+          start = match.start()
+          self._in_data = False
+
+    if self._key is not None:
+      self._key.append(data[key_start:])
+    self._Append(data[start:])
+
+  def GetRemainder(self):
+    """Returns the response without its rows.
+
+    @rtype: str
+
+    """
+    return "".join(self._rest)
+
+
+class _RapiTransfer(object):
+  """A single RAPI request driven by L{_PerformTransfers}.
+
+  """
+  def __init__(self, client, method, path, query, content, deadline=None,
+               decoder=None):
+    assert path.startswith("/")
+
+    self.client = client
+    self.method = method
+    self.deadline = deadline
+    self.decoder = decoder
+    self.curl = None
+    self.result = None
+    self.error = None
+
+    if content is not None:
+      self.encoded_content = client._json_encoder.encode(content)
+    else:
+      self.encoded_content = ""
+
+    # Build URL
+    urlparts = [client._base_url, path]
+    if query:
+      urlparts.append("?")
+      urlparts.append(urlencode(client._EncodeQuery(query)))
+
+    self.url = "".join(urlparts)
+
+    # Buffer for response
+    self.encoded_resp_body = _CompatIO()
+
+  def Start(self):
+    """Checks out and configures the cURL object of this request.
+
+    @rtype: pycurl.Curl
+
+    """
+    self.client._logger.debug("Sending request %s %s (content=%r)",
+                              self.method, self.url, self.encoded_content)
+
+    curl = self.client._CheckoutCurl()
+    curl.setopt(pycurl.CUSTOMREQUEST, str(self.method))
+    curl.setopt(pycurl.URL, str(self.url))
+    curl.setopt(pycurl.POSTFIELDS, str(self.encoded_content))
+    if self.decoder is not None:
+      curl.setopt(pycurl.WRITEFUNCTION, self.decoder.Feed)
+    else:
+      curl.setopt(pycurl.WRITEFUNCTION, self.encoded_resp_body.write)
+    self.curl = curl
+    return curl
+
+  def Finish(self, errno=None, errmsg=None):
+    """Releases the cURL object and decodes the response.
+
+    @type errno: int
+    @param errno: cURL error code if the transfer failed
+
+    """
+    curl = self.curl
+    self.curl = None
+    healthy = False
+    try:
+      if errno is not None:
+        if errno in _CURL_SSL_CERT_ERRORS:
+          self.error = CertificateError("SSL certificate error %s" % errmsg,
+                                        code=errno)
+        else:
+          self.error = GanetiApiError(str((errno, errmsg)), code=errno)
+        return
+
+      # Get HTTP response code
+      http_code = curl.getinfo(pycurl.RESPONSE_CODE)
+      healthy = True
+    finally:
+      # Reset settings to not keep references to large objects in memory
+      # between requests
+      curl.setopt(pycurl.POSTFIELDS, "")
+      curl.setopt(pycurl.WRITEFUNCTION, lambda _: None)
+      # Handles whose transfer failed may be left with a broken connection
+      self.client._CheckinCurl(curl, healthy)
+
+    if self.decoder is not None:
+      self.encoded_resp_body.write(self.decoder.GetRemainder())
+
+    try:
+      self.result = _DecodeResponse(http_code, self.encoded_resp_body)
+    except GanetiApiError as err:
+      self.error = err
+    except ValueError as err:
+      # The body is not JSON, e.g. an error page of a proxy in front of RAPI
+      self.error = GanetiApiError("Invalid response: %s" % err,
+                                  code=http_code)
+
+  def Fail(self, error):
+    """Marks the request as failed without a response.
+
+    """
+    if self.curl is not None:
+      curl = self.curl
+      self.curl = None
+      curl.setopt(pycurl.POSTFIELDS, "")
+      curl.setopt(pycurl.WRITEFUNCTION, lambda _: None)
+      self.client._CheckinCurl(curl, False)
+    self.error = error
+
+  def Result(self):
+    """Returns the decoded response or raises the request's error.
+
+    """
+    if self.error is not None:
+      raise self.error # pylint: disable=E0702
+    return self.result
+
+
+def _DecodeResponse(http_code, encoded_resp_body):
+  """Decodes a RAPI response.
+
+  @raises GanetiApiError: If an invalid response is returned
+
+  """
+  # Was anything written to the response buffer?
+  if encoded_resp_body.tell():
+    encoded_resp_body.seek(0)
+    response_content = simplejson.load(encoded_resp_body)
+  else:
+    response_content = None
+
+  if http_code != HTTP_OK:
+    if isinstance(response_content, dict):
+      msg = ("%s %s: %s" %
+             (response_content["code"],
+              response_content["message"],
+              response_content["explain"]))
+    else:
+      msg = str(response_content)
+
+    raise GanetiApiError(msg, code=http_code)
+
+  return response_content
+
+
+def _WaitForSockets(multi, deadline):
+  """Waits until a transfer of a multi handle can make progress.
+
+  Uses C{select.select}, so that waiting yields to other greenlets when
+  running under a monkey-patched gevent.
+
+  """
+  timeout = multi.timeout()
+  if timeout < 0:
+    timeout = 0.1
+  else:
+    timeout = min(timeout / 1000.0, 1.0)
+
+  remaining = _Remaining(deadline)
+  if remaining is not None:
+    timeout = min(timeout, remaining)
+
+  if timeout <= 0:
+    return
+
+  read, write, exc = multi.fdset()
+  if read or write or exc:
+    select.select(read, write, exc, timeout)
+  else:
+    # libcurl has no sockets to wait on yet (e.g. while resolving)
+    time.sleep(min(timeout, 0.05))
+
+
+def _PerformTransfers(transfers):
+  """Drives a set of transfers to completion.
+
+  @type transfers: list of L{_RapiTransfer}
+
+  """
+  for _ in _DriveTransfers(transfers):
+    pass
+
+
+def _DriveTransfers(transfers):
+  """Drives a set of transfers from a single cURL multi handle.
+
+  At most L{MAX_IN_FLIGHT} (see L{SetMaxInFlight}) transfers are active per
+  process; the rest are queued until a slot frees up. Transfers which have not
+  finished by their deadline fail with a timeout error.
+
+  This is a generator yielding whenever data may have been received, so that
+  callers can consume the rows of streamed responses as they come in. Closing
+  it aborts the transfers still running.
+
+  @type transfers: list of L{_RapiTransfer}
+
+  """
+  pending = collections.deque(transfers)
+  active = {}
+  multi = pycurl.CurlMulti()
+
+  def _Finish(curl, errno=None, errmsg=None):
+    multi.remove_handle(curl)
+    transfer = active.pop(curl)
+    _in_flight.release()
+    transfer.Finish(errno, errmsg)
+
+  try:
+    while pending or active:
+      now = time.time()
+      # Give up on transfers whose deadline has passed
+      for transfer in [t for t in pending
+                       if t.deadline is not None and t.deadline <= now]:
+        pending.remove(transfer)
+        transfer.Fail(GanetiApiError("Request timed out before being sent",
+                                     code=pycurl.E_OPERATION_TIMEDOUT))
+      for curl, transfer in list(active.items()):
+        if transfer.deadline is not None and transfer.deadline <= now:
+          multi.remove_handle(curl)
+          del active[curl]
+          _in_flight.release()
+          transfer.Fail(GanetiApiError("Request timed out",
+                                       code=pycurl.E_OPERATION_TIMEDOUT))
+
+      # Start as many transfers as the per-process limit allows. Only block
+      # waiting for a slot if there is nothing to drive meanwhile.
+      while pending:
+        if active:
+          acquired = _in_flight.acquire(False)
+        else:
+          # Never wait for a slot without a timeout: slots held by streamed
+          # responses nobody consumes would otherwise block us forever
+          timeout = _Remaining(pending[0].deadline)
+          if timeout is None:
+            timeout = pending[0].client.slot_timeout
+          acquired = _in_flight.acquire(True, timeout)
+          if not acquired and pending[0].deadline is None:
+            pending.popleft().Fail(
+              GanetiApiError("Timed out waiting for a free transfer slot",
+                             code=pycurl.E_OPERATION_TIMEDOUT))
+            continue
+        if not acquired:
+          break
+        transfer = pending.popleft()
+        try:
+          curl = transfer.Start()
+        except Exception as err: # pylint: disable=W0703
+          _in_flight.release()
+          transfer.Fail(GanetiApiError(str(err)))
+          continue
+        active[curl] = transfer
+        multi.add_handle(curl)
+
+      if not active:
+        continue
+
+      while True:
+        ret, _ = multi.perform()
+        if ret != pycurl.E_CALL_MULTI_PERFORM:
+          break
+
+      while True:
+        queued, ok_list, err_list = multi.info_read()
+        for curl in ok_list:
+          _Finish(curl)
+        for curl, errno, errmsg in err_list:
+          _Finish(curl, errno, errmsg)
+        if not queued:
+          break
+
+      yield
+
+      if active:
+        deadlines = [t.deadline for t in active.values()
+                     if t.deadline is not None]
+        _WaitForSockets(multi, min(deadlines) if deadlines else None)
+  finally:
+    # Only reached with active transfers if something above blew up
+    for curl, transfer in list(active.items()):
+      multi.remove_handle(curl)
+      _in_flight.release()
+      transfer.Fail(GanetiApiError("Request aborted"))
+    multi.close()
+
+
+def _PrepareQuery(what, fields, qfilter, reason):
+  """Builds the path, query arguments and body of a query request.
+
+  """
+  query = []
+  _AppendReason(query, reason)
+
+  body = {
+    "fields": fields,
+    }
+
+  _SetItemIf(body, qfilter is not None, "qfilter", qfilter)
+  # TODO: remove "filter" after 2.7
+  _SetItemIf(body, qfilter is not None, "filter", qfilter)
+
+  return ("/%s/query/%s" % (GANETI_RAPI_VERSION, what), query, body)
+
+
+def ExecuteMany(requests, timeout=None):
+  """Sends several RAPI requests concurrently.
+
+  All requests, possibly against different clusters, are driven from a single
+  event loop. A failed request does not affect the others.
+
+  @type requests: list of tuples
+  @param requests: C{(client, method, path, query)} or
+                   C{(client, method, path, query, content)} tuples
+  @type timeout: number
+  @param timeout: seconds after which requests which haven't completed fail
+  @rtype: list
+  @return: the JSON-decoded response or the L{GanetiApiError} raised for
+           each request, in the order of C{requests}; responses which are not
+           valid JSON are returned as a L{GanetiApiError} too, never as any
+           other exception
+
+  """
+  if timeout is not None:
+    deadline = time.time() + timeout
+  else:
+    deadline = None
+
+  transfers = []
+  for request in requests:
+    client, method, path, query = request[:4]
+    content = request[4] if len(request) > 4 else None
+    transfers.append(_RapiTransfer(client, method, path, query, content,
+                                   deadline=deadline))
+
+  _PerformTransfers(transfers)
+
+  return [t.error if t.error is not None else t.result for t in transfers]
+
+
 class GanetiRapiClient(object): # pylint: disable=R0904
   """Ganeti RAPI client.
 
@@ -421,7 +1044,8 @@ class GanetiRapiClient(object): # pylint: disable=R0904
 
   def __init__(self, host, port=GANETI_RAPI_PORT,
                username=None, password=None, logger=logging,
-               curl_config_fn=None, curl_factory=None):
+               curl_config_fn=None, curl_factory=None, curl_pool=None,
+               timeout=None):
     """Initializes this class.
 
     @type host: string
@@ -434,6 +1058,12 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     @param password: the password to connect with
     @type curl_config_fn: callable
     @param curl_config_fn: Function to configure C{pycurl.Curl} object
+    @type curl_pool: L{CurlPool}
+    @param curl_pool: Pool to reuse C{pycurl.Curl} objects from; a new object
+                      is created for every request if not given
+    @type timeout: number
+    @param timeout: seconds a request may take, also the longest a request
+                    waits for a transfer slot (L{SLOT_TIMEOUT} if not given)
     @param logger: Logging object
 
     """
@@ -442,6 +1072,10 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     self._logger = logger
     self._curl_config_fn = curl_config_fn
     self._curl_factory = curl_factory
+    self._curl_pool = curl_pool
+    if timeout is None:
+      timeout = SLOT_TIMEOUT
+    self.slot_timeout = timeout
 
     try:
       socket.inet_pton(socket.AF_INET6, host)
@@ -495,6 +1129,23 @@ class GanetiRapiClient(object): # pylint: disable=R0904
 
     return curl
 
+  def _CheckoutCurl(self):
+    """Returns a cURL object for a single request.
+
+    """
+    if self._curl_pool is not None:
+      return self._curl_pool.Checkout(self._CreateCurl)
+    return self._CreateCurl()
+
+  def _CheckinCurl(self, curl, healthy):
+    """Releases a cURL object returned by L{_CheckoutCurl}.
+
+    """
+    if self._curl_pool is not None:
+      self._curl_pool.Checkin(curl, healthy=healthy)
+    else:
+      curl.close()
+
   @staticmethod
   def _EncodeQuery(query):
     """Encode query values for RAPI URL.
@@ -545,73 +1196,10 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     @raises GanetiApiError: If an invalid response is returned
 
     """
-    assert path.startswith("/")
+    transfer = _RapiTransfer(self, method, path, query, content)
+    _PerformTransfers([transfer])
 
-    curl = self._CreateCurl()
-
-    if content is not None:
-      encoded_content = self._json_encoder.encode(content)
-    else:
-      encoded_content = ""
-
-    # Build URL
-    urlparts = [self._base_url, path]
-    if query:
-      urlparts.append("?")
-      urlparts.append(urlencode(self._EncodeQuery(query)))
-
-    url = "".join(urlparts)
-
-    self._logger.debug("Sending request %s %s (content=%r)",
-                       method, url, encoded_content)
-
-    # Buffer for response
-    encoded_resp_body = _CompatIO()
-
-    # Configure cURL
-    curl.setopt(pycurl.CUSTOMREQUEST, str(method))
-    curl.setopt(pycurl.URL, str(url))
-    curl.setopt(pycurl.POSTFIELDS, str(encoded_content))
-    curl.setopt(pycurl.WRITEFUNCTION, encoded_resp_body.write)
-
-    try:
-      # Send request and wait for response
-      try:
-        curl.perform()
-      except pycurl.error as err:
-        if err.args[0] in _CURL_SSL_CERT_ERRORS:
-          raise CertificateError("SSL certificate error %s" % err,
-                                 code=err.args[0])
-
-        raise GanetiApiError(str(err), code=err.args[0])
-    finally:
-      # Reset settings to not keep references to large objects in memory
-      # between requests
-      curl.setopt(pycurl.POSTFIELDS, "")
-      curl.setopt(pycurl.WRITEFUNCTION, lambda _: None)
-
-    # Get HTTP response code
-    http_code = curl.getinfo(pycurl.RESPONSE_CODE)
-
-    # Was anything written to the response buffer?
-    if encoded_resp_body.tell():
-      encoded_resp_body.seek(0)
-      response_content = simplejson.load(encoded_resp_body)
-    else:
-      response_content = None
-
-    if http_code != HTTP_OK:
-      if isinstance(response_content, dict):
-        msg = ("%s %s: %s" %
-               (response_content["code"],
-                response_content["message"],
-                response_content["explain"]))
-      else:
-        msg = str(response_content)
-
-      raise GanetiApiError(msg, code=http_code)
-
-    return response_content
+    return transfer.Result()
 
   def GetVersion(self):
     """Gets the Remote API version running on the cluster.
@@ -2473,20 +3061,68 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     @return: job id
 
     """
-    query = []
-    _AppendReason(query, reason)
+    return self._SendRequest(HTTP_PUT,
+                             *_PrepareQuery(what, fields, qfilter, reason))
 
-    body = {
-      "fields": fields,
-      }
+  def PrepareQuery(self, what, fields, qfilter=None, reason=None):
+    """Builds the request of L{Query} for L{ExecuteMany}.
 
-    _SetItemIf(body, qfilter is not None, "qfilter", qfilter)
-    # TODO: remove "filter" after 2.7
-    _SetItemIf(body, qfilter is not None, "filter", qfilter)
+    @type what: string
+    @param what: Resource name, one of L{constants.QR_VIA_RAPI}
+    @type fields: list of string
+    @param fields: Requested fields
+    @type qfilter: None or list
+    @param qfilter: Query filter
+    @type reason: string
+    @param reason: the reason for executing this operation
 
-    return self._SendRequest(HTTP_PUT,
-                             ("/%s/query/%s" %
-                              (GANETI_RAPI_VERSION, what)), query, body)
+    @rtype: tuple
+    @return: C{(client, method, path, query, content)}
+
+    """
+    return (self, HTTP_PUT) + _PrepareQuery(what, fields, qfilter, reason)
+
+  def StreamQuery(self, what, fields, qfilter=None, reason=None):
+    """Retrieves information about resources, row by row.
+
+    Unlike L{Query}, the response is decoded while it is being received and
+    each row is yielded as soon as it is complete.
+
+    @type what: string
+    @param what: Resource name, one of L{constants.QR_VIA_RAPI}
+    @type fields: list of string
+    @param fields: Requested fields
+    @type qfilter: None or list
+    @param qfilter: Query filter
+    @type reason: string
+    @param reason: the reason for executing this operation
+
+    @rtype: generator
+    @return: the rows of the result, each a list of (status, value) pairs
+             in the order of C{fields}
+
+    @raises GanetiApiError: If an invalid response is returned
+
+    """
+    decoder = _QueryRowDecoder()
+    transfer = _RapiTransfer(self, HTTP_PUT,
+                             *_PrepareQuery(what, fields, qfilter, reason),
+                             decoder=decoder)
+
+    drive = _DriveTransfers([transfer])
+    try:
+      for _ in drive:
+        while decoder.rows:
+          yield decoder.rows.popleft()
+    finally:
+      # Runs when the generator is closed or collected before it is
+      # exhausted, aborting the transfer and releasing its slot
+      drive.close()
+
+    transfer.Result()
+
+    while decoder.rows:
+      yield decoder.rows.popleft()
 
   def QueryFields(self, what, fields=None, reason=None):
     """Retrieves available fields for a resource.
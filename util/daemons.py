@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*- vim:fileencoding=utf-8:
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Command line, logging, pid file, daemonization and signal handling shared
+# by the gevent daemons, watcher.py and refresher.py.
+
+import sys
+import atexit
+import logging
+from optparse import OptionParser
+from signal import SIGINT, SIGTERM
+
+import daemon
+import daemon.pidfile
+import setproctitle
+from lockfile import LockError
+
+from gevent import signal
+from gevent import reinit as gevent_reinit
+
+
+def option_parser(default_pid_file, default_log_file):
+    """Returns an OptionParser with the options every daemon takes"""
+    parser = OptionParser()
+    parser.add_option("-d", "--debug", action="store_true", dest="debug")
+    parser.add_option("-p", "--pid-file", dest="pid_file",
+                      default=default_pid_file, metavar="FILE",
+                      help="Save PID to file (default: %s)" % default_pid_file)
+    parser.add_option("-l", "--log-file", dest="log_file",
+                      default=default_log_file, metavar="FILE",
+                      help="Write log to FILE (default: %s)" %
+                           default_log_file)
+    parser.add_option("-f", "--foreground", action="store_true",
+                      dest="foreground", help="Do not daemonize")
+    parser.add_option("-u", "--user", dest="user", metavar="USER",
+                      help="User to run as")
+    parser.add_option("-g", "--group", dest="group", metavar="GROUP",
+                      help="Group to run as")
+    return parser
+
+
+def setup_logging(name, opts, log_format="%(asctime)s %(message)s"):
+    """Returns the logger of the daemon, logging to the --log-file"""
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG if opts.debug else logging.INFO)
+    formatter = logging.Formatter(log_format, "%m/%d/%Y %I:%M:%S %p")
+    handler = logging.FileHandler(opts.log_file)
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    return logger
+
+
+class AllFilesDaemonContext(daemon.DaemonContext):
+    """ DaemonContext class keeping all file descriptors open """
+    def _get_exclude_file_descriptors(self):
+        class All:
+            def __contains__(self, value):
+                return True
+        return All()
+
+
+def _lock_failed():
+    sys.stderr.write("Unable to acquire PID file lock."
+                     " Is another process running?\n")
+    sys.exit(1)
+
+
+def daemonize(opts, logger):
+    """Takes the pid file and, unless --foreground was given, forks to the
+    background as --user and --group. Returns the DaemonContext, None in the
+    foreground.
+    """
+    pidf = daemon.pidfile.TimeoutPIDLockFile(opts.pid_file, 3)
+    if opts.foreground:
+        try:
+            pidf.__enter__()
+        except LockError:
+            _lock_failed()
+        atexit.register(pidf.__exit__)
+        return None
+
+    # Currently, gevent uses libevent-dns for asynchornous DNS resolution,
+    # which opens a socket upon initialization time. Since we can't get the fd
+    # reliably, We have to maintain all file descriptors open (which won't harm
+    # anyway)
+    context = AllFilesDaemonContext(pidfile=pidf, umask=0o022)
+    if opts.user:
+        try:
+            context.uid = int(opts.user)
+        except ValueError:
+            import pwd
+            try:
+                context.uid = pwd.getpwnam(opts.user).pw_uid
+            except KeyError:
+                sys.stderr.write("User %s not found\n" % opts.user)
+                sys.exit(1)
+
+    if opts.group:
+        try:
+            context.gid = int(opts.group)
+        except ValueError:
+            import grp
+            try:
+                context.gid = grp.getgrnam(opts.group).gr_gid
+            except KeyError:
+                sys.stderr.write("Group %s not found\n" % opts.group)
+                sys.exit(1)
+
+    try:
+        context.open()
+    except LockError:
+        _lock_failed()
+
+    logger.info("Forked to background")
+    # We must reinit gevent after forking
+    gevent_reinit()
+    return context
+
+
+def exit_on_signals(logger):
+    """Exits on SIGINT and SIGTERM"""
+    def fatal_signal_handler(signum, frame):
+        logger.info("Caught %s, exiting" % signum)
+        raise SystemExit
+
+    signal.signal(SIGINT, fatal_signal_handler)
+    signal.signal(SIGTERM, fatal_signal_handler)
+
+
+def start(name, opts, log_format="%(asctime)s %(message)s"):
+    """Sets up logging, daemonizes, handles signals and sets the process
+    title, as every daemon does on startup. Returns the logger and the
+    DaemonContext (None in the foreground).
+    """
+    logger = setup_logging(name, opts, log_format)
+    logger.info("Starting up")
+    context = daemonize(opts, logger)
+    exit_on_signals(logger)
+
+    # Set the process title
+    setproctitle.setproctitle(sys.argv[0])
+
+    logger.info("Initialization complete")
+    return logger, context
@@ -22,17 +22,15 @@ import json
 from gevent import monkey
 monkey.patch_all()
 
-import atexit
-import daemon
-import logging
-import daemon.pidfile
+from time import time
 import setproctitle
-from lockfile import LockError
 from signal import SIGINT, SIGTERM
 
-from gevent import sleep, signal
+from gevent import Timeout, sleep, signal, spawn, wait
+from gevent.event import AsyncResult, Event
 from gevent import reinit as gevent_reinit
-from gevent.pool import Pool
+from gevent.lock import Semaphore
+from gevent.queue import Queue
 
 import greenstalk
 import os
@@ -41,7 +39,12 @@ from django.conf import settings
 import django
 django.setup()
 
-from ganeti.models import Cluster
+from ganeti.models import Cluster, rapi_pool_stats, reset_rapi_pools
+from ganeti.jobqueue import WATCHER_SHARDS, watched_tubes
+from ganeti import locks
+from ganeti.localcache import hot_cache
+from util import daemons
+from util.client import GanetiApiError
 from apply.models import InstanceApplication, STATUS_FAILED, STATUS_SUCCESS
 from django.core.cache import cache
 from django.contrib.sites.models import Site
@@ -51,15 +54,40 @@ from django.core.mail import mail_admins, mail_managers, send_mail
 from django import urls
 from django.template.loader import render_to_string
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import close_old_connections
+from django.db import close_old_connections, connections
+from django.core.cache import close_caches
 
 logger = None
 
 POLL_INTERVALS = [0.5, 1, 1, 2, 2, 2, 5]
+# How often handlers waiting for a job touch their locks and reservations
+KEEPALIVE_INTERVAL = 10
+JOB_FIELDS = ["id", "status", "summary", "opstatus", "opresult", "end_ts"]
+# RAPI answers these if it does not know /jobs/<id>/wait
+WAIT_UNSUPPORTED_CODES = (405, 501)
+# RAPI answers this if it does not know the job, e.g. once it is archived
+JOB_NOT_FOUND_CODE = 404
+# After how many ticks in a row that a job is not found it is given up on,
+# and its waiters get a status of JOB_GONE
+MISSING_JOB_TICKS = 10
+JOB_GONE = "gone"
+# How long to poll a cluster whose RAPI did not long-poll, before trying again
+WAIT_RETRY_INTERVAL = 3600
 DEFAULT_WORKERS = 10
+# Per job type concurrency, overriding the --workers option
+WORKERS = getattr(settings, "WATCHER_WORKERS", {})
+# How many reserved jobs of each type may wait for a free worker; the
+# watcher stops reserving jobs while the queue of a type is full
+QUEUE_SIZE = getattr(settings, "WATCHER_QUEUE_SIZE", 100)
+RESERVE_TIMEOUT = 1
+# Queued jobs are touched so that their reservation (60s by default) does
+# not run out while they wait for a worker
+QUEUE_TOUCH_INTERVAL = 20
+METRICS_INTERVAL = 60
 DEFAULT_PID_FILE = "/var/run/ganetimgr-watcher.pid"
 DEFAULT_LOG_FILE = "/var/log/ganetimgr/watcher.log"
 RESERVE_ERROR_THRESHOLD = 30
+POOL_STATS_INTERVAL = 300
 
 
 def next_poll_interval():
@@ -70,6 +98,181 @@ def next_poll_interval():
         yield POLL_INTERVALS[-1]
 
 
+# hostname -> time until which the jobs of the cluster are polled
+wait_unsupported = {}
+# hostname -> JobTracker
+trackers = {}
+
+
+class JobTracker(object):
+    """Tracks the outstanding jobs of a cluster for the handlers waiting on
+    them.
+
+    All outstanding jobs are resolved with a single RAPI call per tick, so
+    the load on the cluster does not grow with the number of jobs. A single
+    outstanding job is long-polled with WaitForJobChange instead, which
+    returns as soon as the job changes, or as soon as another job is added.
+
+    Jobs that the cluster does not know for MISSING_JOB_TICKS ticks in a row
+    end with a status of JOB_GONE.
+    """
+    def __init__(self, cluster):
+        self.cluster = cluster
+        # job id -> AsyncResult set to the status of the finished job
+        self.waiters = {}
+        # job id -> number of ticks in a row the job was not found
+        self.missing = {}
+        self.added = False
+        # set when a job is added, to interrupt long-polling
+        self.wakeup = Event()
+        self.greenlet = None
+        # (job id, job info, log serial) of the long-polled job
+        self.long_poll_state = (None, None, None)
+
+    def wait(self, job_id, timeout):
+        """Returns the status of the job once it ends, raises
+        gevent.Timeout if it has not ended after timeout seconds
+        """
+        result = self.waiters.get(job_id)
+        if result is None:
+            result = self.waiters[job_id] = AsyncResult()
+            self.added = True
+            self.wakeup.set()
+        if self.greenlet is None or self.greenlet.dead:
+            self.greenlet = spawn(self.run)
+        return result.get(timeout=timeout)
+
+    def forget(self, job_id):
+        self.waiters.pop(job_id, None)
+        self.missing.pop(job_id, None)
+
+    def run(self):
+        pi = next_poll_interval()
+        while self.waiters:
+            if self.added:
+                # new jobs usually end soon, start polling fast again
+                self.added = False
+                pi = next_poll_interval()
+            job_ids = list(self.waiters)
+            if (
+                len(job_ids) == 1 and
+                wait_unsupported.get(self.cluster.hostname, 0) <= time()
+            ):
+                statuses = self.long_poll(job_ids[0], pi)
+            else:
+                sleep(next(pi))
+                statuses = self.poll(job_ids)
+            if statuses is not None:
+                self.resolve(job_ids, statuses)
+
+    def resolve(self, job_ids, statuses):
+        """Hands the statuses of the jobs that ended to their waiters.
+        statuses are those of the job_ids that the cluster knows.
+        """
+        for job_id in job_ids:
+            status = statuses.get(job_id)
+            if status is None:
+                missing = self.missing[job_id] = \
+                    self.missing.get(job_id, 0) + 1
+                if missing < MISSING_JOB_TICKS:
+                    continue
+                logger.warn("Job %d not found on %s, giving up on it" %
+                            (job_id, self.cluster.hostname))
+                status = dict.fromkeys(JOB_FIELDS)
+                status.update(id=job_id, status=JOB_GONE)
+            elif not status.get("end_ts"):
+                self.missing.pop(job_id, None)
+                continue
+            self.missing.pop(job_id, None)
+            if job_id in self.waiters:
+                self.waiters.pop(job_id).set(status)
+
+    def long_poll(self, job_id, pi):
+        """Returns the statuses of the jobs the cluster knows, as poll does,
+        None if nothing changed or a job was added while waiting.
+        """
+        self.wakeup.clear()
+        waiting = spawn(self.wait_for_change, job_id, pi)
+        wait([waiting, self.wakeup], count=1)
+        if not waiting.ready():
+            # poll every outstanding job from now on, the request finishes
+            # on its own
+            return None
+        return waiting.value
+
+    def wait_for_change(self, job_id, pi):
+        last_job_id, job_info, log_serial = self.long_poll_state
+        if last_job_id != job_id:
+            job_info = log_serial = None
+        logger.debug("Waiting for job %d on %s" %
+                     (job_id, self.cluster.hostname))
+        try:
+            change = self.cluster.wait_for_job_change(
+                job_id, JOB_FIELDS, job_info, log_serial
+            )
+        except GanetiApiError as err:
+            if err.code == JOB_NOT_FOUND_CODE:
+                # unknown or archived, look it up among every job
+                sleep(next(pi))
+                return self.poll([job_id])
+            if err.code in WAIT_UNSUPPORTED_CODES:
+                logger.info("Cluster %s does not support waiting for jobs"
+                            " (%s), polling its jobs instead" %
+                            (self.cluster.hostname, str(err)))
+                wait_unsupported[self.cluster.hostname] = \
+                    time() + WAIT_RETRY_INTERVAL
+            else:
+                logger.warn("Error waiting for job %d: %s" %
+                            (job_id, str(err)))
+                sleep(next(pi))
+            return None
+        except Exception as err:
+            logger.warn("Error waiting for job %d: %s" % (job_id, str(err)))
+            sleep(next(pi))
+            return None
+
+        if change is None:
+            # RAPI gave up waiting, nothing changed
+            return None
+        job_info = change["job_info"]
+        for entry in change.get("log_entries") or []:
+            log_serial = max(log_serial or 0, entry[0])
+        self.long_poll_state = (job_id, job_info, log_serial)
+        return {job_id: dict(zip(JOB_FIELDS, job_info))}
+
+    def poll(self, job_ids):
+        """Returns the statuses of the job_ids that the cluster knows, None
+        if it could not be asked
+        """
+        logger.debug("Polling %d job(s) on %s" %
+                     (len(job_ids), self.cluster.hostname))
+        try:
+            return self.cluster.get_job_statuses(job_ids, JOB_FIELDS)
+        except Exception as err:
+            logger.warn("Error polling jobs of %s: %s" %
+                        (self.cluster.hostname, str(err)))
+            return None
+
+
+def wait_for_job(cluster, job_id, keepalive):
+    """Blocks until the job ends and returns its status, the status of which
+    is JOB_GONE if the cluster no longer knows the job.
+
+    keepalive() is called every KEEPALIVE_INTERVAL seconds while waiting and
+    may return False to stop waiting, in which case None is returned.
+    """
+    tracker = trackers.get(cluster.hostname)
+    if tracker is None:
+        tracker = trackers[cluster.hostname] = JobTracker(cluster)
+    while True:
+        try:
+            return tracker.wait(int(job_id), KEEPALIVE_INTERVAL)
+        except Timeout:
+            if not keepalive():
+                tracker.forget(int(job_id))
+                return None
+
+
 def try_log(fn, *args, **kwargs):
     global logger
     try:
@@ -78,50 +281,100 @@ def try_log(fn, *args, **kwargs):
         logger.error("%s: %s" % (fn.__name__, str(e)))
 
 
-def monitor_jobs():
-    # We have to open one socket per Greenlet, as currently socket sharing is
-    # not allowed
-    try:
-        b = greenstalk.Client(host=settings.BEANSTALKD_HOST, port=settings.BEANSTALKD_PORT)
-    except Exception as err:
-        logger.error("Error connecting to beanstalkd: %s" % str(err))
-        sleep(5)
-        return
+class Connection(object):
+    """The beanstalkd connection of a watcher process.
+
+    It is shared by the reserver and every handler, since beanstalkd only
+    lets the connection that reserved a job delete, touch or bury it, so
+    commands are serialized. Reserving only blocks for RESERVE_TIMEOUT
+    seconds at a time and then yields, to let the handlers waiting for the
+    connection delete, touch and bury their jobs in between.
+    """
+    def __init__(self, tubes):
+        self.tubes = tubes
+        self.lock = Semaphore()
+        self.client = None
+
+    def connect(self):
+        with self.lock:
+            if self.client is not None:
+                return
+            client = greenstalk.Client(host=settings.BEANSTALKD_HOST,
+                                       port=settings.BEANSTALKD_PORT)
+            for tube in self.tubes:
+                client.watch(tube)
+            if "default" not in self.tubes:
+                client.ignore("default")
+            self.client = client
+
+    def close(self):
+        if self.client is not None:
+            try:
+                self.client.close()
+            except Exception:
+                pass
+            self.client = None
+
+    def _call(self, command, *args):
+        with self.lock:
+            if self.client is None:
+                raise ConnectionError("Not connected to beanstalkd")
+            try:
+                return getattr(self.client, command)(*args)
+            except greenstalk.Error:
+                raise
+            except Exception:
+                # the reserver reconnects, jobs reserved on this connection
+                # are released by beanstalkd
+                self.close()
+                raise
+
+    def reserve(self, timeout):
+        try:
+            return self._call("reserve", timeout)
+        finally:
+            # the lock is free again, but the waiting handlers only get it
+            # once we yield, not if the reserver takes it again right away
+            sleep(0)
 
-    try:
-        b.watch(settings.BEANSTALK_TUBE)
-        b.ignore("default")
-    except AttributeError:
-        # We are watching "default" anyway
-        pass
+    def stats_job(self, job):
+        return self._call("stats_job", job)
 
-    while True:
-        job = b.reserve()
-        stats = b.stats_job(job)
+    def delete(self, job):
+        return self._call("delete", job)
 
-        # Check for erratic jobs and bury them
-        if stats["reserves"] > RESERVE_ERROR_THRESHOLD:
-            logger.error("Job %d reserved %d (> %d) times, burying" %
-                         (job.id, stats["reserves"], RESERVE_ERROR_THRESHOLD))
-            b.bury(job)
-            continue
+    def bury(self, job):
+        return self._call("bury", job)
 
-        try:
-            data = json.loads(job.body)
-        except ValueError:
-            logger.error("Job %d has malformed body '%s', burying" %
-                         (job.id, job.body))
-            b.bury(job)
-            continue
+    def touch(self, job):
+        return self._call("touch", job)
 
-        if "type" in data and data["type"] in DISPATCH_TABLE:
-            DISPATCH_TABLE[data["type"]](b, job)
 
-def clear_cluster_users_cache(cluster_slug):
-    cache.delete("cluster:%s:instances" % cluster_slug)
-    close_old_connections()
+def report_rapi_pools():
+    # All Cluster objects of this process share the same RAPI handle pools,
+    # periodically log how well they are doing
+    while True:
+        sleep(POOL_STATS_INTERVAL)
+        for hostname, stats in sorted(rapi_pool_stats().items()):
+            logger.info("RAPI pool %s: %d idle, %d hits, %d misses,"
+                        " %d evictions, %d discards" %
+                        (hostname, stats["idle"], stats["hits"],
+                         stats["misses"], stats["evictions"],
+                         stats["discards"]))
+
+
+def refresh_cluster_snapshot(cluster, names):
+    # Patch only the instances the job touched into the cluster snapshot, so
+    # that everybody else keeps their warm listing
+    try:
+        cluster.refresh_instance_rows(names)
+    except Exception as err:
+        logger.warn("Error refreshing instances %s of cluster %s: %s,"
+                    " dropping the cluster snapshot" %
+                    (", ".join(names), cluster.slug, str(err)))
+        cluster.drop_instances()
 
-def handle_job_lock(b: greenstalk.Client, job: greenstalk.Job):
+def handle_job_lock(b: Connection, job: greenstalk.Job):
     global logger
     data = json.loads(job.body)
     lock_key = data["lock_key"]
@@ -140,59 +393,41 @@ def handle_job_lock(b: greenstalk.Client, job: greenstalk.Job):
     finally:
         close_old_connections()
 
-    pi = next_poll_interval()
-    while True:
+    def keepalive():
         logger.debug("Checking lock key %s (job: %d)" % (lock_key, job_id))
         reason = cache.get(lock_key)
         if reason is None:
-            logger.info("Lock key %s vanished, forgetting it" % lock_key)
-            b.delete(job)
-            return
-
-        logger.debug("Polling job %d" % job_id)
-        try:
-            status = cluster.get_job_status(job_id)
-        except Exception as err:
-            logger.warn("Error polling job: %s" % str(err))
-            close_old_connections()
-            sleep(next(pi))
-            continue
-        finally:
-            close_old_connections()
-        logger.debug("Done")
-
-        if status["end_ts"]:
-            logger.info("Job %d finished, removing lock %s" %
-                         (job_id, lock_key))
-            if "flush_keys" in data:
-                for key in data["flush_keys"]:
-                    cache.delete(key)
-
-            cache.delete(lock_key)
-            locked_instances = cache.get('locked_instances')
-            # This should contain at least 1 instance
-            if locked_instances is not None:
-                try:
-                    locked_instances.pop("%s"%instance)
-                except KeyError:
-                    pass
-                if len(locked_instances) == 0:
-                    cache.delete('locked_instances')
-                else:
-                    cache.set('locked_instances', locked_instances, 90)
-            else:
-                # This could be due to a cache fail or restart. For the time log it
-                logger.warn("Unable to find instance %s in locked instances cache key" %instance)
-            clear_cluster_users_cache(cluster.slug)
-            b.delete(job)
-            return
+            return False
         # Touch the key
         cache.set(lock_key, reason, 30)
         b.touch(job)
-        sleep(next(pi))
+        return True
 
+    status = keepalive() and wait_for_job(cluster, job_id, keepalive)
+    if not status:
+        logger.info("Lock key %s vanished, forgetting it" % lock_key)
+        b.delete(job)
+        return
 
-def handle_creation(b: greenstalk.Client, job: greenstalk.Job):
+    # a job that is gone does not hold the instance either
+    logger.info("Job %d %s, removing lock %s" %
+                 (job_id, "gone" if status["status"] == JOB_GONE
+                  else "finished", lock_key))
+    if "flush_keys" in data:
+        for key in data["flush_keys"]:
+            hot_cache.delete(key)
+
+    cache.delete(lock_key)
+    if not locks.unlock_instance("%s" % instance):
+        # This could be due to a cache fail or restart. For the time log it
+        logger.warn("Unable to find instance %s in locked instances" % instance)
+    refresh_cluster_snapshot(
+        cluster, data.get("refresh_names", [instance])
+    )
+    b.delete(job)
+
+
+def handle_creation(b: Connection, job: greenstalk.Job):
     global logger
     data = json.loads(job.body)
 
@@ -212,58 +447,70 @@ def handle_creation(b: greenstalk.Client, job: greenstalk.Job):
 
     logger.info("Handling %s (job: %d)",
                  application.hostname, application.job_id)
-    while True:
-        sleep(15)
+
+    def keepalive():
         logger.info("Checking %s (job: %d)",
                      application.hostname, application.job_id)
-        status = application.cluster.get_job_status(application.job_id)
-        if status["end_ts"]:
-            logger.info("%s (job: %d) done. Status: %s", application.hostname,
-                         application.job_id, status["status"])
-            if status["status"] == "error":
-                application.status = STATUS_FAILED
-                application.backend_message = smart_str(status["opresult"])
-                application.save()
-                logger.warn("%s (job: %d) failed. Notifying admins",
-                             application.hostname, application.job_id)
-                try_log(mail_admins, "Instance creation failure for %s on %s" %
-                             (application.hostname, application.cluster),
-                             json.dumps(status, indent=2))
-            else:
-                application.status = STATUS_SUCCESS
-                application.backend_message = None
-                application.save()
-                logger.info("Mailing %s about %s",
-                             application.applicant.email, application.hostname)
-
-                fqdn = Site.objects.get_current().domain
-                instance_url = "https://%s%s" % \
-                               (fqdn, urls.reverse("instance-detail",
-                                                args=(application.cluster.slug,
-                                                      application.hostname)))
-                mail_body = render_to_string("instances/emails/instance_created_mail.txt",
-                                             {"application": application,
-                                              "instance_url": instance_url,
-                                              "BRANDING": settings.BRANDING
-                                            })
-                mail_body_managers = render_to_string("instances/emails/instance_created_mail.txt",
-                                             {"application": application,
-                                              "reviewer": application.reviewer,
-                                              "instance_url": instance_url,
-                                              "BRANDING": settings.BRANDING
-                                            })
-                try_log(send_mail, settings.EMAIL_SUBJECT_PREFIX +
-                          "Instance %s is ready" % application.hostname,
-                          mail_body, settings.SERVER_EMAIL,
-                          [application.applicant.email])
-                logger.info("Mailing managers about %s" %
-                             application.hostname)
-                try_log(mail_managers, "Instance %s is ready" % application.hostname,
-                              mail_body_managers)
-            b.delete(job)
-            close_old_connections()
-            break
-        b.delete(job)
+        b.touch(job)
+        return True
+
+    status = wait_for_job(application.cluster, application.job_id, keepalive)
+    logger.info("%s (job: %d) done. Status: %s", application.hostname,
+                 application.job_id, status["status"])
+    if status["status"] == JOB_GONE:
+        # whether the instance was created is unknown
+        logger.warn("%s (job: %d) not found, burying" %
+                    (application.hostname, application.job_id))
+        try_log(mail_admins, "Burying job #%d" % job.id,
+                "Job %d of application %d (%s) is not known to %s, please"
+                " inspect it manually" %
+                (application.job_id, application.id, application.hostname,
+                 application.cluster))
+        b.bury(job)
+        close_old_connections()
+        return
+    if status["status"] == "error":
+        application.status = STATUS_FAILED
+        application.backend_message = smart_str(status["opresult"])
+        application.save()
+        logger.warn("%s (job: %d) failed. Notifying admins",
+                     application.hostname, application.job_id)
+        try_log(mail_admins, "Instance creation failure for %s on %s" %
+                     (application.hostname, application.cluster),
+                     json.dumps(status, indent=2))
+    else:
+        application.status = STATUS_SUCCESS
+        application.backend_message = None
+        application.save()
+        logger.info("Mailing %s about %s",
+                     application.applicant.email, application.hostname)
+
+        fqdn = Site.objects.get_current().domain
+        instance_url = "https://%s%s" % \
+                       (fqdn, urls.reverse("instance-detail",
+                                        args=(application.cluster.slug,
+                                              application.hostname)))
+        mail_body = render_to_string("instances/emails/instance_created_mail.txt",
+                                     {"application": application,
+                                      "instance_url": instance_url,
+                                      "BRANDING": settings.BRANDING
+                                    })
+        mail_body_managers = render_to_string("instances/emails/instance_created_mail.txt",
+                                     {"application": application,
+                                      "reviewer": application.reviewer,
+                                      "instance_url": instance_url,
+                                      "BRANDING": settings.BRANDING
+                                    })
+        try_log(send_mail, settings.EMAIL_SUBJECT_PREFIX +
+                  "Instance %s is ready" % application.hostname,
+                  mail_body, settings.SERVER_EMAIL,
+                  [application.applicant.email])
+        logger.info("Mailing managers about %s" %
+                     application.hostname)
+        try_log(mail_managers, "Instance %s is ready" % application.hostname,
+                      mail_body_managers)
+    b.delete(job)
+    close_old_connections()
 
 
 DISPATCH_TABLE = {
@@ -272,124 +519,274 @@ DISPATCH_TABLE = {
 }
 
 
-def parse_arguments(args):
-    from optparse import OptionParser
+class JobTypeMetrics(object):
+    def __init__(self):
+        self.running = 0
+        self.handled = 0
+        self.failed = 0
+        self.wait = 0.0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, wait, latency, failed):
+        self.handled += 1
+        self.failed += int(failed)
+        self.wait += wait
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def report(self, queued):
+        handled = self.handled or 1
+        report = {
+            "queued": queued,
+            "running": self.running,
+            "handled": self.handled,
+            "failed": self.failed,
+            "avg_wait": self.wait / handled,
+            "avg_latency": self.latency / handled,
+            "max_latency": self.max_latency,
+        }
+        # the counters cover one reporting interval
+        self.handled = self.failed = 0
+        self.wait = self.latency = self.max_latency = 0.0
+        return report
+
+
+class Scheduler(object):
+    """Reserves jobs on a single beanstalkd connection and hands them to a
+    bounded pool of workers per job type, through bounded queues.
+    """
+    def __init__(self, workers, tubes):
+        self.connection = Connection(tubes)
+        self.workers = dict(
+            (job_type, WORKERS.get(job_type, workers))
+            for job_type in DISPATCH_TABLE
+        )
+        self.queues = dict(
+            (job_type, Queue(QUEUE_SIZE)) for job_type in DISPATCH_TABLE
+        )
+        self.metrics = dict(
+            (job_type, JobTypeMetrics()) for job_type in DISPATCH_TABLE
+        )
+        # job id -> job, for the jobs waiting in the queues
+        self.queued = {}
+
+    def run(self):
+        logger.info("Watching tube(s) %s" % ", ".join(self.connection.tubes))
+        for job_type, workers in self.workers.items():
+            logger.info("Handling up to %d %s jobs at a time" %
+                        (workers, job_type))
+            for i in range(workers):
+                spawn(self.work, job_type)
+        spawn(self.touch_queued)
+        spawn(self.report_metrics)
+        self.reserve()
+
+    def reserve(self):
+        b = self.connection
+        while True:
+            try:
+                b.connect()
+                job = b.reserve(RESERVE_TIMEOUT)
+            except greenstalk.TimedOutError:
+                continue
+            except Exception as err:
+                logger.error("Error reserving jobs from beanstalkd: %s" %
+                             str(err))
+                b.close()
+                sleep(5)
+                continue
 
-    parser = OptionParser()
-    parser.add_option("-w", "--workers", dest="workers",
-                      default=DEFAULT_WORKERS, metavar="NUM",
-                      help="The number of workers monitoring jobs"
-                           " simultaneously (default: %d)" % DEFAULT_WORKERS)
-    parser.add_option("-d", "--debug", action="store_true", dest="debug")
-    parser.add_option("-p", "--pid-file", dest="pid_file",
-                      default=DEFAULT_PID_FILE, metavar="FILE",
-                      help="Save PID to file (default: %s)" % DEFAULT_PID_FILE)
-    parser.add_option("-l", "--log-file", dest="log_file",
-                      default=DEFAULT_LOG_FILE, metavar="FILE",
-                      help="Write log to FILE (default: %s)" %
-                           DEFAULT_LOG_FILE)
-    parser.add_option("-f", "--foreground", action="store_true",
-                      dest="foreground", help="Do not daemonize")
-    parser.add_option("-u", "--user", dest="user", metavar="USER",
-                      help="User to run as")
-    parser.add_option("-g", "--group", dest="group", metavar="GROUP",
-                      help="Group to run as")
-    return parser.parse_args(args)
+            try:
+                job_type = self.check(job)
+            except Exception as err:
+                logger.error("Error checking job %d: %s" % (job.id, str(err)))
+                continue
+            if job_type is None:
+                continue
+            self.queued[job.id] = job
+            # blocks while the queue is full, so that no more jobs are
+            # reserved than can be handled
+            self.queues[job_type].put((job, time()))
+
+    def check(self, job):
+        """Returns the type of a reserved job, or None if it was buried"""
+        b = self.connection
+        stats = b.stats_job(job)
 
+        # Check for erratic jobs and bury them
+        if stats["reserves"] > RESERVE_ERROR_THRESHOLD:
+            logger.error("Job %d reserved %d (> %d) times, burying" %
+                         (job.id, stats["reserves"], RESERVE_ERROR_THRESHOLD))
+            b.bury(job)
+            return None
 
-class AllFilesDaemonContext(daemon.DaemonContext):
-    """ DaemonContext class keeping all file descriptors open """
-    def _get_exclude_file_descriptors(self):
-        class All:
-            def __contains__(self, value):
-                return True
-        return All()
+        try:
+            data = json.loads(job.body)
+        except ValueError:
+            logger.error("Job %d has malformed body '%s', burying" %
+                         (job.id, job.body))
+            b.bury(job)
+            return None
 
+        if data.get("type") not in DISPATCH_TABLE:
+            logger.error("Job %d has unknown type %s, burying" %
+                         (job.id, data.get("type")))
+            b.bury(job)
+            return None
+        return data["type"]
+
+    def work(self, job_type):
+        queue = self.queues[job_type]
+        metrics = self.metrics[job_type]
+        handler = DISPATCH_TABLE[job_type]
+        while True:
+            job, queued_at = queue.get()
+            self.queued.pop(job.id, None)
+            started = time()
+            failed = False
+            metrics.running += 1
+            try:
+                handler(self.connection, job)
+            except Exception as err:
+                # left reserved, beanstalkd hands it out again once its
+                # reservation runs out
+                logger.error("Error handling %s job %d: %s" %
+                             (job_type, job.id, str(err)))
+                failed = True
+            finally:
+                metrics.running -= 1
+                close_old_connections()
+            metrics.record(started - queued_at, time() - started, failed)
+
+    def touch_queued(self):
+        while True:
+            sleep(QUEUE_TOUCH_INTERVAL)
+            for job in list(self.queued.values()):
+                try_log(self.connection.touch, job)
+
+    def report_metrics(self):
+        while True:
+            sleep(METRICS_INTERVAL)
+            metrics = dict(
+                (job_type, self.metrics[job_type].report(queue.qsize()))
+                for job_type, queue in self.queues.items()
+            )
+            for job_type, report in sorted(metrics.items()):
+                logger.info("%s jobs: %d queued, %d running, %d handled"
+                            " (%d failed), %.1fs average wait, %.1fs average"
+                            " latency, %.1fs max latency" %
+                            (job_type, report["queued"], report["running"],
+                             report["handled"], report["failed"],
+                             report["avg_wait"], report["avg_latency"],
+                             report["max_latency"]))
+            cache.set("watcher:metrics:%d" % os.getpid(), metrics,
+                      2 * METRICS_INTERVAL)
 
-def fatal_signal_handler(signum, frame):
-    logger.info("Caught %s, exiting" % signum)
-    raise SystemExit
 
+def parse_arguments(args):
+    parser = daemons.option_parser(DEFAULT_PID_FILE, DEFAULT_LOG_FILE)
+    parser.add_option("-w", "--workers", dest="workers", type="int",
+                      default=DEFAULT_WORKERS, metavar="NUM",
+                      help="The number of jobs of each type handled"
+                           " simultaneously, unless set in WATCHER_WORKERS"
+                           " (default: %d)" % DEFAULT_WORKERS)
+    parser.add_option("-n", "--processes", dest="processes", type="int",
+                      default=1, metavar="NUM",
+                      help="The number of worker processes, each handling"
+                           " the jobs of a share of the clusters; at most"
+                           " WATCHER_SHARDS (default: 1)")
+    return parser.parse_args(args)
 
-def main():
-    opts, args = parse_arguments(sys.argv[1:])
-    pidf = daemon.pidfile.TimeoutPIDLockFile(opts.pid_file, 3)
 
-    lvl = logging.DEBUG if opts.debug else logging.INFO
+# pid -> number of the worker processes, in the parent
+worker_pids = {}
 
-    global logger
-    logger = logging.getLogger("watcher")
-    logger.setLevel(lvl)
-    formatter = logging.Formatter("%(asctime)s %(message)s",
-                                  "%m/%d/%Y %I:%M:%S %p")
-    handler = logging.FileHandler(opts.log_file)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-
-    logger.info("Starting up")
-
-    context = None
-    if not opts.foreground:
-        # Currently, gevent uses libevent-dns for asynchornous DNS resolution,
-        # which opens a socket upon initialization time. Since we can't get the fd
-        # reliably, We have to maintain all file descriptors open (which won't harm
-        # anyway)
-        context = AllFilesDaemonContext(pidfile=pidf, umask=0o022)
-        if opts.user:
-            try:
-                context.uid = int(opts.user)
-            except ValueError:
-                import pwd
-                try:
-                    context.uid = pwd.getpwnam(opts.user).pw_uid
-                except KeyError:
-                    sys.stderr.write("User %s not found\n" % opts.user)
-                    sys.exit(1)
-
-        if opts.group:
-            try:
-                context.gid = int(opts.group)
-            except ValueError:
-                import grp
-                try:
-                    context.gid = grp.getgrnam(opts.group).gr_gid
-                except KeyError:
-                    sys.stderr.write("Group %s not found\n" % opts.group)
-                    sys.exit(1)
 
+def terminate_workers(signum, frame):
+    logger.info("Caught %s, stopping workers and exiting" % signum)
+    for pid in list(worker_pids):
         try:
-            context.open()
-        except LockError:
-            sys.stderr.write("Unable to acquire PID file lock."
-                             " Is another process running?\n")
-            sys.exit(1)
+            os.kill(pid, SIGTERM)
+        except OSError:
+            pass
+    raise SystemExit
+
 
-        logger.info("Forked to background")
+def start_worker(process):
+    """Forks worker process number process. Returns True in the worker."""
+    # The worker must not share the connections of the parent
+    connections.close_all()
+    close_caches()
+    pid = os.fork()
+    if pid == 0:
         # We must reinit gevent after forking
         gevent_reinit()
+        # The RAPI handles of the parent are not ours to use
+        reset_rapi_pools()
+        worker_pids.clear()
+        return True
+    worker_pids[pid] = process
+    logger.info("Started worker %d (pid %d)" % (process, pid))
+    return False
+
+
+def supervise_workers():
+    """Restarts worker processes that exit. Only returns in a restarted
+    worker, with its number.
+    """
+    while True:
+        pid, status = os.waitpid(-1, 0)
+        process = worker_pids.pop(pid, None)
+        if process is None:
+            continue
+        logger.warn("Worker %d (pid %d) exited with status %d, restarting"
+                    " it" % (process, pid, status))
+        sleep(1)
+        if start_worker(process):
+            return process
 
-    else:
-        try:
-            pidf.__enter__()
-        except LockError:
-            sys.stderr.write("Unable to acquire PID file lock."
-                             " Is another process running?\n")
-            sys.exit(1)
-        atexit.register(pidf.__exit__)
 
-    signal.signal(SIGINT, fatal_signal_handler)
-    signal.signal(SIGTERM, fatal_signal_handler)
+def run_worker(process, processes, opts):
+    tubes = watched_tubes(process, processes)
+    if processes > 1:
+        setproctitle.setproctitle("%s worker %d" % (sys.argv[0], process))
+    spawn(report_rapi_pools)
+    Scheduler(opts.workers, tubes).run()
 
-    # Set the process title
-    setproctitle.setproctitle(sys.argv[0])
 
-    logger.info("Initialization complete")
-    p = Pool(opts.workers)
-    while True:
-        logger.debug("Spawning new worker")
-        p.spawn(monitor_jobs)
+def main():
+    opts, args = parse_arguments(sys.argv[1:])
+
+    global logger
+    log_format = "%(asctime)s %(message)s"
+    if opts.processes > 1:
+        log_format = "%(asctime)s [%(process)d] %(message)s"
+    logger, context = daemons.start("watcher", opts, log_format)
+
+    processes = opts.processes
+    if processes > WATCHER_SHARDS:
+        logger.warn("Only %d shard(s) of jobs (WATCHER_SHARDS), running %d"
+                    " worker process(es) instead of %d" %
+                    (WATCHER_SHARDS, WATCHER_SHARDS, processes))
+        processes = WATCHER_SHARDS
+    if processes == 1:
+        run_worker(0, 1, opts)
+        return
+
+    # Every worker handles the jobs of its own share of the clusters, so no
+    # job is polled twice and RAPI pools are not shared
+    for process in range(processes):
+        if start_worker(process):
+            break
+    else:
+        signal.signal(SIGINT, terminate_workers)
+        signal.signal(SIGTERM, terminate_workers)
+        process = supervise_workers()
+    daemons.exit_on_signals(logger)
+    run_worker(process, processes, opts)
 
-    if opts.daemonize:
+    if context is not None:
         context.close()
 
 if __name__ == "__main__":